@@ -0,0 +1,217 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy.orm import Session
+# to support Python versions lower than 3.8, we import
+# `Literal` from typing_extensions instead from the builtin module
+#   See also: https://docs.python.org/3/library/typing.html#typing.Literal
+from typing_extensions import Literal
+
+from app.api import crud, schemas, utils
+from app.api.config import get_api_settings
+from app.api.metrics import AUDIT_WRITES
+from app.api.timing import phase
+from app.database import SessionLocal
+
+log = logging.getLogger("api")
+
+
+class AuditWriter:
+    """
+    Register the user actions into the database.
+
+    In `durable` mode each action is committed, using the request's database
+    session, before the request finishes. In `batched` mode, the actions are
+    queued in memory and a background thread inserts them in bulk, whenever
+    `batch_size` actions are pending or every `flush_interval` seconds. The
+    queue is bounded by `max_buffer`: if it's full, the request waits up to
+    `enqueue_timeout` seconds and then falls back to a durable write. The
+    pending actions are written when the writer is stopped, skipping the
+    actions of the users removed in the meantime.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        mode: Literal["batched", "durable"] = "batched",
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_buffer: int = 10000,
+        enqueue_timeout: float = 0.1,
+    ):
+        self.session_factory = session_factory
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._written = 0
+        self._batches = 0
+        self._fallbacks = 0
+        self._metrics = {
+            mode: AUDIT_WRITES.labels(mode)
+            for mode in ("durable", "batched", "fallback")
+        }
+
+    def start(self) -> None:
+        """Start the background thread (only needed in `batched` mode)."""
+        with self._start_lock:
+            if self.mode != "batched" or self._thread is not None:
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="audit-writer", daemon=True,
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread and write the pending actions."""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop_event.set()
+                self._wakeup.set()
+                thread.join()
+        self.flush()
+
+    def record(self, db: Session, action: schemas.ActionCreate, user_id: int):
+        """Register an user action, depending on the configured mode."""
+        with phase("audit"):
+            return self._record(db, action, user_id)
+
+    def _record(self, db: Session, action: schemas.ActionCreate, user_id: int):
+        if self.mode == "durable":
+            db_action = crud.create_user_action(db, action, user_id)
+            self._metrics["durable"].inc()
+            return db_action
+
+        self.start()
+        row = {
+            **action.dict(),
+            "owner_id": user_id,
+            "timestamp": utils.get_timestamp(),
+        }
+        try:
+            self._queue.put(row, timeout=self.enqueue_timeout)
+            if self._queue.qsize() >= self.batch_size:
+                self._wakeup.set()
+        except queue.Full:
+            log.warning("Audit queue is full, writing action synchronously")
+            self._fallbacks += 1
+            crud.create_user_actions(db, [row])
+            self._metrics["fallback"].inc()
+
+    def _drain(self, max_items: int) -> List[dict]:
+        rows = []
+        while len(rows) < max_items:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def flush(self) -> int:
+        """Write all the queued actions. Returns the number of actions."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                rows = self._drain(self.batch_size)
+                if not rows:
+                    break
+                db = self.session_factory()
+                try:
+                    batch_written = self._write(db, rows)
+                finally:
+                    db.close()
+                written += batch_written
+                self._written += batch_written
+                self._batches += 1
+                self._metrics["batched"].inc(batch_written)
+        return written
+
+    def _write(self, db: Session, rows: List[dict]) -> int:
+        # the users may have been removed since their actions were queued
+        user_ids = crud.get_existing_user_ids(
+            db, (row["owner_id"] for row in rows),
+        )
+        valid_rows = [row for row in rows if row["owner_id"] in user_ids]
+        if len(valid_rows) < len(rows):
+            log.info(
+                f"Discarding {len(rows) - len(valid_rows)} queued actions "
+                f"of removed users"
+            )
+        if not valid_rows:
+            return 0
+        try:
+            crud.create_user_actions(db, valid_rows)
+            return len(valid_rows)
+        except Exception:
+            db.rollback()
+            log.exception(
+                "Failed to write queued actions, writing them one by one"
+            )
+        # so a failing action (e.g. of an user removed meanwhile) doesn't
+        # prevent the rest from being written
+        written = 0
+        for row in valid_rows:
+            try:
+                crud.create_user_actions(db, [row])
+                written += 1
+            except Exception:
+                db.rollback()
+                log.exception(f"Discarding queued action: {row}")
+        return written
+
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while not self._stop_event.is_set():
+            elapsed = time.monotonic() - last_flush
+            if (
+                self._queue.qsize() >= self.batch_size
+                or elapsed >= self.flush_interval
+            ):
+                try:
+                    self.flush()
+                except Exception:
+                    log.exception("Failed to write queued actions")
+                last_flush = time.monotonic()
+                continue
+            self._wakeup.wait(self.flush_interval - elapsed)
+            self._wakeup.clear()
+
+    def stats(self) -> dict:
+        """Return the audit writer metrics."""
+        return {
+            "mode": self.mode,
+            "queued": self._queue.qsize(),
+            "written": self._written,
+            "batches": self._batches,
+            "fallbacks": self._fallbacks,
+        }
+
+
+_audit_writer: Optional[AuditWriter] = None
+
+
+def get_audit_writer() -> AuditWriter:
+    """Return the audit writer, configured via `APISettings`."""
+    global _audit_writer
+    if _audit_writer is None:
+        api_settings = get_api_settings()
+        _audit_writer = AuditWriter(
+            SessionLocal,
+            mode=api_settings.audit_mode,
+            batch_size=api_settings.audit_batch_size,
+            flush_interval=api_settings.audit_flush_interval,
+            max_buffer=api_settings.audit_max_buffer,
+            enqueue_timeout=api_settings.audit_enqueue_timeout,
+        )
+    return _audit_writer
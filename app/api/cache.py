@@ -0,0 +1,465 @@
+"""
+A cache shared by the API workers. The values are stored (as JSON) in one of
+the following backends, selected with the `cache_backend` setting:
+
+- `memory`: an in-process LRU cache, each worker has its own copy
+- `sqlite`: a SQLite file, shared by the workers running in the same host
+- `redis`: a server speaking the Redis protocol, shared by all the workers
+
+The keys of each namespace include a version number stored in the backend,
+so a namespace can be invalidated for every worker by increasing it. Each
+worker keeps the version for a while (`cache_version_ttl`), instead of
+reading it for every value.
+"""
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from app.api.config import DB_DIRECTORY, get_api_settings
+from app.api.metrics import CACHE_REQUESTS
+
+log = logging.getLogger("api")
+
+
+class CacheError(Exception):
+    """An error returned by the cache backend."""
+
+
+class CacheBackend:
+    """
+    The interface of the cache backends. The values are strings, and a `ttl`
+    lower or equal than zero means that the value never expires.
+    """
+    name = ""
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: float = 0) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def incr(self, key: str) -> int:
+        """Increase the counter stored in `key` and return its new value."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """
+    A thread-safe in-process backend, which keeps up to `maxsize` values (the
+    least recently used ones are evicted first). Since the values aren't
+    serialized, it can also be used directly to cache any object.
+    """
+    name = "memory"
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # the counters (versions) are never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._counters:
+                return str(self._counters[key])
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float = 0) -> None:
+        expires_at = time.monotonic() + ttl if ttl > 0 else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    A backend stored in a SQLite file, which can be shared by the workers
+    running in the same host. Each thread uses its own connection.
+    """
+    name = "sqlite"
+    # remove the expired values every `purge_interval` writes
+    purge_interval = 1000
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float = 0) -> None:
+        connection = self._connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) "
+            "VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl > 0 else None),
+        )
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            connection.execute(
+                "DELETE FROM cache WHERE expires_at <= ?", (time.time(),)
+            )
+
+    def delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def incr(self, key: str) -> int:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO cache (key, value, expires_at) "
+                "VALUES (?, '1', NULL) ON CONFLICT (key) "
+                "DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (key,),
+            )
+            value = connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,),
+            ).fetchone()[0]
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return int(value)
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class RedisBackend(CacheBackend):
+    """
+    A backend stored in a server speaking the Redis protocol (RESP), given
+    its url (`redis://host:port/db`). Each thread uses its own connection.
+    """
+    name = "redis"
+
+    def __init__(self, url: str, timeout: float = 1.0):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname or "localhost"
+        self.port = parsed_url.port or 6379
+        self.db = int(parsed_url.path.strip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout,
+            )
+            connection = (sock, sock.makefile("rb"))
+            self._local.connection = connection
+            if self.db:
+                self.execute("SELECT", self.db)
+        return connection
+
+    def _read_reply(self, reader) -> Any:
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the cache server")
+        prefix, data = line[:1], line[1:-2]
+        if prefix == b"+":
+            return data.decode()
+        if prefix == b"-":
+            raise CacheError(data.decode())
+        if prefix == b":":
+            return int(data)
+        if prefix == b"$":
+            length = int(data)
+            if length == -1:
+                return None
+            return reader.read(length + 2)[:-2].decode()
+        if prefix == b"*":
+            length = int(data)
+            if length == -1:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise CacheError(f"Unexpected reply from the cache server: {line!r}")
+
+    def execute(self, *args) -> Any:
+        """Send a command to the server and return its reply."""
+        sock, reader = self._connect()
+        command = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            arg = str(arg).encode()
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        try:
+            sock.sendall(b"".join(command))
+            return self._read_reply(reader)
+        except (OSError, ConnectionError):
+            # the next command will open a new connection
+            self.close()
+            raise
+
+    def get(self, key: str) -> Optional[str]:
+        return self.execute("GET", key)
+
+    def set(self, key: str, value: str, ttl: float = 0) -> None:
+        if ttl > 0:
+            self.execute("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            self.execute("SET", key, value)
+
+    def delete(self, key: str) -> None:
+        self.execute("DEL", key)
+
+    def incr(self, key: str) -> int:
+        return self.execute("INCR", key)
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            sock, reader = connection
+            reader.close()
+            sock.close()
+            self._local.connection = None
+
+
+class Cache:
+    """
+    A namespace of the cache, whose values (any JSON serializable object) are
+    stored in `backend` for `ttl` seconds (`0` disables it). The backend
+    errors are logged and handled as cache misses, so an unavailable cache
+    never breaks a request. The version of the namespace is read from the
+    backend every `version_ttl` seconds, so an invalidation made by other
+    worker is applied after it.
+    """
+
+    def __init__(
+            self,
+            backend: CacheBackend,
+            namespace: str,
+            ttl: float,
+            version_ttl: float = 1.0,
+    ):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        # the version of the namespace, and when it must be read again
+        self._version = ("0", 0.0)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._metrics = {
+            counter: CACHE_REQUESTS.labels(namespace, result)
+            for counter, result in (
+                ("hits", "hit"), ("misses", "miss"), ("errors", "error"),
+            )
+        }
+
+    def _version_key(self) -> str:
+        return f"{self.namespace}:version"
+
+    def _get_version(self, fresh: bool = False) -> str:
+        version, expires_at = self._version
+        now = time.monotonic()
+        if fresh or now >= expires_at:
+            version = self.backend.get(self._version_key()) or "0"
+            self._version = (version, now + self.version_ttl)
+        return version
+
+    def _key(self, key: str, fresh: bool = False) -> str:
+        return f"{self.namespace}:{self._get_version(fresh)}:{key}"
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        self._metrics[counter].inc()
+
+    def get(self, key: str) -> Any:
+        """Return the cached value for `key`, or `None` (a miss)."""
+        if self.ttl <= 0:
+            return None
+        try:
+            value = self.backend.get(self._key(key))
+        except (OSError, CacheError, sqlite3.Error) as e:
+            log.warning(f"Cache error reading {self.namespace}: {e}")
+            self._count("errors")
+            value = None
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store `value` for `key`."""
+        if self.ttl <= 0:
+            return
+        try:
+            self.backend.set(self._key(key), json.dumps(value), self.ttl)
+        except (OSError, CacheError, sqlite3.Error) as e:
+            log.warning(f"Cache error writing {self.namespace}: {e}")
+            self._count("errors")
+
+    def delete(self, key: str) -> None:
+        """
+        Remove `key` from the cache, for every worker sharing the
+        backend.
+        """
+        try:
+            # with the current version, the one used by the other workers
+            self.backend.delete(self._key(key, fresh=True))
+        except (OSError, CacheError, sqlite3.Error) as e:
+            log.warning(f"Cache error deleting {self.namespace}: {e}")
+            self._count("errors")
+
+    def invalidate(self) -> None:
+        """
+        Remove all the values of the namespace, for every worker sharing the
+        backend.
+        """
+        try:
+            version = self.backend.incr(self._version_key())
+            self._version = (str(version), time.monotonic() + self.version_ttl)
+        except (OSError, CacheError, sqlite3.Error) as e:
+            log.warning(f"Cache error invalidating {self.namespace}: {e}")
+            self._count("errors")
+
+    def stats(self) -> dict:
+        """Return the cache metrics."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": self.backend.name,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+_backend: Optional[CacheBackend] = None
+_caches: Dict[str, Cache] = {}
+_token_cache: Optional[MemoryBackend] = None
+
+
+def get_cache_backend() -> CacheBackend:
+    """Return the cache backend configured via `APISettings`."""
+    global _backend
+    if _backend is None:
+        api_settings = get_api_settings()
+        if api_settings.cache_backend == "redis":
+            _backend = RedisBackend(
+                api_settings.cache_url or "redis://localhost:6379/0"
+            )
+        elif api_settings.cache_backend == "sqlite":
+            _backend = SQLiteBackend(
+                api_settings.cache_url or str(DB_DIRECTORY / "cache.db")
+            )
+        else:
+            _backend = MemoryBackend(api_settings.cache_max_entries)
+    return _backend
+
+
+def get_token_cache() -> MemoryBackend:
+    """
+    Return the cache of the decoded access tokens. It is always kept in the
+    worker's memory, since decoding a token is faster than a round trip to a
+    shared backend.
+    """
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = MemoryBackend(get_api_settings().token_cache_size)
+    return _token_cache
+
+
+def _get_cache(namespace: str, ttl: float) -> Cache:
+    if namespace not in _caches:
+        _caches[namespace] = Cache(
+            get_cache_backend(),
+            namespace,
+            ttl,
+            get_api_settings().cache_version_ttl,
+        )
+    return _caches[namespace]
+
+
+def get_user_cache() -> Cache:
+    """
+    Return the cache of the authenticated users (keyed by `user_cache_key`).
+    """
+    return _get_cache("users", get_api_settings().user_cache_ttl)
+
+
+def user_cache_key(username: str, user_id: int) -> str:
+    """Return the key of a user within the cache of the authenticated users."""
+    return f"{username}:{user_id}"
+
+
+def get_histogram_cache() -> Cache:
+    """Return the cache of the histogram responses."""
+    return _get_cache("histograms", get_api_settings().histogram_cache_ttl)
+
+
+def get_primary_reads_cache() -> Cache:
+    """
+    Return the users who have just written something (keyed by username),
+    whose queries must be sent to the primary database.
+    """
+    return _get_cache(
+        "primary_reads", get_api_settings().replica_sticky_seconds,
+    )
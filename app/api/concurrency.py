@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from app.api.config import get_api_settings
+
+try:
+    import contextvars  # Python 3.7+ only.
+except ImportError:  # pragma: no cover
+    contextvars = None
+
+log = logging.getLogger("api")
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the bounded thread pool used to run blocking work (database queries
+    and password hashing) outside of the event loop. The pool is created
+    lazily, with the size set by `APISettings.blocking_pool_size`.
+    """
+    global _executor
+    if _executor is None:
+        pool_size = get_api_settings().blocking_pool_size
+        log.debug(f"Starting blocking thread pool with {pool_size} workers")
+        _executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="blocking",
+        )
+    return _executor
+
+
+def shutdown_executor(wait: bool = True) -> None:
+    """Stop the blocking thread pool (it will be recreated if needed)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking callable in our bounded thread pool and wait for its result
+    without blocking the event loop. The current context is propagated to the
+    worker thread, so context variables are available to the callable.
+    """
+    loop = asyncio.get_event_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if contextvars is not None:
+        call = functools.partial(contextvars.copy_context().run, call)
+    return await loop.run_in_executor(get_executor(), call)
+
+
+class RequestLimiter:
+    """
+    Limit how many requests hold a resource at once (e.g. the connections
+    of the database pool), making the rest wait on the event loop, instead
+    of within a thread of our pool (where a waiting request would keep the
+    thread that a request holding the resource needs to finish).
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        # a semaphore per event loop (usually, only the loop of the server)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # a semaphore can only be used within the loop that created it
+        loop = asyncio.get_event_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def __aenter__(self):
+        await self._get_semaphore().acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._get_semaphore().release()
+
+
+_db_limiter: Optional[RequestLimiter] = None
+
+
+def get_db_limiter() -> RequestLimiter:
+    """
+    Return the limiter of the requests using the database, configured via
+    `APISettings.db_max_requests`.
+    """
+    global _db_limiter
+    if _db_limiter is None:
+        _db_limiter = RequestLimiter(get_api_settings().db_max_requests)
+    return _db_limiter
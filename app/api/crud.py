@@ -1,13 +1,33 @@
 import logging
+from collections import Counter
 from datetime import datetime, timedelta
-
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from sqlalchemy import and_, case, func, or_, select
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Session
 # to support Python versions lower than 3.8, we import
 # `Literal` from typing_extensions instead from the builtin module
 #   See also: https://docs.python.org/3/library/typing.html#typing.Literal
 from typing_extensions import Literal
 
-from app.api import models, schemas, utils, security
+from app.api import hashing, models, schemas, utils
+from app.api.cache import (
+    get_histogram_cache,
+    get_user_cache,
+    user_cache_key,
+)
+from app.api.revocation import get_revocation_list
+from app.api.security import ACCESS_TOKEN_EXPIRE_MINUTES
 
 log = logging.getLogger("api")
 
@@ -24,10 +44,29 @@ def get_user_by_username(db: Session, username: str):
     )
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    """A convenient function to create a new user."""
+def get_existing_user_ids(db: Session, user_ids: Iterable[int]) -> Set[int]:
+    """
+    Given some user ids, returns the ones of the users registered in database
+    (excluding the users being removed in background).
+    """
+    query = db.query(models.User.id).filter(
+        models.User.id.in_(set(user_ids)),
+        models.User.username.isnot(None),
+    )
+    return {user_id for user_id, in query}
+
+
+def create_user(
+        db: Session, user: schemas.UserCreate, hashed_password: str = None,
+):
+    """
+    A convenient function to create a new user. The password is hashed,
+    unless it's already given hashed (`hashed_password`).
+    """
     # generate a random salt to be used for hashing user's password
-    hash_password = security.get_password_hash(user.password)
+    hash_password = (
+        hashed_password or hashing.get_password_hash(user.password)
+    )
     db_user = models.User(
         username=user.username, hashed_password=hash_password
     )
@@ -43,90 +82,366 @@ def create_user(db: Session, user: schemas.UserCreate):
     return db_user
 
 
-def change_user_password(db: Session, user_id: int, new_password):
-    """Change user password."""
+def change_user_password(
+        db: Session, user_id: int, new_password, hashed_password: str = None,
+):
+    """
+    Change user password (hashing it, unless it's already given hashed in
+    `hashed_password`).
+    """
     db_user = get_user(db, user_id)
-    db_user.hashed_password = security.get_password_hash(new_password)
+    db_user.hashed_password = (
+        hashed_password or hashing.get_password_hash(new_password)
+    )
+    revocation = _revoke_user_tokens(db, db_user.username)
     db.commit()
+    get_user_cache().delete(user_cache_key(db_user.username, user_id))
+    get_revocation_list().add(revocation)
     return db_user
 
 
-def remove_user(db: Session, user_id: int) -> schemas.UserRemoved:
+def _revoke_user_tokens(
+        db: Session, username: str,
+) -> models.TokenRevocation:
+    """
+    Revoke all the access tokens issued to an user until now (within the
+    current transaction), removing the expired revocations.
+    """
+    now = datetime.utcnow()
+    db.query(models.TokenRevocation).filter(
+        models.TokenRevocation.expires_at <= now
+    ).delete(synchronize_session=False)
+    revocation = models.TokenRevocation(
+        username=username,
+        issued_before=now,
+        # any token issued before `now` will be expired by then
+        expires_at=now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+    db.add(revocation)
+    return revocation
+
+
+def revoke_token(db: Session, jti: str, expires_at: datetime):
+    """Revoke an access token, given its id (`jti`) and expiration time."""
+    revocation = models.TokenRevocation(jti=jti, expires_at=expires_at)
+    db.add(revocation)
+    db.commit()
+    get_revocation_list().add(revocation)
+    return revocation
+
+
+def remove_user(
+        db: Session, user_id: int, sync_limit: Optional[int] = None,
+) -> schemas.UserRemoved:
     """
      Given an user id, removes an user and all his information from database.
+     The actions are removed with bulk deletes, but if the user has more than
+     `sync_limit` actions, only the account is removed right away (its tokens
+     are revoked and its username is released) and a removal of its actions
+     is registered, to be performed in background by
+     :func:`remove_pending_user_actions`.
     """
     db_user = get_user(db, user_id)
-    db.delete(db_user)
+    username = db_user.username
+    pending = 0
+    if sync_limit is not None:
+        pending = (
+            db.query(func.count(models.Action.id))
+            .filter(models.Action.owner_id == user_id)
+            .scalar()
+        )
+    db.query(models.LastAction).filter(
+        models.LastAction.owner_id == user_id
+    ).delete(synchronize_session=False)
+    revocation = _revoke_user_tokens(db, username)
+    if sync_limit is not None and pending > sync_limit:
+        db.add(models.UserDeletion(
+            user_id=user_id,
+            username=username,
+            total=pending,
+            removed=0,
+            created_at=datetime.utcnow(),
+        ))
+        db_user.username = None
+        db_user.hashed_password = None
+        db_user.is_active = False
+    else:
+        pending = 0
+        _remove_actions(db, models.Action.owner_id == user_id)
+        db.delete(db_user)
     db.commit()
+    # with the `memory` backend, the other workers keep the user cached until
+    # it expires (its tokens are rejected by the revocation list anyway)
+    get_user_cache().delete(user_cache_key(username, user_id))
+    get_histogram_cache().invalidate()
+    get_revocation_list().add(revocation)
     removed_user = schemas.UserRemoved(**{
-        "username": db_user.username, "id": db_user.id,
+        "username": username,
+        "id": user_id,
+        "pending_actions": pending or None,
     })
     log.info(f"Removed user: {removed_user}")
     return removed_user
 
 
-def _get_user_all_actions(db: Session, user_id: int):
-    """A private function that return all actions performed by an user."""
-    return db.query(models.Action).filter(models.Action.owner_id == user_id)
+def _remove_actions(db: Session, *criteria) -> int:
+    """
+    A private function that removes the actions matching `criteria` with a
+    bulk delete, updating the histogram aggregates. The changes are not
+    committed. Returns the number of removed actions.
+    """
+    counts = (
+        db.query(models.Action.title, func.count(models.Action.id))
+        .filter(*criteria)
+        .group_by(models.Action.title)
+    )
+    _update_action_counts(db, {title: -count for title, count in counts})
+    _remove_action_rollups(
+        db,
+        db.query(models.Action.title, models.Action.timestamp)
+        .filter(*criteria)
+        .yield_per(1000),
+    )
+    return db.query(models.Action).filter(*criteria).delete(
+        synchronize_session=False
+    )
+
+
+def get_user_deletions(
+        db: Session, include_finished: bool = False,
+) -> List[models.UserDeletion]:
+    """Return the background removals of users' actions (oldest first)."""
+    query = db.query(models.UserDeletion)
+    if not include_finished:
+        query = query.filter(models.UserDeletion.finished_at.is_(None))
+    return query.order_by(models.UserDeletion.created_at).all()
+
+
+def claim_user_deletion(
+        db: Session, lease: float = 60.0,
+) -> Optional[models.UserDeletion]:
+    """
+    Claim a pending removal of an user's actions, so only one worker performs
+    it. A removal claimed more than `lease` seconds ago (by a worker which
+    stopped) can be claimed again. Returns `None` if there is nothing to do.
+    """
+    table = models.UserDeletion.__table__
+    now = datetime.utcnow()
+    expired = now - timedelta(seconds=lease)
+    candidates = (
+        db.query(models.UserDeletion.user_id, models.UserDeletion.claimed_at)
+        .filter(
+            models.UserDeletion.finished_at.is_(None),
+            or_(
+                models.UserDeletion.claimed_at.is_(None),
+                models.UserDeletion.claimed_at < expired,
+            ),
+        )
+        .order_by(models.UserDeletion.created_at)
+        .all()
+    )
+    for user_id, claimed_at in candidates:
+        # only one worker can update the row from its previous claim
+        claim = table.update().where(table.c.user_id == user_id).values(
+            claimed_at=now
+        )
+        if claimed_at is None:
+            claim = claim.where(table.c.claimed_at.is_(None))
+        else:
+            claim = claim.where(table.c.claimed_at == claimed_at)
+        claimed = db.execute(claim).rowcount == 1
+        db.commit()
+        if claimed:
+            return db.query(models.UserDeletion).get(user_id)
+    return None
+
+
+def remove_pending_user_actions(
+        db: Session, deletion: models.UserDeletion, batch_size: int = 10000,
+) -> int:
+    """
+    Remove a batch of actions (at most `batch_size`) of an user whose removal
+    is pending (see :func:`remove_user`), in its own transaction, updating
+    the progress of the removal. Once there are no actions left, the user
+    itself is removed and the removal is finished. Returns the number of
+    removed actions.
+    """
+    action = models.Action
+    # the ids of the batch: the first ones left (the previous batches have
+    # been removed), so no rows are skipped to find them
+    batch_ids = [
+        action_id for action_id, in (
+            db.query(action.id)
+            .filter(action.owner_id == deletion.user_id)
+            .order_by(action.id)
+            .limit(batch_size)
+        )
+    ]
+    removed = 0
+    if batch_ids:
+        removed = _remove_actions(
+            db,
+            action.owner_id == deletion.user_id,
+            action.id <= batch_ids[-1],
+        )
+    now = datetime.utcnow()
+    deletion.removed += removed
+    deletion.claimed_at = now
+    if len(batch_ids) < batch_size:
+        # it was the last batch
+        db.query(models.User).filter(
+            models.User.id == deletion.user_id
+        ).delete(synchronize_session=False)
+        deletion.finished_at = now
+        log.info(f"Removed user's actions: {deletion.username}")
+    db.commit()
+    if removed:
+        get_histogram_cache().invalidate()
+    return removed
+
+
+def _query_actions(db: Session, rows: bool = False):
+    """
+    A private function that returns a query of actions, as tuples of `id`,
+    `title`, `timestamp` and `owner_id` if `rows` is set.
+    """
+    action = models.Action
+    if rows:
+        return db.query(
+            action.id, action.title, action.timestamp, action.owner_id,
+        )
+    return db.query(action)
+
+
+def _get_user_all_actions(db: Session, user_id: int, rows: bool = False):
+    """
+    A private function that return all actions performed by an user (as
+    tuples of `id`, `title`, `timestamp` and `owner_id`, if `rows` is set).
+    """
+    return _query_actions(db, rows).filter(models.Action.owner_id == user_id)
 
 
 def get_user_actions(
-    db: Session, user_id: int, sort: str = "desc", limit: int = 100
+    db: Session,
+    user_id: int,
+    sort: str = "desc",
+    limit: int = 100,
+    after: Optional[Tuple[datetime, int]] = None,
+    rows: bool = False,
 ) -> list:
     """
     A function that returns user actions sorted depending on the supplied kwarg
     `sort`. You also can limit the results shown via the kwarg `limit`. I you
-    set `limit=0`, it will show all the results.
+    set `limit=0`, it will show all the results. To paginate the results, set
+    `after` with the timestamp and the id of the last action of the previous
+    page, so we get the next actions via an index range scan (instead of
+    skipping the previous ones with an offset). If `rows` is set, the actions
+    are returned as tuples of `id`, `title`, `timestamp` and `owner_id`
+    (cheaper than loading the models).
     """
-    query = _get_user_all_actions(db, user_id)
+    query = _get_user_all_actions(db, user_id, rows=rows)
     log.debug(f"Selected order for user actions is: {sort}")
-    not_limited = limit == 0
+    timestamp, action_id = models.Action.timestamp, models.Action.id
     sort_desc = sort == "desc"
-    if not_limited:
+    if after is not None:
+        after_timestamp, after_id = after
         if sort_desc:
-            return query.order_by(models.Action.timestamp.desc()).all()
-        return query.order_by(models.Action.timestamp.asc()).all()
-
+            query = query.filter(or_(
+                timestamp < after_timestamp,
+                and_(timestamp == after_timestamp, action_id < after_id),
+            ))
+        else:
+            query = query.filter(or_(
+                timestamp > after_timestamp,
+                and_(timestamp == after_timestamp, action_id > after_id),
+            ))
     if sort_desc:
-        return (
-            query.order_by(models.Action.timestamp.desc()).limit(limit).all()
+        query = query.order_by(timestamp.desc(), action_id.desc())
+    else:
+        query = query.order_by(timestamp.asc(), action_id.asc())
+    if limit != 0:
+        query = query.limit(limit)
+    return query.all()
+
+
+def iter_user_actions(
+    db: Session, user_id: int, sort: str = "asc", chunk_size: int = 1000,
+) -> Iterator[tuple]:
+    """
+    A function that iterates over all the user actions, as tuples of `id`,
+    `title`, `timestamp` and `owner_id`, without loading all of them at once:
+    the rows are fetched from the database in chunks of `chunk_size` (via a
+    server-side cursor, if the database supports it).
+    """
+    action = models.Action
+    if sort == "desc":
+        order = (action.timestamp.desc(), action.id.desc())
+    else:
+        order = (action.timestamp.asc(), action.id.asc())
+    query = (
+        _get_user_all_actions(db, user_id, rows=True)
+        .order_by(*order)
+        .execution_options(stream_results=True)
+        .yield_per(chunk_size)
+    )
+    # the query will be executed once we start iterating
+    yield from query
+
+
+def get_latest_user_actions(
+        db: Session, user_id: int, rows: bool = False,
+) -> list:
+    """
+    A function that returns the latest user action of each kind, sorted from
+    the newest to the oldest. The latest actions are read from the
+    `last_actions` table, which is updated every time that we register an
+    action, so the cost doesn't depend on the number of user actions. If
+    `rows` is set, the actions are returned as tuples (see `get_user_actions`).
+    """
+    return (
+        _query_actions(db, rows)
+        .join(
+            models.LastAction,
+            models.LastAction.action_id == models.Action.id,
         )
-    return query.order_by(models.Action.timestamp.asc()).limit(limit).all()
+        .filter(models.LastAction.owner_id == user_id)
+        .order_by(models.Action.timestamp.desc(), models.Action.id.desc())
+        .all()
+    )
 
 
-def get_latest_user_actions(db: Session, user_id: int) -> list:
+def get_all_actions(db: Session, after_id: int = 0, limit: int = 0):
     """
-    A function that queries all the user actions but keeps only the latest of
-    each kind.
+    A function that return all actions from all users. To paginate the
+    results, set `limit` and the id of the last action received (`after_id`).
     """
-    added_actions = set()
-    last_actions = []
-    query = get_user_actions(db, user_id, sort="desc", limit=0)
-    for row in query:
-        if row.title in added_actions:
-            continue
-        added_actions.add(row.title)
-        last_actions.append(row)
-    return last_actions
+    query = (
+        db.query(models.Action)
+        .filter(models.Action.id > after_id)
+        .order_by(models.Action.id)
+    )
+    if limit != 0:
+        query = query.limit(limit)
+    return query.all()
 
 
-def get_all_actions(db: Session, skip: int = 0):
-    """A function that return all actions from all users."""
-    return db.query(models.Action).offset(skip).all()
+def get_period_start(
+        period_time: Literal["hour", "day", "month"] = "day",
+) -> datetime:
+    """Return the datetime where a period of time, ending now, starts."""
+    current_time = datetime.utcnow()
+    if period_time == "hour":
+        return current_time - timedelta(hours=1)
+    elif period_time == "day":
+        return current_time - timedelta(days=1)
+    return current_time - timedelta(days=31)
 
 
 def get_all_actions_in_a_period(
         db: Session, period_time: Literal["hour", "day", "month"] = "day",
 ) -> list:
     """Return all actions in a period of time since the current datetime."""
-    current_time = datetime.utcnow()
-    if period_time == "hour":
-        time_ago = current_time - timedelta(hours=1)
-    elif period_time == "day":
-        time_ago = current_time - timedelta(days=1)
-    else:
-        time_ago = current_time - timedelta(days=31)
-
+    time_ago = get_period_start(period_time)
     query = db.query(models.Action).filter(
         models.Action.timestamp > time_ago
     )
@@ -135,52 +450,432 @@ def get_all_actions_in_a_period(
 
 
 def get_users_periods_histogram(
-        db: Session, period_time: Literal["hour", "day", "month", ""] = "",
+        db: Session,
+        period_time: Literal["hour", "day", "month", ""] = "",
+        include_timestamps: bool = True,
 ) -> dict:
     """
-    Return all types of registered actions with the datetime for each
-    registered action. The result will be in a dict format, where the keys are
-    the actions and the values are lists containing datetime objects.
+    Return all types of registered actions with the number of actions
+    (`size`) and the first and the last timestamps (`min`/`max`) of each one.
+    If `include_timestamps` is set, we also include the timestamps of all the
+    registered actions (`timestamps`), sorted in ascending order. The result
+    will be in a dict format, where the keys are the actions and the values
+    are dicts containing the described data.
     """
-    if period_time == "":
-        all_actions = get_all_actions(db)
-    else:
-        all_actions = get_all_actions_in_a_period(
-            db, period_time=period_time,
+    timestamp = models.Action.timestamp
+    if not include_timestamps:
+        # let the database do the aggregation, so we only receive one row
+        # for each type of action
+        query = db.query(
+            models.Action.title,
+            func.count(models.Action.id),
+            func.min(timestamp),
+            func.max(timestamp),
         )
+        if period_time != "":
+            query = query.filter(timestamp > get_period_start(period_time))
+        query = query.group_by(models.Action.title)
+        return {
+            title: {
+                "size": size,
+                "min": utils.format_timestamp(min_ts),
+                "max": utils.format_timestamp(max_ts),
+            }
+            for title, size, min_ts, max_ts in query
+        }
+
+    # stream the timestamps sorted, so we don't need to load all the rows at
+    # once, and we get the `min`/`max` values from the first/last ones
+    query = db.query(models.Action.title, timestamp)
+    if period_time != "":
+        query = query.filter(timestamp > get_period_start(period_time))
     histogram = {}
-    for row in all_actions:
-        title = row.title
-        dt = row.timestamp
-        if row.title in histogram:
-            histogram[title]["timestamps"].append(dt)
-            histogram[title]["size"] += 1
+    for title, dt in query.order_by(timestamp).yield_per(10000):
+        dt = utils.format_timestamp(dt)
+        if title in histogram:
+            data = histogram[title]
+            data["timestamps"].append(dt)
+            data["size"] += 1
+            data["max"] = dt
             continue
         histogram[title] = {
-            "timestamps": [dt],
-            "size": 1,
+            "timestamps": [dt], "size": 1, "min": dt, "max": dt,
         }
-
-    # now set the min and max values, which will be
-    # the first and the last item of the timestamps list since the timestamps
-    # are registered in a linear sequence of time, so no need to check the
-    # values.
-    for key, data in histogram.items():
-        histogram[key]["min"] = data["timestamps"][0]
-        histogram[key]["max"] = data["timestamps"][-1]
     return histogram
 
 
 def get_users_types_histogram(db: Session) -> dict:
     """
     Return all types of registered actions as well as the number of times that
-    the action was used in a dict format.
+    the action was used in a dict format. The counts are read from the
+    `action_counts` table, which is updated every time that we register an
+    action, so we don't need to scan the `actions` table.
+    """
+    query = db.query(models.ActionCount.title, models.ActionCount.count)
+    return dict(query.all())
+
+
+def _upsert(db: Session, table, key: dict, values: dict, update: dict):
+    """
+    A private function that inserts a row into `table` (with the columns set
+    in `key` and `values`) or, if there is a row matching `key`, updates it
+    with the expressions in `update`.
+    """
+    if db.bind.dialect.name == "postgresql":
+        statement = postgresql.insert(table).values(**key, **values)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=list(key), set_=update,
+        ))
+        return
+    conditions = [table.c[column] == value for column, value in key.items()]
+    updated = db.execute(
+        table.update().where(and_(*conditions)).values(**update)
+    )
+    if updated.rowcount == 0:
+        db.execute(table.insert().values(**key, **values))
+
+
+def _update_action_counts(db: Session, counts: Dict[str, int]):
+    """
+    A private function that adds the supplied counts (which may be negative)
+    to the `action_counts` table. The changes are not committed, so they will
+    be committed alongside the actions.
+    """
+    table = models.ActionCount.__table__
+    for title, count in counts.items():
+        if title is None or count == 0:
+            continue
+        _upsert(
+            db,
+            table,
+            key={"title": title},
+            values={"count": count},
+            update={"count": table.c.count + count},
+        )
+    # only a removal can leave a count at zero
+    if any(count < 0 for count in counts.values()):
+        db.execute(table.delete().where(table.c.count <= 0))
+
+
+def _aggregate_rollups(actions: Iterable[Tuple[str, str]]) -> dict:
+    """
+    A private function that groups the supplied actions, pairs of title and
+    timestamp, into buckets of time. Returns a dict where the keys are tuples
+    of granularity, bucket and title and the values are lists containing the
+    count, the min timestamp and the max timestamp of the bucket.
+    """
+    rollups = {}
+    for title, timestamp in actions:
+        if title is None:
+            continue
+        for granularity in utils.BUCKET_FIELDS:
+            bucket = utils.get_bucket(timestamp, granularity)
+            key = (granularity, bucket, title)
+            if key not in rollups:
+                rollups[key] = [1, timestamp, timestamp]
+                continue
+            data = rollups[key]
+            data[0] += 1
+            data[1] = min(data[1], timestamp)
+            data[2] = max(data[2], timestamp)
+    return rollups
+
+
+def _update_action_rollups(db: Session, actions: Iterable[Tuple[str, str]]):
     """
-    actions_data = get_users_periods_histogram(db, period_time="")
-    counted_actions = {}
-    for k, v in actions_data.items():
-        counted_actions[k] = v["size"]
-    return counted_actions
+    A private function that adds the supplied actions, pairs of title and
+    timestamp, to the `action_rollups` table. The changes are not committed,
+    so they will be committed alongside the actions.
+    """
+    table = models.ActionRollup.__table__
+    for key, (count, min_ts, max_ts) in _aggregate_rollups(actions).items():
+        granularity, bucket, title = key
+        _upsert(
+            db,
+            table,
+            key={"granularity": granularity, "bucket": bucket, "title": title},
+            values={
+                "count": count,
+                "min_timestamp": min_ts,
+                "max_timestamp": max_ts,
+            },
+            update={
+                "count": table.c.count + count,
+                "min_timestamp": case(
+                    [(table.c.min_timestamp > min_ts, min_ts)],
+                    else_=table.c.min_timestamp,
+                ),
+                "max_timestamp": case(
+                    [(table.c.max_timestamp < max_ts, max_ts)],
+                    else_=table.c.max_timestamp,
+                ),
+            },
+        )
+
+
+def _remove_action_rollups(db: Session, actions: Iterable[Tuple[str, str]]):
+    """
+    A private function that subtracts the supplied actions, pairs of title and
+    timestamp, from the `action_rollups` table. The buckets left empty are
+    removed, for the others, the min/max timestamps are kept (so they are
+    still valid bounds of the remaining actions).
+    """
+    table = models.ActionRollup.__table__
+    for key, (count, _, _) in _aggregate_rollups(actions).items():
+        granularity, bucket, title = key
+        db.execute(
+            table.update()
+            .where(table.c.granularity == granularity)
+            .where(table.c.bucket == bucket)
+            .where(table.c.title == title)
+            .values(count=table.c.count - count)
+        )
+    db.execute(table.delete().where(table.c.count <= 0))
+
+
+def _update_last_actions(db: Session, actions: Iterable[dict]):
+    """
+    A private function that updates the `last_actions` table with the supplied
+    actions (dicts with the keys `id`, `title`, `owner_id` and `timestamp`).
+    The changes are not committed, so they will be committed alongside the
+    actions.
+    """
+    latest = {}
+    for action in actions:
+        key = (action["owner_id"], action["title"])
+        if key not in latest or (
+            (action["timestamp"], action["id"])
+            > (latest[key]["timestamp"], latest[key]["id"])
+        ):
+            latest[key] = action
+
+    table = models.LastAction.__table__
+    for (owner_id, title), action in latest.items():
+        if title is None:
+            continue
+        # only replace the stored action if the new one is more recent
+        is_newer = or_(
+            table.c.timestamp < action["timestamp"],
+            and_(
+                table.c.timestamp == action["timestamp"],
+                table.c.action_id < action["id"],
+            ),
+        )
+        _upsert(
+            db,
+            table,
+            key={"owner_id": owner_id, "title": title},
+            values={
+                "action_id": action["id"], "timestamp": action["timestamp"],
+            },
+            update={
+                "action_id": case(
+                    [(is_newer, action["id"])], else_=table.c.action_id,
+                ),
+                "timestamp": case(
+                    [(is_newer, action["timestamp"])], else_=table.c.timestamp,
+                ),
+            },
+        )
+
+
+def get_users_periods_histogram_buckets(
+        db: Session,
+        granularity: Literal["minute", "hour", "day"] = "hour",
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+) -> dict:
+    """
+    Return all types of registered actions between `start` and `end`, with the
+    number of actions registered in each bucket of time (per `minute`, `hour`
+    or `day`). The result will be in a dict format, where the keys are the
+    actions and the values are dicts containing the total number of actions
+    (`size`), the first and the last timestamps (`min`/`max`) and the count
+    per bucket (`buckets`). The range is aligned to the buckets boundaries,
+    so any bucket which contains `start` or `end` is fully included.
+    """
+    table = models.ActionRollup
+    query = db.query(
+        table.title,
+        table.bucket,
+        table.count,
+        table.min_timestamp,
+        table.max_timestamp,
+    ).filter(table.granularity == granularity)
+    if start is not None:
+        query = query.filter(
+            table.bucket >= utils.get_bucket(start, granularity)
+        )
+    if end is not None:
+        query = query.filter(table.bucket <= end)
+
+    histogram = {}
+    for title, bucket, count, min_ts, max_ts in query.order_by(table.bucket):
+        if title not in histogram:
+            histogram[title] = {
+                "buckets": {}, "size": 0, "min": min_ts, "max": max_ts,
+            }
+        data = histogram[title]
+        data["buckets"][utils.format_timestamp(bucket)] = count
+        data["size"] += count
+        data["min"] = min(data["min"], min_ts)
+        data["max"] = max(data["max"], max_ts)
+    for data in histogram.values():
+        data["min"] = utils.format_timestamp(data["min"])
+        data["max"] = utils.format_timestamp(data["max"])
+    return histogram
+
+
+def rebuild_action_counts(db: Session) -> dict:
+    """
+    Recompute the `action_counts` table from the `actions` table. Returns
+    the new counts in a dict format.
+    """
+    counts = dict(
+        db.query(models.Action.title, func.count(models.Action.id))
+        .filter(models.Action.title.isnot(None))
+        .group_by(models.Action.title)
+        .all()
+    )
+    db.query(models.ActionCount).delete()
+    db.bulk_insert_mappings(
+        models.ActionCount,
+        [{"title": title, "count": count} for title, count in counts.items()],
+    )
+    db.commit()
+    get_histogram_cache().invalidate()
+    log.info(f"Rebuilt action counts for {len(counts)} types of actions")
+    return counts
+
+
+def rebuild_action_rollups(db: Session) -> int:
+    """
+    Recompute the `action_rollups` table from the `actions` table. Returns
+    the number of buckets.
+    """
+    rollups = _aggregate_rollups(
+        db.query(models.Action.title, models.Action.timestamp).yield_per(10000)
+    )
+    db.query(models.ActionRollup).delete()
+    db.bulk_insert_mappings(
+        models.ActionRollup,
+        [
+            {
+                "granularity": granularity,
+                "bucket": bucket,
+                "title": title,
+                "count": count,
+                "min_timestamp": min_ts,
+                "max_timestamp": max_ts,
+            }
+            for (granularity, bucket, title), (count, min_ts, max_ts)
+            in rollups.items()
+        ],
+    )
+    db.commit()
+    get_histogram_cache().invalidate()
+    log.info(f"Rebuilt action rollups: {len(rollups)} buckets")
+    return len(rollups)
+
+
+def archive_actions(
+        db: Session,
+        start: datetime,
+        end: datetime,
+        write: Callable[[List[tuple]], None] = None,
+        batch_size: int = 10000,
+) -> int:
+    """
+    Remove the actions registered between `start` (included) and `end` from
+    the database, in batches (each one in its own transaction). Each batch of
+    rows (`id`, `title`, `timestamp` and `owner_id`) is passed to `write`
+    before removing it, so it can be archived. The histogram aggregates are
+    updated, and the latest action of each kind is kept (see `last_actions`).
+    Returns the number of removed actions.
+    """
+    action = models.Action
+    latest_actions = select([models.LastAction.action_id])
+    removed = 0
+    last_id = 0
+    while True:
+        rows = (
+            db.query(
+                action.id, action.title, action.timestamp, action.owner_id,
+            )
+            .filter(
+                action.timestamp >= start,
+                action.timestamp < end,
+                action.id > last_id,
+                ~action.id.in_(latest_actions),
+            )
+            .order_by(action.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        if write is not None:
+            write(rows)
+        counts = Counter(row.title for row in rows)
+        _update_action_counts(
+            db, {title: -count for title, count in counts.items()},
+        )
+        _remove_action_rollups(
+            db, [(row.title, row.timestamp) for row in rows],
+        )
+        db.query(action).filter(
+            action.id.in_([row.id for row in rows])
+        ).delete(synchronize_session=False)
+        db.commit()
+        removed += len(rows)
+        last_id = rows[-1].id
+    if removed:
+        get_histogram_cache().invalidate()
+    return removed
+
+
+def register_action_archive(
+        db: Session, month: str, rows: int, path: Optional[str],
+) -> models.ActionArchive:
+    """Register (or update) a month of actions removed from the database."""
+    archive = db.query(models.ActionArchive).get(month)
+    if archive is None:
+        archive = models.ActionArchive(month=month, rows=0)
+        db.add(archive)
+    archive.rows += rows
+    archive.path = path
+    archive.archived_at = datetime.utcnow()
+    db.commit()
+    return archive
+
+
+def rebuild_last_actions(db: Session) -> int:
+    """
+    Recompute the `last_actions` table from the `actions` table. Returns the
+    number of rows of the `last_actions` table.
+    """
+    action = models.Action
+    query = (
+        db.query(action.id, action.title, action.owner_id, action.timestamp)
+        .filter(action.title.isnot(None))
+        .order_by(action.timestamp, action.id)
+        .yield_per(10000)
+    )
+    # since the actions are sorted, the last one of each kind is the latest
+    latest = {
+        (owner_id, title): {
+            "owner_id": owner_id,
+            "title": title,
+            "action_id": action_id,
+            "timestamp": timestamp,
+        }
+        for action_id, title, owner_id, timestamp in query
+    }
+    db.query(models.LastAction).delete()
+    db.bulk_insert_mappings(models.LastAction, list(latest.values()))
+    db.commit()
+    log.info(f"Rebuilt last actions: {len(latest)} rows")
+    return len(latest)
 
 
 def create_user_action(
@@ -192,6 +887,50 @@ def create_user_action(
         **action.dict(), owner_id=user_id, timestamp=timestamp
     )
     db.add(db_action)
+    # we need the id of the action to register it as the latest one
+    db.flush()
+    _update_action_counts(db, {db_action.title: 1})
+    _update_action_rollups(db, [(db_action.title, timestamp)])
+    _update_last_actions(db, [{
+        "id": db_action.id,
+        "title": db_action.title,
+        "owner_id": user_id,
+        "timestamp": timestamp,
+    }])
     db.commit()
     db.refresh(db_action)
     return db_action
+
+
+def create_user_actions(db: Session, actions: List[dict]):
+    """
+    Register into database several user actions at once. Each action should
+    be a dict with the keys: `title`, `owner_id` and `timestamp`.
+    """
+    # the actions are inserted at once (fetching their ids would insert them
+    # one by one), the ids needed to register the latest actions are looked
+    # up afterwards, within the ids allocated since then
+    last_id = db.query(func.max(models.Action.id)).scalar() or 0
+    db.bulk_insert_mappings(models.Action, actions)
+    _update_action_counts(
+        db, Counter(action["title"] for action in actions),
+    )
+    _update_action_rollups(
+        db, [(action["title"], action["timestamp"]) for action in actions],
+    )
+    owner_ids = {action["owner_id"] for action in actions}
+    new_actions = (
+        _query_actions(db, rows=True)
+        .filter(models.Action.id > last_id)
+        .filter(models.Action.owner_id.in_(owner_ids))
+    )
+    _update_last_actions(db, [
+        {
+            "id": action_id,
+            "title": title,
+            "timestamp": timestamp,
+            "owner_id": owner_id,
+        }
+        for action_id, title, timestamp, owner_id in new_actions
+    ])
+    db.commit()
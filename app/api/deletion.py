@@ -0,0 +1,130 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from app.api import crud
+from app.api.config import get_api_settings
+from app.database import SessionLocal
+
+log = logging.getLogger("api")
+
+
+class UserDeletionWorker:
+    """
+    Remove, in background, the actions of the removed users with too many
+    actions to remove them at once (see :func:`app.api.crud.remove_user`).
+
+    The pending removals are stored into the database, so they are resumed
+    after a restart, and each one is claimed by a single worker (of any
+    process). Every `poll_interval` seconds (or when woken up after an user
+    is removed), the worker removes the pending actions in batches of
+    `batch_size` actions, each one in its own transaction, so the database
+    is never locked for long.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = 5000,
+        poll_interval: float = 5.0,
+        lease: float = 60.0,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._users = 0
+        self._removed = 0
+
+    def start(self) -> None:
+        """Start the background thread (unless `poll_interval` is `0`)."""
+        with self._start_lock:
+            if self.poll_interval <= 0 or self._thread is not None:
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="user-deletion", daemon=True,
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread, the removal in progress is resumed later.
+        """
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stop_event.set()
+                self._wakeup.set()
+                thread.join()
+
+    def wake(self) -> None:
+        """Look for pending removals right away."""
+        self.start()
+        self._wakeup.set()
+
+    def run_pending(self) -> int:
+        """
+        Perform all the pending removals (which are not claimed by other
+        worker). Returns the number of removed actions.
+        """
+        removed = 0
+        db = self.session_factory()
+        try:
+            while not self._stop_event.is_set():
+                deletion = crud.claim_user_deletion(db, lease=self.lease)
+                if deletion is None:
+                    break
+                while (
+                    deletion.finished_at is None
+                    and not self._stop_event.is_set()
+                ):
+                    batch = crud.remove_pending_user_actions(
+                        db, deletion, batch_size=self.batch_size,
+                    )
+                    removed += batch
+                    self._removed += batch
+                if deletion.finished_at is not None:
+                    self._users += 1
+        finally:
+            db.close()
+        return removed
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.run_pending()
+            except Exception:
+                log.exception("Failed to remove the actions of an user")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def stats(self) -> dict:
+        """Return the worker metrics."""
+        return {
+            "running": self._thread is not None,
+            "users": self._users,
+            "removed": self._removed,
+        }
+
+
+_deletion_worker: Optional[UserDeletionWorker] = None
+
+
+def get_deletion_worker() -> UserDeletionWorker:
+    """Return the user deletion worker, configured via `APISettings`."""
+    global _deletion_worker
+    if _deletion_worker is None:
+        api_settings = get_api_settings()
+        _deletion_worker = UserDeletionWorker(
+            SessionLocal,
+            batch_size=api_settings.user_delete_batch_size,
+            poll_interval=api_settings.user_delete_poll_interval,
+        )
+    return _deletion_worker
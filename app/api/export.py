@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+from itertools import islice
+from typing import AsyncGenerator, Iterator, List
+
+from app.api.concurrency import run_blocking
+from app.api.utils import format_timestamp
+
+EXPORT_FIELDS = ("id", "title", "timestamp", "owner_id")
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def serialize_ndjson(rows: List[tuple]) -> str:
+    """Serialize rows of actions as JSON lines."""
+    lines = []
+    for action_id, title, timestamp, owner_id in rows:
+        lines.append(json.dumps({
+            "id": action_id,
+            "title": title,
+            "timestamp": format_timestamp(timestamp),
+            "owner_id": owner_id,
+        }))
+        lines.append("\n")
+    return "".join(lines)
+
+
+def serialize_csv(rows: List[tuple]) -> str:
+    """Serialize rows of actions as CSV lines (without header)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows(
+        (action_id, title, format_timestamp(timestamp), owner_id)
+        for action_id, title, timestamp, owner_id in rows
+    )
+    return buffer.getvalue()
+
+
+def _next_chunk(rows: Iterator[tuple], chunk_size: int) -> List[tuple]:
+    return list(islice(rows, chunk_size))
+
+
+async def stream_actions(
+        rows: Iterator[tuple], export_format: str, chunk_size: int = 1000,
+) -> AsyncGenerator[str, None]:
+    """
+    Serialize the supplied actions (tuples of `id`, `title`, `timestamp` and
+    `owner_id`) in `ndjson` or `csv` format, chunk by chunk, so we only keep
+    one chunk of actions in memory. The rows are fetched from the database in
+    our thread pool, so we don't block the event loop.
+    """
+    if export_format == "csv":
+        serialize = serialize_csv
+        yield ",".join(EXPORT_FIELDS) + "\n"
+    else:
+        serialize = serialize_ndjson
+    while True:
+        chunk = await run_blocking(_next_chunk, rows, chunk_size)
+        if not chunk:
+            break
+        yield serialize(chunk)
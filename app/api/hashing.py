@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from app.api import security
+from app.api.concurrency import run_blocking
+from app.api.metrics import BCRYPT_DURATION
+from app.api.timing import phase
+from app.api.config import get_api_settings
+
+log = logging.getLogger("api")
+
+HASHING_POOL_BUSY_MSG = (
+    "The server is busy processing other credentials, please, retry later."
+)
+
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing pool can't accept more work."""
+
+
+class HashingPool:
+    """
+    Run the password hashing/verification (bcrypt) in a dedicated pool of
+    processes, so the CPU cost of it doesn't starve the request workers.
+
+    The number of pending operations is bounded by `max_pending`, once reached
+    any new operation is rejected immediately by raising `HashingPoolBusy`,
+    instead of queueing it for an unbounded time. If `workers` is `0`, the
+    operations run in the calling thread (the admission control still applies).
+
+    The `*_async` methods are meant for the event loop: the admission happens
+    there (before using any thread), and the result of the processes is
+    awaited without holding a thread while the password is hashed.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._peak_pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._duration = BCRYPT_DURATION.labels()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                log.debug(f"Starting hashing pool with {self.workers} workers")
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # don't fork a process which is running threads
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _admit(self) -> float:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise HashingPoolBusy(HASHING_POOL_BUSY_MSG)
+            self._pending += 1
+            self._peak_pending = max(self._peak_pending, self._pending)
+        return time.perf_counter()
+
+    def _finish(self, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed)
+        self._duration.observe(elapsed)
+
+    def _run(self, func: Callable, *args):
+        start = self._admit()
+        try:
+            if self.workers == 0:
+                return func(*args)
+            return self._get_executor().submit(func, *args).result()
+        finally:
+            self._finish(start)
+
+    async def _run_async(self, func: Callable, *args):
+        start = self._admit()
+        try:
+            if self.workers == 0:
+                return await run_blocking(func, *args)
+            future = self._get_executor().submit(func, *args)
+            return await asyncio.wrap_future(future)
+        finally:
+            self._finish(start)
+
+    def hash(self, password: str) -> str:
+        """Given a password, returns a hashed password."""
+        return self._run(security.get_password_hash, password)
+
+    def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """Verify that a password matches a hashed password."""
+        return self._run(
+            security.verify_password, plain_password, hashed_password,
+        )
+
+    async def hash_async(self, password: str) -> str:
+        """Given a password, returns a hashed password (see `hash`)."""
+        return await self._run_async(security.get_password_hash, password)
+
+    async def verify_async(
+            self, plain_password: str, hashed_password: str,
+    ) -> bool:
+        """Verify that a password matches a hashed password (see `verify`)."""
+        return await self._run_async(
+            security.verify_password, plain_password, hashed_password,
+        )
+
+    def stats(self) -> dict:
+        """Return the pool metrics, to be able to size it properly."""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "peak_pending": self._peak_pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "latency_avg": (
+                    self._latency_total / self._completed
+                    if self._completed else 0.0
+                ),
+                "latency_max": self._latency_max,
+            }
+
+    def shutdown(self) -> None:
+        """Stop the worker processes (they will be restarted if needed)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_hashing_pool: Optional[HashingPool] = None
+
+
+def get_hashing_pool() -> HashingPool:
+    """Return the hashing pool, configured via `APISettings`."""
+    global _hashing_pool
+    if _hashing_pool is None:
+        api_settings = get_api_settings()
+        _hashing_pool = HashingPool(
+            workers=api_settings.hashing_workers,
+            max_pending=api_settings.hashing_max_pending,
+        )
+    return _hashing_pool
+
+
+def get_password_hash(password: str) -> str:
+    """Hash a password using the hashing pool."""
+    with phase("bcrypt"):
+        return get_hashing_pool().hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against a hashed password using the hashing pool."""
+    with phase("bcrypt"):
+        return get_hashing_pool().verify(plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a password using the hashing pool, from the event loop."""
+    with phase("bcrypt"):
+        return await get_hashing_pool().hash_async(password)
+
+
+async def verify_password_async(
+        plain_password: str, hashed_password: str,
+) -> bool:
+    """
+    Verify a password against a hashed password using the hashing pool, from
+    the event loop.
+    """
+    with phase("bcrypt"):
+        return await get_hashing_pool().verify_async(
+            plain_password, hashed_password,
+        )
@@ -0,0 +1,533 @@
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.api.config import get_api_settings
+from app.api.timing import get_route_name
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class MemoryStorage:
+    """The values of the metrics of this process, kept in memory."""
+
+    def __init__(self):
+        self._keys: List[str] = []
+        self._values: List[float] = []
+
+    def allocate(self, key: str) -> int:
+        """Add a value (`0`), returning its position."""
+        self._keys.append(key)
+        self._values.append(0.0)
+        return len(self._values) - 1
+
+    def add(self, position: int, amount: float) -> None:
+        self._values[position] += amount
+
+    def set(self, position: int, value: float) -> None:
+        self._values[position] = value
+
+    def read(self) -> Iterator[Tuple[str, float]]:
+        """Return the keys and values of the metrics."""
+        return zip(list(self._keys), list(self._values))
+
+    def close(self) -> None:
+        pass
+
+
+class FileStorage:
+    """
+    The values of the metrics of this process, kept in a file (within
+    `directory`) mapped in memory, so updating a value is just a memory
+    write. The metrics of all the processes are aggregated by reading all the
+    files of `directory`.
+
+    The file starts with the number of used bytes, followed by the entries:
+    the length of the key, the key (padded to 8 bytes) and the value.
+    """
+
+    initial_size = 64 * 1024
+
+    def __init__(self, directory: str, process_id: Optional[int] = None):
+        self.directory = directory
+        process_id = os.getpid() if process_id is None else process_id
+        self.path = os.path.join(directory, f"metrics_{process_id}.db")
+        self._file = open(self.path, "a+b")
+        if os.path.getsize(self.path) < self.initial_size:
+            self._file.truncate(self.initial_size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._used = struct.unpack_from("i", self._map, 0)[0] or 8
+
+    def allocate(self, key: str) -> int:
+        encoded = key.encode()
+        padded = encoded + b" " * (8 - (len(encoded) + 4) % 8)
+        entry = struct.pack(f"i{len(padded)}sd", len(padded), padded, 0.0)
+        while self._used + len(entry) > len(self._map):
+            # the previous map is not closed, other threads may be using it
+            self._file.truncate(len(self._map) * 2)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        self._map[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        struct.pack_into("i", self._map, 0, self._used)
+        return self._used - 8
+
+    def add(self, position: int, amount: float) -> None:
+        value = struct.unpack_from("d", self._map, position)[0]
+        struct.pack_into("d", self._map, position, value + amount)
+
+    def set(self, position: int, value: float) -> None:
+        struct.pack_into("d", self._map, position, value)
+
+    def read(self) -> Iterator[Tuple[str, float]]:
+        """Return the keys and values of the metrics of every process."""
+        for path in glob.glob(os.path.join(self.directory, "metrics_*.db")):
+            with open(path, "rb") as f:
+                data = f.read()
+            used = struct.unpack_from("i", data, 0)[0]
+            position = 8
+            while position < used:
+                length = struct.unpack_from("i", data, position)[0]
+                position += 4
+                key = data[position:position + length].decode().rstrip()
+                position += length
+                yield key, struct.unpack_from("d", data, position)[0]
+                position += 8
+
+    def close(self) -> None:
+        self._map.flush()
+
+
+class Value:
+    """
+    A value of a metric. The updates of the values changed from several
+    threads are serialized by its own lock (the values changed only from the
+    event loop don't need it).
+    """
+
+    __slots__ = ("registry", "key", "position", "_lock")
+
+    def __init__(self, registry: "Registry", key: str, thread_safe: bool):
+        self.registry = registry
+        self.key = key
+        self.position = registry.add_value(self)
+        self._lock = threading.Lock() if thread_safe else None
+
+    def add(self, amount: float) -> None:
+        storage = self.registry.storage
+        if self._lock is None:
+            storage.add(self.position, amount)
+            return
+        with self._lock:
+            storage.add(self.position, amount)
+
+    def set(self, value: float) -> None:
+        self.registry.storage.set(self.position, value)
+
+
+class Metric:
+    """
+    The base of our metrics: a family of values, one per combination of
+    the values of its labels (see `labels`).
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        registry: "Registry",
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        thread_safe: bool = True,
+    ):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.thread_safe = thread_safe
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *labelvalues: str):
+        """
+        Return the metric for the supplied values of its labels. The result
+        should be kept by the caller, so it's only looked up once.
+        """
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.get(labelvalues)
+                if child is None:
+                    labels = dict(zip(self.labelnames, labelvalues))
+                    child = self._children[labelvalues] = self._child(labels)
+        return child
+
+    def _key(self, suffix: str, labels: dict) -> str:
+        return json.dumps([self.name, suffix, labels], sort_keys=True)
+
+    def _child(self, labels: dict):
+        raise NotImplementedError
+
+
+class CounterChild:
+    __slots__ = ("_value",)
+
+    def __init__(self, value: Value):
+        self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self._value.add(amount)
+
+
+class Counter(Metric):
+    """A value which only increases (e.g. the number of requests)."""
+
+    type = "counter"
+
+    def _child(self, labels: dict) -> CounterChild:
+        key = self._key("_total", labels)
+        return CounterChild(Value(self.registry, key, self.thread_safe))
+
+
+class GaugeChild:
+    __slots__ = ("_value",)
+
+    def __init__(self, value: Value):
+        self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self._value.add(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._value.add(-amount)
+
+    def set(self, value: float) -> None:
+        self._value.set(value)
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down (e.g. the connections in use). The values
+    of all the processes are added up, and reset when a process stops.
+    """
+
+    type = "gauge"
+
+    def _child(self, labels: dict) -> GaugeChild:
+        value = Value(self.registry, self._key("", labels), self.thread_safe)
+        self.registry.gauges.append(value)
+        return GaugeChild(value)
+
+
+class HistogramChild:
+    __slots__ = ("_bounds", "_buckets", "_sum")
+
+    def __init__(self, bounds: tuple, buckets: List[Value], total: Value):
+        self._bounds = bounds
+        self._buckets = buckets
+        self._sum = total
+
+    def observe(self, amount: float) -> None:
+        # the counts are stored per bucket, they are added up when exposed
+        self._buckets[bisect.bisect_left(self._bounds, amount)].add(1)
+        self._sum.add(amount)
+
+
+class Histogram(Metric):
+    """
+    The distribution of a value (e.g. the latency of the requests), counted
+    in `buckets`.
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def _child(self, labels: dict) -> HistogramChild:
+        buckets = [
+            Value(
+                self.registry,
+                self._key("_bucket", {**labels, "le": format_value(bound)}),
+                self.thread_safe,
+            )
+            for bound in self.buckets + (float("inf"),)
+        ]
+        total = Value(
+            self.registry, self._key("_sum", labels), self.thread_safe,
+        )
+        return HistogramChild(self.buckets, buckets, total)
+
+
+def format_value(value: float) -> str:
+    """Format a value as Prometheus does."""
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return f"{int(value)}.0"
+    return repr(float(value))
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", r"\\").replace('"', r"\"").replace(
+            "\n", r"\n"
+        ))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Registry:
+    """
+    Our metrics, whose values are stored in memory or, if `directory` is
+    set, in a file per process (so the metrics of several workers are
+    aggregated). The storage is created on first use (so a forked worker
+    doesn't share it with its parent).
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        # the `metrics_dir` setting if not supplied
+        self.directory = directory
+        self.metrics: Dict[str, Metric] = {}
+        self.values: List[Value] = []
+        self.gauges: List[Value] = []
+        self._storage = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    @property
+    def storage(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._storage = self._create_storage()
+                    # the values of the parent process are not inherited
+                    for value in self.values:
+                        value.position = self._storage.allocate(value.key)
+                    self._pid = os.getpid()
+        return self._storage
+
+    def _create_storage(self):
+        if self.directory is None:
+            self.directory = get_api_settings().metrics_dir
+        if self.directory:
+            return FileStorage(self.directory)
+        return MemoryStorage()
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def add_value(self, value: Value) -> int:
+        """Add a value of a metric, returning its position in the storage."""
+        with self._lock:
+            storage = self.storage
+            self.values.append(value)
+            return storage.allocate(value.key)
+
+    def collect(self) -> Dict[str, dict]:
+        """
+        Return the values of each metric, added up for all the processes,
+        grouped by metric name and labels.
+        """
+        samples = defaultdict(lambda: defaultdict(float))
+        for key, value in self.storage.read():
+            name, suffix, labels = json.loads(key)
+            labels = tuple(sorted(labels.items()))
+            samples[name][(suffix, labels)] += value
+        return samples
+
+    def expose(self) -> str:
+        """Return the metrics in the Prometheus text format."""
+        samples = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            values = samples.get(name, {})
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            if isinstance(metric, Histogram):
+                lines.extend(self._expose_histogram(name, values))
+                continue
+            for (suffix, labels), value in sorted(values.items()):
+                lines.append(
+                    f"{name}{suffix}{format_labels(dict(labels))} "
+                    f"{format_value(value)}"
+                )
+        lines.extend(self._expose_ratios(samples))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _expose_histogram(name: str, values: dict) -> List[str]:
+        series = defaultdict(dict)
+        for (suffix, labels), value in values.items():
+            labels = dict(labels)
+            le = labels.pop("le", None)
+            series[tuple(sorted(labels.items()))][(suffix, le)] = value
+        lines = []
+        for labels, values in sorted(series.items()):
+            labels = dict(labels)
+            buckets = sorted(
+                (
+                    (float(le.replace("+Inf", "inf")), le, value)
+                    for (suffix, le), value in values.items()
+                    if suffix == "_bucket"
+                ),
+            )
+            count = 0.0
+            for _, le, value in buckets:
+                count += value
+                lines.append(
+                    f"{name}_bucket{format_labels({**labels, 'le': le})} "
+                    f"{format_value(count)}"
+                )
+            lines.append(
+                f"{name}_sum{format_labels(labels)} "
+                f"{format_value(values.get(('_sum', None), 0.0))}"
+            )
+            lines.append(
+                f"{name}_count{format_labels(labels)} {format_value(count)}"
+            )
+        return lines
+
+    @staticmethod
+    def _expose_ratios(samples: dict) -> List[str]:
+        """The hit ratio of each cache namespace, from the cache requests."""
+        requests = defaultdict(dict)
+        for (_, labels), value in samples.get("cache_requests", {}).items():
+            labels = dict(labels)
+            requests[labels["namespace"]][labels["result"]] = value
+        lines = [
+            "# HELP cache_hit_ratio Cache hits / (hits + misses).",
+            "# TYPE cache_hit_ratio gauge",
+        ]
+        for namespace, results in sorted(requests.items()):
+            hits, misses = results.get("hit", 0), results.get("miss", 0)
+            ratio = hits / (hits + misses) if hits + misses else 0.0
+            lines.append(
+                f"cache_hit_ratio{format_labels({'namespace': namespace})} "
+                f"{format_value(ratio)}"
+            )
+        return lines
+
+    def close(self) -> None:
+        """Reset the gauges of this process (it's stopping)."""
+        if self._storage is None:
+            return
+        for value in self.gauges:
+            value.set(0)
+        self._storage.close()
+
+
+registry = Registry()
+
+REQUESTS = Counter(
+    registry,
+    "http_requests",
+    "Number of HTTP requests, per route and class of status code.",
+    ["route", "status"],
+    # only updated from the event loop
+    thread_safe=False,
+)
+REQUEST_DURATION = Histogram(
+    registry,
+    "http_request_duration_seconds",
+    "Time spent processing the HTTP requests (until the response starts).",
+    ["route"],
+    thread_safe=False,
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    registry,
+    "db_pool_checked_out",
+    "Number of database connections in use.",
+)
+DB_POOL_CONNECTIONS = Gauge(
+    registry,
+    "db_pool_connections",
+    "Number of database connections opened by the pools.",
+)
+BCRYPT_DURATION = Histogram(
+    registry,
+    "bcrypt_duration_seconds",
+    "Time spent hashing or verifying a password (including the wait for a "
+    "hashing process).",
+)
+AUDIT_WRITES = Counter(
+    registry,
+    "audit_actions_written",
+    "Number of user actions written, per mode (`durable`, `batched` or "
+    "`fallback`, a batched action written synchronously).",
+    ["mode"],
+)
+CACHE_REQUESTS = Counter(
+    registry,
+    "cache_requests",
+    "Number of cache lookups, per namespace and result (`hit` or `miss`), "
+    "and of failed cache operations (`error`).",
+    ["namespace", "result"],
+)
+
+
+class MetricsMiddleware:
+    """
+    An ASGI middleware which counts the requests and measures its latency,
+    per route. The metrics of each route are looked up once, so recording a
+    request doesn't allocate them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._route_metrics: Dict[str, tuple] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_metrics(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                self.record(scope, status_code, time.perf_counter() - start)
+                status_code = None
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            if status_code is not None:
+                # the request failed before responding
+                self.record(scope, status_code, time.perf_counter() - start)
+
+    def record(self, scope, status_code: int, elapsed: float) -> None:
+        route = get_route_name(scope)
+        metrics = self._route_metrics.get(route)
+        if metrics is None:
+            metrics = self._route_metrics[route] = (
+                [
+                    REQUESTS.labels(route, f"{status_class}xx")
+                    for status_class in range(6)
+                ],
+                REQUEST_DURATION.labels(route),
+            )
+        requests, duration = metrics
+        requests[min(status_code // 100, 5)].inc()
+        duration.observe(elapsed)
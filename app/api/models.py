@@ -1,7 +1,9 @@
 from sqlalchemy import (
     Boolean,
     Column,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
 )
@@ -19,17 +21,117 @@ class User(Base):
     hashed_password = Column(String)
     is_active = Column(Boolean, default=False)
 
+    # the actions are removed via bulk deletes (see `crud.remove_user`), so
+    # they are never loaded just to remove them
     actions = relationship(
-        "Action", cascade="all,delete", back_populates="owner",
+        "Action",
+        cascade="all,delete",
+        passive_deletes=True,
+        back_populates="owner",
     )
 
 
 class Action(Base):
-    """Description for `actions` database table."""
+    """
+    Description for `actions` database table. The `timestamp` is stored in
+    UTC. The composite indexes cover our main queries: the actions of an user
+    sorted by time and the actions of a kind within a period of time.
+    """
     __tablename__ = "actions"
+    __table_args__ = (
+        Index("ix_actions_owner_id_timestamp", "owner_id", "timestamp"),
+        Index("ix_actions_title_timestamp", "title", "timestamp"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, index=True)
-    timestamp = Column(String, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    title = Column(String)
+    timestamp = Column(DateTime, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
 
     owner = relationship("User", back_populates="actions")
+
+
+class ActionCount(Base):
+    """
+    Description for `action_counts` database table, which holds the number of
+    registered actions for each action's title.
+    """
+    __tablename__ = "action_counts"
+    title = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ActionRollup(Base):
+    """
+    Description for `action_rollups` database table, which holds the number of
+    registered actions for each action's title, grouped in buckets of time
+    (per `minute`, `hour` and `day`). The `bucket` column holds the datetime
+    where the bucket starts, and `min_timestamp`/`max_timestamp` the first and
+    the last action registered within the bucket.
+    """
+    __tablename__ = "action_rollups"
+    granularity = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    title = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    min_timestamp = Column(DateTime)
+    max_timestamp = Column(DateTime)
+
+
+class LastAction(Base):
+    """
+    Description for `last_actions` database table, which holds the latest
+    action registered by each user for each action's title.
+    """
+    __tablename__ = "last_actions"
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    title = Column(String, primary_key=True)
+    action_id = Column(Integer, ForeignKey("actions.id"), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+
+class TokenRevocation(Base):
+    """
+    Description for `token_revocations` database table, which holds the
+    revoked access tokens: a single token (given its `jti`) or all the tokens
+    of an user issued before `issued_before`. The rows are only needed until
+    `expires_at`, when the revoked tokens have expired anyway.
+    """
+    __tablename__ = "token_revocations"
+    id = Column(Integer, primary_key=True, index=True)
+    jti = Column(String, nullable=True)
+    username = Column(String, nullable=True)
+    issued_before = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class ActionArchive(Base):
+    """
+    Description for `action_archives` database table, which holds the months
+    of actions removed from the `actions` table by the retention policy, with
+    the number of removed actions and the file where they were archived (if
+    they were not dropped).
+    """
+    __tablename__ = "action_archives"
+    month = Column(String, primary_key=True)
+    rows = Column(Integer, nullable=False, default=0)
+    path = Column(String, nullable=True)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class UserDeletion(Base):
+    """
+    Description for `user_deletions` database table, which holds the removals
+    of the users with too many actions to remove them at once: the account is
+    removed right away, but its actions are removed in background, in batches.
+    `removed` holds the progress (out of `total` actions) and `claimed_at`
+    when a worker last processed the removal (so, if it stops, other worker
+    can take over). The user's row is removed when its last action is.
+    """
+    __tablename__ = "user_deletions"
+    user_id = Column(Integer, primary_key=True)
+    username = Column(String, nullable=False)
+    total = Column(Integer, nullable=False, default=0)
+    removed = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    claimed_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True, index=True)
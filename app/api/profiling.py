@@ -0,0 +1,222 @@
+import os
+import sys
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional
+
+from app.api.config import get_api_settings
+
+# the innermost frames of a thread waiting for work (e.g. the event loop
+# polling its sockets, or an idle worker of a thread pool)
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+class ProfilerBusy(Exception):
+    """Raised when another profile is running."""
+
+
+def get_frame_name(frame) -> str:
+    """Return the name of a frame: its function, file and line."""
+    code = frame.f_code
+    path = _short_path(code.co_filename)
+    return f"{code.co_name} ({path}:{frame.f_lineno})"
+
+
+@lru_cache(maxsize=None)
+def _short_path(path: str) -> str:
+    # relative to the longest entry of `sys.path` containing it
+    prefixes = [p for p in sys.path if p and path.startswith(p + os.sep)]
+    if not prefixes:
+        return path
+    return path[len(max(prefixes, key=len)) + 1:]
+
+
+class StackSampler:
+    """
+    Sample the stacks of every thread of the process (but its own) every
+    `interval` seconds, from a background thread, counting the times each
+    stack is seen (skipping the idle threads, unless `include_idle`). Nothing
+    runs unless the sampler is started.
+    """
+
+    def __init__(self, interval: float = 0.005, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        """Stop sampling, returning the count of each (collapsed) stack."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.stacks
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = self._collapse(frame)
+                if stack is not None:
+                    thread_name = names.get(thread_id, str(thread_id))
+                    self.stacks[f"{thread_name};{stack}"] += 1
+            self.samples += 1
+            if self._stop_event.wait(self.interval):
+                break
+
+    def _collapse(self, frame) -> Optional[str]:
+        code = frame.f_code
+        idle = (os.path.basename(code.co_filename), code.co_name)
+        if not self.include_idle and idle in IDLE_FRAMES:
+            return None
+        frames = []
+        while frame is not None:
+            frames.append(get_frame_name(frame))
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+
+def format_collapsed(stacks: Counter) -> str:
+    """
+    Return the stacks in the collapsed format (a stack per line, its frames
+    separated by `;`, followed by its count), as used by `flamegraph.pl`,
+    speedscope or inferno.
+    """
+    return "".join(
+        f"{stack} {count}\n" for stack, count in stacks.most_common()
+    )
+
+
+class Profiler:
+    """
+    Profile the process by sampling its stacks (see `StackSampler`), a
+    profile at a time, so a profiling request can't overload the worker.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def start(self, include_idle: bool = False) -> StackSampler:
+        """Start sampling, raises `ProfilerBusy` if already profiling."""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("Another profile is running, retry later.")
+        try:
+            sampler = StackSampler(self.interval, include_idle)
+            sampler.start()
+        except Exception:
+            self._lock.release()
+            raise
+        return sampler
+
+    def stop(self, sampler: StackSampler) -> Counter:
+        """Stop the `sampler`, returning its stacks."""
+        try:
+            return sampler.stop()
+        finally:
+            self._lock.release()
+
+
+class ProfilingMiddleware:
+    """
+    An ASGI middleware which profiles the requests with a `header` (e.g.
+    `X-Profile: 1`), returning the collapsed stacks sampled while the request
+    was processed instead of its response (the original status code is sent
+    in the `X-Profile-Status` header). The stacks of every thread are
+    sampled, so they include the concurrent requests. If given, `authorize`
+    is awaited with the scope of the request, the header is ignored unless
+    it returns `True`.
+    """
+
+    def __init__(
+            self,
+            app,
+            profiler: Profiler,
+            header: str = "x-profile",
+            authorize: Callable[[dict], Awaitable[bool]] = None,
+    ):
+        self.app = app
+        self.profiler = profiler
+        self.header = header.lower().encode()
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self._requested(scope)
+            or (self.authorize is not None and not await self.authorize(scope))
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            sampler = self.profiler.start()
+        except ProfilerBusy as e:
+            await self._respond(send, 409, str(e).encode())
+            return
+        status_code = 500
+
+        async def discard_response(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+        try:
+            await self.app(scope, receive, discard_response)
+        finally:
+            stacks = self.profiler.stop(sampler)
+        await self._respond(
+            send,
+            200,
+            format_collapsed(stacks).encode(),
+            [(b"x-profile-status", str(status_code).encode())],
+        )
+
+    def _requested(self, scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == self.header:
+                return value.lower() in (b"1", b"true", b"yes")
+        return False
+
+    @staticmethod
+    async def _respond(send, status_code: int, body: bytes, headers=()):
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                *headers,
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Profiler:
+    """Return the profiler of the process, configured via `APISettings`."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(get_api_settings().profile_interval)
+    return _profiler
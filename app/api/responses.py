@@ -0,0 +1,64 @@
+import json
+from datetime import datetime
+from typing import Any, Iterable, List
+
+from starlette.responses import JSONResponse
+
+from app.api.timing import phase
+from app.api.utils import format_timestamp
+
+try:
+    import orjson  # optional, installed with `fastapi[all]`
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """Encode JSON-compatible `content`, with `orjson` if installed."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    A JSON response for content which is already JSON-compatible (only
+    dicts, lists, strings, numbers and `None`), so it's encoded as is (with
+    `orjson`, if installed), without `jsonable_encoder` or a response model.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def serialize_actions(rows: Iterable[tuple]) -> List[dict]:
+    """
+    Serialize rows of actions (tuples of `id`, `title`, `timestamp` and
+    `owner_id`) as `schemas.Action` does, without creating a model per row.
+    """
+    return [
+        {
+            "title": title,
+            "id": action_id,
+            "owner_id": owner_id,
+            "timestamp": (
+                format_timestamp(timestamp) if isinstance(timestamp, datetime)
+                else timestamp
+            ),
+        }
+        for action_id, title, timestamp, owner_id in rows
+    ]
+
+
+def actions_response(rows: Iterable[tuple], **kwargs) -> FastJSONResponse:
+    """Return a response with the rows of actions (see `serialize_actions`)."""
+    with phase("serialize"):
+        return FastJSONResponse(serialize_actions(rows), **kwargs)
+
+
+def json_response(content: Any, **kwargs) -> FastJSONResponse:
+    """Return a response with JSON-compatible `content`."""
+    with phase("serialize"):
+        return FastJSONResponse(content, **kwargs)
@@ -0,0 +1,141 @@
+"""
+The revoked access tokens. Each worker keeps them in memory, so checking a
+token doesn't need any query: the revocations are stored in the database and
+each worker reloads them every `revocation_sync_interval` seconds.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from app.api import models
+from app.api.config import get_api_settings
+
+log = logging.getLogger("api")
+
+
+def to_epoch(value: datetime) -> float:
+    """Convert an UTC datetime to seconds since the epoch."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class RevocationList:
+    """
+    The revoked access tokens, indexed by their `jti` and by username (the
+    time before which all the tokens of the user are revoked), so checking
+    a token is O(1). The entries are dropped when the tokens expire.
+    """
+
+    def __init__(self, sync_interval: float = 5.0):
+        self.sync_interval = sync_interval
+        # jti -> expiration time
+        self._tokens: Dict[str, float] = {}
+        # username -> (issued before, expiration time)
+        self._users: Dict[str, tuple] = {}
+        # id -> expiration time, of the revocations loaded from the database
+        self._loaded: Dict[int, float] = {}
+        self._synced_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def is_revoked(self, claims: dict) -> bool:
+        """Check if the token with the given (decoded) claims is revoked."""
+        jti = claims.get("jti")
+        if jti is not None and jti in self._tokens:
+            return True
+        revoked_user = self._users.get(claims.get("sub"))
+        # the tokens without `iat` were issued before the revocations
+        return (
+            revoked_user is not None
+            and claims.get("iat", 0) < revoked_user[0]
+        )
+
+    def add(self, revocation: models.TokenRevocation) -> None:
+        """Apply a revocation stored in the database."""
+        expires_at = to_epoch(revocation.expires_at)
+        with self._lock:
+            if revocation.jti is not None:
+                self._tokens[revocation.jti] = expires_at
+            if revocation.username is not None:
+                issued_before = to_epoch(revocation.issued_before)
+                current = self._users.get(revocation.username)
+                if current is None or current[0] < issued_before:
+                    self._users[revocation.username] = (
+                        issued_before, expires_at,
+                    )
+
+    def needs_sync(self) -> bool:
+        """Check if the revocations should be loaded from the database."""
+        return (
+            self._synced_at is None
+            or time.monotonic() - self._synced_at >= self.sync_interval
+        )
+
+    def sync(self, db: Session) -> int:
+        """
+        Load the revocations (added by any worker) which haven't expired, and
+        drop the expired ones. Returns the number of new revocations.
+
+        All of them are loaded every time (they only live as long as the
+        tokens), since the ids don't tell which ones are new: a revocation
+        committed after a later one (with a greater id) would be missed.
+        """
+        self._synced_at = time.monotonic()
+        now = datetime.utcnow()
+        revocations = (
+            db.query(models.TokenRevocation)
+            .filter(models.TokenRevocation.expires_at > now)
+            .all()
+        )
+        new = 0
+        for revocation in revocations:
+            if revocation.id in self._loaded:
+                continue
+            self.add(revocation)
+            self._loaded[revocation.id] = to_epoch(revocation.expires_at)
+            new += 1
+        self.purge(to_epoch(now))
+        return new
+
+    def purge(self, now: float) -> None:
+        """Drop the revocations of the tokens expired at `now`."""
+        with self._lock:
+            self._tokens = {
+                jti: expires_at
+                for jti, expires_at in self._tokens.items()
+                if expires_at > now
+            }
+            self._users = {
+                username: revoked
+                for username, revoked in self._users.items()
+                if revoked[1] > now
+            }
+            self._loaded = {
+                revocation_id: expires_at
+                for revocation_id, expires_at in self._loaded.items()
+                if expires_at > now
+            }
+
+    def stats(self) -> dict:
+        """Return the revocation list metrics."""
+        return {
+            "tokens": len(self._tokens),
+            "users": len(self._users),
+            "loaded": len(self._loaded),
+            "sync_interval": self.sync_interval,
+        }
+
+
+_revocation_list: Optional[RevocationList] = None
+
+
+def get_revocation_list() -> RevocationList:
+    """Return the revoked tokens, configured via `APISettings`."""
+    global _revocation_list
+    if _revocation_list is None:
+        _revocation_list = RevocationList(
+            get_api_settings().revocation_sync_interval,
+        )
+    return _revocation_list
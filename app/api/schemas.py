@@ -1,6 +1,9 @@
+from datetime import datetime
 from typing import List
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
+
+from app.api.utils import format_timestamp
 
 
 class ActionBase(BaseModel):
@@ -40,9 +43,16 @@ class Action(ActionBase):
     )
     timestamp: str = Field(
         None,
-        title="The datetime when the action was performed.",
+        title="The datetime (UTC) when the action was performed.",
     )
 
+    @validator("timestamp", pre=True)
+    def format_datetime(cls, value):
+        """Keep the format of the timestamp supplied by our API."""
+        if isinstance(value, datetime):
+            return format_timestamp(value)
+        return value
+
     class Config:
         orm_mode = True
 
@@ -77,10 +87,20 @@ class UserRemoved(UserBase):
         description="The `id` of the removed user.",
         gt=0,
     )
+    pending_actions: int = Field(
+        None,
+        title="Actions pending to be removed.",
+        description=(
+            "The number of actions of the user which will be removed in "
+            "background (only for the users with too many actions to remove "
+            "them at once)."
+        ),
+        ge=0,
+    )
 
 
-class User(UserBase):
-    """A class which defines an User."""
+class UserProfile(UserBase):
+    """A class which defines the profile of an User (without actions)."""
     id: int = Field(
         None,
         title="`id` of the user.",
@@ -96,7 +116,28 @@ class User(UserBase):
             "This field will be automatically set when the user authenticates."
         ),
     )
-    actions: List[Action] = []
+
+    class Config:
+        orm_mode = True
+        schema_extra = {
+            "example": {
+                "username": "johndoe",
+                "id": 1,
+                "is_active": True,
+            }
+        }
+
+
+class UserDetails(UserProfile):
+    """
+    A class which defines the profile of an User, optionally including some
+    of the user actions.
+    """
+    actions: List[Action] = Field(
+        None,
+        title="The user actions.",
+        description="Only included when requested.",
+    )
 
     class Config:
         orm_mode = True
@@ -117,6 +158,15 @@ class User(UserBase):
         }
 
 
+class User(UserProfile):
+    """A class which defines an User."""
+    actions: List[Action] = []
+
+    class Config:
+        orm_mode = True
+        schema_extra = UserDetails.Config.schema_extra
+
+
 class Token(BaseModel):
     """A class which describes a Token."""
     access_token: str
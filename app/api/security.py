@@ -1,6 +1,8 @@
+import uuid
+
 import jwt
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 from passlib.context import CryptContext
 
@@ -28,12 +30,17 @@ def create_access_token(*, data: dict, expires_delta: timedelta = None):
     will only be usable for a limited period of time.
     """
     to_encode = data.copy()
+    now = datetime.utcnow()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(
-            minutes=ACCESS_TOKEN_EXPIRE_MINUTES,
-        )
-    to_encode.update({"exp": expire})
+        expire = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # `jti` identifies the token and `iat` (with microseconds) tells if it
+    # was issued before the user's tokens were revoked
+    to_encode.update({
+        "exp": expire,
+        "iat": now.replace(tzinfo=timezone.utc).timestamp(),
+        "jti": uuid.uuid4().hex,
+    })
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -0,0 +1,289 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi.routing import APIRoute
+
+from app.api.config import get_api_settings
+
+try:
+    import contextvars  # Python 3.7+ only.
+except ImportError:  # pragma: no cover
+    contextvars = None
+
+log = logging.getLogger("api")
+
+# the timings of the request being processed (also available within the
+# threads of `run_blocking`, since the context is propagated)
+_current_timing = None
+if contextvars is not None:
+    _current_timing = contextvars.ContextVar("request_timing", default=None)
+
+
+class RequestTiming:
+    """
+    The timings of a request: the time spent in each phase (e.g. `jwt`,
+    `user`, `bcrypt`, `audit` or `serialize`) and the number and duration of
+    its SQL queries, keeping the ones slower than `slow_query_threshold`.
+    """
+
+    def __init__(self, slow_query_threshold: float = 0.1):
+        self.start = time.perf_counter()
+        self.slow_query_threshold = slow_query_threshold
+        self.phases: Dict[str, float] = {}
+        self.queries = 0
+        self.sql_time = 0.0
+        self.slow_queries: List[Tuple[str, float]] = []
+        self.endpoint_end: Optional[float] = None
+
+    def add_phase(self, name: str, elapsed: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def add_query(self, statement: str, elapsed: float) -> None:
+        self.queries += 1
+        self.sql_time += elapsed
+        if elapsed >= self.slow_query_threshold:
+            self.slow_queries.append((statement, elapsed))
+
+    def server_timing(self) -> str:
+        """Return the timings in the format of the `Server-Timing` header."""
+        metrics = [
+            f'db;dur={self.sql_time * 1000:.2f};desc="{self.queries} queries"'
+        ]
+        metrics.extend(
+            f"{name};dur={elapsed * 1000:.2f}"
+            for name, elapsed in self.phases.items()
+        )
+        total = time.perf_counter() - self.start
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    """Return the timings of the current request (if any)."""
+    return _current_timing.get() if _current_timing is not None else None
+
+
+@contextmanager
+def phase(name: str):
+    """Measure a phase of the current request (if any)."""
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add_phase(name, time.perf_counter() - start)
+
+
+def record_query(statement: str, elapsed: float) -> None:
+    """Add a SQL query to the timings of the current request (if any)."""
+    timing = current_timing()
+    if timing is not None:
+        timing.add_query(statement, elapsed)
+
+
+class TimingReport:
+    """
+    The request timings aggregated per route, alongside the latest
+    `slow_query_samples` slow queries. A warning is logged for the requests
+    running more than `max_queries` queries (e.g. a query per row).
+    """
+
+    def __init__(
+        self,
+        slow_query_threshold: float = 0.1,
+        slow_query_samples: int = 20,
+        max_queries: int = 50,
+    ):
+        self.slow_query_threshold = slow_query_threshold
+        self.max_queries = max_queries
+        self._lock = threading.Lock()
+        self._routes: Dict[str, dict] = {}
+        self._slow_queries = deque(maxlen=slow_query_samples)
+
+    def record(self, route: str, timing: RequestTiming) -> None:
+        """Add the timings of a finished request of `route`."""
+        elapsed = time.perf_counter() - timing.start
+        if timing.queries > self.max_queries:
+            log.warning(
+                f"{route} ran {timing.queries} queries within a request"
+            )
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {
+                    "requests": 0,
+                    "time": 0.0,
+                    "time_max": 0.0,
+                    "queries": 0,
+                    "queries_max": 0,
+                    "sql_time": 0.0,
+                    "phases": {},
+                }
+            stats["requests"] += 1
+            stats["time"] += elapsed
+            stats["time_max"] = max(stats["time_max"], elapsed)
+            stats["queries"] += timing.queries
+            stats["queries_max"] = max(stats["queries_max"], timing.queries)
+            stats["sql_time"] += timing.sql_time
+            for name, phase_elapsed in timing.phases.items():
+                stats["phases"][name] = (
+                    stats["phases"].get(name, 0.0) + phase_elapsed
+                )
+            for statement, query_elapsed in timing.slow_queries:
+                self._slow_queries.append({
+                    "route": route,
+                    "statement": statement,
+                    "seconds": query_elapsed,
+                })
+
+    def report(self) -> dict:
+        """
+        Return the average time, queries, SQL time and time of each phase
+        per request of each route, and the slow queries.
+        """
+        with self._lock:
+            routes = {}
+            for route, stats in self._routes.items():
+                requests = stats["requests"]
+                routes[route] = {
+                    "requests": requests,
+                    "time_avg": stats["time"] / requests,
+                    "time_max": stats["time_max"],
+                    "queries_avg": stats["queries"] / requests,
+                    "queries_max": stats["queries_max"],
+                    "sql_time_avg": stats["sql_time"] / requests,
+                    "phases_avg": {
+                        name: elapsed / requests
+                        for name, elapsed in stats["phases"].items()
+                    },
+                }
+            return {
+                "routes": routes,
+                "slow_queries": list(self._slow_queries),
+            }
+
+    def reset(self) -> None:
+        """Discard the recorded timings."""
+        with self._lock:
+            self._routes.clear()
+            self._slow_queries.clear()
+
+
+# the names of the routes, per method and endpoint
+_route_names: Dict[tuple, str] = {}
+
+
+def get_route_name(scope) -> str:
+    """Return the method and the path template of the matched route."""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    key = (scope["method"], endpoint)
+    name = _route_names.get(key)
+    if name is None:
+        path = next(
+            (
+                route.path
+                for route in scope["app"].routes
+                if getattr(route, "endpoint", None) is endpoint
+            ),
+            endpoint.__name__,
+        )
+        name = _route_names[key] = f"{scope['method']} {path}"
+    return name
+
+
+class TimingMiddleware:
+    """
+    An ASGI middleware which measures each request (see `RequestTiming`),
+    sending its timings to the client in the `Server-Timing` header (if
+    `server_timing` is set) and adding them to `report` per route.
+    """
+
+    def __init__(self, app, report: TimingReport, server_timing: bool = True):
+        self.app = app
+        self.report = report
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or _current_timing is None:
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming(self.report.slow_query_threshold)
+        token = _current_timing.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                if timing.endpoint_end is not None:
+                    timing.add_phase(
+                        "serialize", time.perf_counter() - timing.endpoint_end,
+                    )
+                if self.server_timing:
+                    message = dict(message)
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", timing.server_timing().encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timing.reset(token)
+            self.report.record(get_route_name(scope), timing)
+
+
+def timed_endpoint(endpoint: Callable) -> Callable:
+    """
+    Wrap an (async) endpoint to record when it finishes, so the time until
+    the response starts (its serialization) is measured.
+    """
+    if not asyncio.iscoroutinefunction(endpoint) or hasattr(
+        endpoint, "__timed__"
+    ):
+        return endpoint
+
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            timing = current_timing()
+            if timing is not None:
+                timing.endpoint_end = time.perf_counter()
+
+    wrapper.__timed__ = True
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """A route whose endpoint is wrapped with `timed_endpoint`."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+
+_timing_report: Optional[TimingReport] = None
+
+
+def get_timing_report() -> TimingReport:
+    """Return the report of the request timings, configured via settings."""
+    global _timing_report
+    if _timing_report is None:
+        api_settings = get_api_settings()
+        _timing_report = TimingReport(
+            slow_query_threshold=api_settings.slow_query_threshold,
+            slow_query_samples=api_settings.slow_query_samples,
+            max_queries=api_settings.request_max_queries,
+        )
+    return _timing_report
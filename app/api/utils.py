@@ -1,18 +1,74 @@
+import base64
 from datetime import datetime
-from typing import Union
+from typing import Tuple, Union
 
 from fastapi import HTTPException
 from starlette import status
+# to support Python versions lower than 3.8, we import
+# `Literal` from typing_extensions instead from the builtin module
+#   See also: https://docs.python.org/3/library/typing.html#typing.Literal
+from typing_extensions import Literal
 
 UNAUTHORIZED_USER_QUERY_MSG = (
     "You are not allowed to view/modify the {section} "
     "of another user, please, use your own id: `{user_id}`."
 )
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
+# For each granularity of time, the fields of a datetime that we reset to get
+# the start of the bucket
+BUCKET_FIELDS = {
+    "minute": {"second": 0},
+    "hour": {"minute": 0, "second": 0},
+    "day": {"hour": 0, "minute": 0, "second": 0},
+}
 
-def get_timestamp() -> str:
-    """Get current datetime in string format."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def get_timestamp() -> datetime:
+    """Get current datetime (in UTC and without microseconds)."""
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    """Given a datetime, returns it in the string format used by our API."""
+    return timestamp.strftime(TIMESTAMP_FORMAT)
+
+
+def get_bucket(
+        timestamp: datetime, granularity: Literal["minute", "hour", "day"],
+) -> datetime:
+    """
+    Given a datetime, returns the start of the bucket of time (per `minute`,
+    `hour` or `day`) that contains it.
+    """
+    return timestamp.replace(microsecond=0, **BUCKET_FIELDS[granularity])
+
+
+def encode_cursor(timestamp: datetime, action_id: int) -> str:
+    """
+    Given the timestamp and the id of the last action of a page, returns an
+    opaque cursor to request the next page.
+    """
+    raw_cursor = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{action_id}"
+    return base64.urlsafe_b64encode(raw_cursor.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Given a cursor generated with `encode_cursor`, returns the timestamp and
+    the id of the action. Raises `ValueError` if the cursor is not valid.
+    """
+    try:
+        raw_cursor = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, action_id = raw_cursor.split("|")
+        return (
+            datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+            int(action_id),
+        )
+    except ValueError as exc:
+        # this also covers base64 and unicode decoding errors
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
 
 
 def check_user_id(
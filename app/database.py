@@ -1,19 +1,237 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
 
-from app.api.config import SQLALCHEMY_DATABASE_URI
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool, StaticPool
+from sqlalchemy.sql.expression import UpdateBase
+
+from app.api import metrics, timing
+from app.api.config import APISettings, get_api_settings
 from app.api.models import Base
 
+log = logging.getLogger("api")
+
+
+def set_sqlite_pragmas(engine: Engine, api_settings: APISettings) -> None:
+    """
+    Configure every new SQLite connection of `engine`. With the WAL journal
+    the readers don't block the writer (and vice versa), and the writers
+    wait up to `sqlite_busy_timeout` for the lock instead of failing with
+    `database is locked`.
+    """
+    pragmas = {
+        "journal_mode": api_settings.sqlite_journal_mode,
+        "synchronous": api_settings.sqlite_synchronous,
+        "busy_timeout": api_settings.sqlite_busy_timeout,
+        "cache_size": api_settings.sqlite_cache_size,
+        "mmap_size": api_settings.sqlite_mmap_size,
+    }
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def record_query_timings(target=Engine) -> None:
+    """
+    Measure every query run by the `target` engine (by default, all of them),
+    adding it to the timings of the current request (see `app.api.timing`).
+    """
+
+    @event.listens_for(target, "before_cursor_execute")
+    def before_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany,
+    ):
+        conn.info.setdefault("query_start_time", []).append(
+            time.perf_counter()
+        )
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany,
+    ):
+        start = conn.info["query_start_time"].pop()
+        timing.record_query(statement, time.perf_counter() - start)
+
+
+def record_pool_metrics(target=Pool) -> None:
+    """
+    Count the connections opened and checked out by the `target` pool (by
+    default, all of them), see `app.api.metrics`.
+    """
+    connections = metrics.DB_POOL_CONNECTIONS.labels()
+    checked_out = metrics.DB_POOL_CHECKED_OUT.labels()
+
+    @event.listens_for(target, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        connections.inc()
+
+    @event.listens_for(target, "close")
+    def on_close(dbapi_connection, connection_record):
+        connections.dec()
+
+    @event.listens_for(target, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out.inc()
+
+    @event.listens_for(target, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out.dec()
+
+
+def create_db_engine(
+        database_uri: str, api_settings: APISettings = None,
+) -> Engine:
+    """
+    Create an engine for `database_uri`, with the pooling (and the SQLite
+    pragmas) configured via `APISettings`.
+    """
+    api_settings = api_settings or get_api_settings()
+    url = make_url(database_uri)
+    if url.get_backend_name() != "sqlite":
+        # the queries are run in the threads of `run_blocking`, each thread
+        # needs its own connection from the pool
+        return create_engine(
+            database_uri,
+            pool_size=api_settings.db_pool_size,
+            max_overflow=api_settings.db_max_overflow,
+            pool_timeout=api_settings.db_pool_timeout,
+            pool_recycle=api_settings.db_pool_recycle,
+            pool_pre_ping=api_settings.db_pool_pre_ping,
+        )
 
-# Create our sqlite3 database
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URI,
     # By default SQLite will only allow one thread to communicate with it,
     # assuming that each thread would handle an independent request. But in
     # FastAPI, using normal functions (def) more than one thread could
     # interact with the database for the same request, so we need to make
     # SQLite know that it should allow that.
-    connect_args={"check_same_thread": False}
+    connect_args = {"check_same_thread": False}
+    if url.database in (None, "", ":memory:"):
+        # an in-memory database only lives within its connection, so it is
+        # shared by every thread
+        return create_engine(
+            database_uri, connect_args=connect_args, poolclass=StaticPool,
+        )
+    # keep the connections open (SQLAlchemy would open a new one for each
+    # session), so their pragmas and page cache are reused
+    engine = create_engine(
+        database_uri,
+        connect_args=connect_args,
+        poolclass=QueuePool,
+        pool_size=api_settings.db_pool_size,
+        max_overflow=api_settings.db_max_overflow,
+        pool_timeout=api_settings.db_pool_timeout,
+    )
+    set_sqlite_pragmas(engine, api_settings)
+    return engine
+
+
+class RoutingSession(Session):
+    """
+    A session that sends the queries to a `replica` and the writes to the
+    `primary` database. Once the session has written something, all its
+    queries are sent to the primary as well, so it can read its own writes.
+    """
+
+    def __init__(self, primary: Engine, replica: Engine, **kwargs):
+        super().__init__(bind=primary, **kwargs)
+        self.primary = primary
+        self.replica = replica
+        self.has_written = False
+
+    def get_bind(self, mapper=None, clause=None):
+        # the ORM writes (flushes and bulk operations) don't supply a clause
+        if self._flushing or clause is None or isinstance(clause, UpdateBase):
+            self.has_written = True
+        return self.primary if self.has_written else self.replica
+
+
+class ReplicaSet:
+    """
+    The read replicas of the database, used in turns. Choosing a replica
+    doesn't connect to it: a replica is marked as down when connecting to it
+    (or a connection to it) fails, then it is skipped for `retry_interval`
+    seconds, and checked (once) before being used again.
+    """
+
+    def __init__(self, engines: List[Engine], retry_interval: float = 30.0):
+        self.engines = engines
+        self.retry_interval = retry_interval
+        self._turns = itertools.cycle(range(len(engines)))
+        self._down_until: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        for index, engine in enumerate(engines):
+            self._watch(index, engine)
+
+    def __bool__(self) -> bool:
+        return bool(self.engines)
+
+    def _watch(self, index: int, engine: Engine) -> None:
+        @event.listens_for(engine, "handle_error")
+        def on_error(context):
+            # the connection couldn't be opened, or it has been lost
+            if context.connection is None or context.is_disconnect:
+                self._mark_down(index, context.original_exception)
+
+    def _mark_down(self, index: int, error: Exception) -> None:
+        engine = self.engines[index]
+        log.warning(f"Database replica {engine.url!r} is down: {error}")
+        with self._lock:
+            self._down_until[index] = time.monotonic() + self.retry_interval
+
+    def _is_up(self, index: int) -> bool:
+        with self._lock:
+            down_until = self._down_until.get(index)
+            if down_until is None:
+                return True
+            if down_until > time.monotonic():
+                return False
+            # check it once (the other requests skip it meanwhile)
+            self._down_until[index] = time.monotonic() + self.retry_interval
+        try:
+            # check out a connection from the pool (and return it), if it
+            # fails, the replica is marked as down again by `_watch`
+            self.engines[index].connect().close()
+        except Exception:
+            return False
+        with self._lock:
+            self._down_until.pop(index, None)
+        return True
+
+    def choose(self) -> Optional[Engine]:
+        """Return an available replica, or `None` to use the primary."""
+        for _ in range(len(self.engines)):
+            with self._lock:
+                index = next(self._turns)
+            if self._is_up(index):
+                return self.engines[index]
+        return None
+
+
+# Measure the queries of the requests
+if get_api_settings().request_timing:
+    record_query_timings()
+# and its connection pools
+if get_api_settings().metrics_enabled:
+    record_pool_metrics()
+# Create our database
+engine = create_db_engine(get_api_settings().database_url)
+# and its read replicas (if any)
+replicas = ReplicaSet(
+    [
+        create_db_engine(url)
+        for url in get_api_settings().database_replica_urls
+    ],
+    get_api_settings().replica_retry_interval,
 )
 # Create a database session for our engine
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
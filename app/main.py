@@ -1,34 +1,86 @@
+import asyncio
+import hashlib
 import logging
-from datetime import timedelta
-from typing import List
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
 
 import jwt
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import (
+    APIRouter,
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Response,
+)
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jwt import PyJWTError
 from sqlalchemy.orm import Session
 from starlette import status
 from starlette.staticfiles import StaticFiles
-from starlette.responses import FileResponse
+from starlette.requests import Request
+from starlette.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 # to support Python versions lower than 3.8, we import
 # `Literal` from typing_extensions instead from the builtin module
 #   See also: https://docs.python.org/3/library/typing.html#typing.Literal
 from typing_extensions import Literal
 
-from app.database import SessionLocal
+from app.database import RoutingSession, SessionLocal, replicas
 from app.api import crud, schemas
+from app.api.audit import get_audit_writer
+from app.api.cache import (
+    get_histogram_cache,
+    get_primary_reads_cache,
+    get_token_cache,
+    get_user_cache,
+    user_cache_key,
+)
+from app.api.concurrency import (
+    get_db_limiter,
+    run_blocking,
+    shutdown_executor,
+)
 from app.api.config import get_api_settings
+from app.api.deletion import get_deletion_worker
+from app.api.export import EXPORT_MEDIA_TYPES, stream_actions
+from app.api.hashing import (
+    HashingPoolBusy,
+    get_hashing_pool,
+    get_password_hash_async,
+    verify_password_async,
+)
+from app.api.metrics import CONTENT_TYPE, MetricsMiddleware, registry
+from app.api.profiling import (
+    ProfilerBusy,
+    ProfilingMiddleware,
+    format_collapsed,
+    get_profiler,
+)
+from app.api.responses import actions_response, json_response
+from app.api.revocation import get_revocation_list
+from app.api.timing import (
+    TimedRoute,
+    TimingMiddleware,
+    get_timing_report,
+    phase,
+)
 from app.api.security import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     ALGORITHM,
     SECRET_KEY,
     create_access_token,
-    verify_password,
 )
-from app.api.utils import check_user_id
+from app.api.utils import check_user_id, decode_cursor, encode_cursor
 
 log = logging.getLogger("api")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/authenticate")
+admin_router = APIRouter()
 api_settings = get_api_settings()
 
 app = FastAPI(
@@ -42,13 +94,88 @@ app = FastAPI(
     debug=api_settings.debug,
 )
 app.mount("/public", StaticFiles(directory="public"), name="public")
+if api_settings.request_timing:
+    # the routes record when their endpoint finishes, so the serialization of
+    # its response is measured as well
+    app.router.route_class = TimedRoute
+    app.add_middleware(
+        TimingMiddleware,
+        report=get_timing_report(),
+        server_timing=api_settings.server_timing_header,
+    )
+if api_settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event("startup")
+def start_audit_writer():
+    """Start the background writer of the user actions."""
+    get_audit_writer().start()
+
+
+@app.on_event("shutdown")
+def stop_audit_writer():
+    """Write any pending user action before the server shuts down."""
+    get_audit_writer().stop()
+
+
+@app.on_event("startup")
+def start_deletion_worker():
+    """Resume the removal of the actions of the removed users."""
+    get_deletion_worker().start()
+
+
+@app.on_event("shutdown")
+def stop_deletion_worker():
+    """Stop removing actions (it will be resumed on the next start)."""
+    get_deletion_worker().stop()
+
+
+@app.on_event("shutdown")
+def close_metrics():
+    """Reset the gauges of this process (e.g. the connections in use)."""
+    registry.close()
+
+
+@app.on_event("shutdown")
+def shutdown_blocking_pool():
+    """Stop the thread pool used to run blocking work on server shutdown."""
+    shutdown_executor()
+
+
+@app.on_event("shutdown")
+def shutdown_hashing_pool():
+    """Stop the password hashing processes on server shutdown."""
+    get_hashing_pool().shutdown()
+
+
+@app.exception_handler(HashingPoolBusy)
+async def hashing_pool_busy_handler(request: Request, exc: HashingPoolBusy):
+    """Reject the request fast when the hashing pool is saturated."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
 
 WRONG_QUERY_ARGUMENTS_MSG = (
     "The Query parameter supplied for `{query_arg}` is invalid."
 )
+# default size of the buckets of the period histogram for each period of time
+PERIOD_GRANULARITIES = {"hour": "minute", "day": "hour", "month": "day"}
+
+
+async def limit_db_requests():
+    """
+    A function to wait until the database can serve the request (see
+    `APISettings.db_max_requests`), so the requests never wait for a
+    connection within our thread pool.
+    """
+    async with get_db_limiter():
+        yield
 
 
-def get_db():
+def get_db(_: None = Depends(limit_db_requests)):
     """A function to get a database session."""
     db = SessionLocal()
     try:
@@ -57,18 +184,71 @@ def get_db():
         db.close()
 
 
-def authenticate_user(
+async def authenticate_user(
     username: str, password: str, db: Session = Depends(get_db)
 ):
     """A function to check user password. If not succeed, will return False."""
-    db_user = crud.get_user_by_username(db, username=username)
+    db_user = await run_blocking(
+        crud.get_user_by_username, db, username=username,
+    )
     if not db_user:
         return False
-    if not verify_password(password, db_user.hashed_password):
+    # the password is verified by the hashing pool (which rejects it right
+    # away if it is busy), without holding a thread of our pool
+    if not await verify_password_async(password, db_user.hashed_password):
         return False
     return db_user
 
 
+def decode_access_token(token: str) -> dict:
+    """
+    A function to decode (and validate) an access token. Since the clients
+    send the same token in every call, the decoded claims are cached (keyed
+    by the token digest) until the token expires.
+    """
+    token_cache = get_token_cache()
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(digest)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        ttl = payload.get("exp", 0) - time.time()
+        if ttl > 0:
+            token_cache.set(digest, payload, ttl)
+    return payload
+
+
+async def load_user(
+    db: Session, username: str, user_id: Optional[int],
+) -> Optional[schemas.UserProfile]:
+    """
+    A function to look up the user of an access token (its `sub` and `uid`
+    claims), returning `None` if the user doesn't exist or has other id. The
+    resolved users are cached (as a detached snapshot), so most of the
+    authenticated calls don't need to query the database. The entries are
+    keyed by the user id too, so a username registered again (after removing
+    its user) is never resolved to the removed user by a worker that still
+    caches it.
+    """
+    user_cache = get_user_cache()
+    # the tokens without `uid` were issued before it was always embedded
+    cache_key = (
+        user_cache_key(username, user_id) if user_id is not None else None
+    )
+    if cache_key is not None:
+        cached_user = await run_blocking(user_cache.get, cache_key)
+        if cached_user is not None:
+            return schemas.UserProfile(**cached_user)
+    db_user = await run_blocking(
+        crud.get_user_by_username, db, username=username,
+    )
+    if db_user is None or (user_id is not None and db_user.id != user_id):
+        return None
+    user = schemas.UserProfile.from_orm(db_user)
+    if cache_key is not None:
+        await run_blocking(user_cache.set, cache_key, user.dict())
+    return user
+
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
 ):
@@ -78,17 +258,124 @@ async def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    with phase("jwt"):
+        try:
+            payload = decode_access_token(token)
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except PyJWTError:
             raise credentials_exception
-    except PyJWTError:
-        raise credentials_exception
-    db_user = crud.get_user_by_username(db, username=username)
-    if db_user is None:
+        # the revoked tokens are kept in memory, and reloaded periodically
+        revocations = get_revocation_list()
+        if revocations.needs_sync():
+            await run_blocking(revocations.sync, db)
+        if revocations.is_revoked(payload):
+            raise credentials_exception
+    user_id = payload.get("uid")
+    if api_settings.token_embed_user and "act" in payload:
+        # the user is described by the token, no need to look it up
+        return schemas.UserProfile(
+            id=user_id, username=username, is_active=payload["act"],
+        )
+    with phase("user"):
+        user = await load_user(db, username, user_id)
+    if user is None:
         raise credentials_exception
-    return db_user
+    return user
+
+
+async def get_current_superuser(
+    current_user: schemas.UserProfile = Depends(get_current_user),
+):
+    """
+    A function to check that the current user is a superuser (see
+    `APISettings.superusers`), to protect the admin routes.
+    """
+    if current_user.username not in api_settings.superusers:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="The user doesn't have enough privileges",
+        )
+    return current_user
+
+
+async def is_superuser_request(scope: dict) -> bool:
+    """
+    A function to check, from a middleware, that a request (its ASGI `scope`)
+    is sent by a superuser, as `get_current_superuser` does (without looking
+    up the user).
+    """
+    if api_settings.disable_superuser_dependency:
+        return True
+    try:
+        token = await oauth2_scheme(Request(scope))
+        payload = decode_access_token(token)
+    except (HTTPException, PyJWTError):
+        return False
+    return (
+        payload.get("sub") in api_settings.superusers
+        and not get_revocation_list().is_revoked(payload)
+    )
+
+
+def reads_from_primary(token: str) -> bool:
+    """
+    A function to check if the user of `token` has just written something,
+    so its queries must be sent to the primary database.
+    """
+    try:
+        username = decode_access_token(token).get("sub")
+    except PyJWTError:
+        return True
+    return get_primary_reads_cache().get(username) is not None
+
+
+async def stick_to_primary(username: str):
+    """
+    A function to send the queries of an user to the primary database for
+    a while (`replica_sticky_seconds`), after the user writes something.
+    """
+    if replicas:
+        await run_blocking(get_primary_reads_cache().set, username, True)
+
+
+def get_read_db(
+    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme),
+):
+    """
+    A function to get a database session for the read-only routes, which
+    sends the queries to a replica (if any is available) and the writes
+    (e.g. the user actions) to the primary database.
+    """
+    replica = None
+    if replicas and not reads_from_primary(token):
+        replica = replicas.choose()
+    if replica is None:
+        yield db
+        return
+    read_db = RoutingSession(
+        primary=db.get_bind(), replica=replica,
+        autocommit=False, autoflush=False,
+    )
+    try:
+        yield read_db
+    finally:
+        read_db.close()
+
+
+async def get_cached_histogram(key: str, func, *args, **kwargs):
+    """
+    A function to return an histogram from the cache, computing it with
+    `func(*args, **kwargs)` (and caching it) when missing.
+    """
+    histogram_cache = get_histogram_cache()
+    histogram = await run_blocking(histogram_cache.get, key)
+    if histogram is None:
+        # the histograms are JSON-compatible (see `json_response`)
+        histogram = await run_blocking(func, *args, **kwargs)
+        await run_blocking(histogram_cache.set, key, histogram)
+    return histogram
 
 
 @app.get("/", include_in_schema=False)
@@ -118,20 +405,28 @@ async def login_for_access_token(
     A `POST` call to login into the server and receive a `Token` to be used for
     API's private calls.
     """
-    db_user = authenticate_user(form_data.username, form_data.password, db)
+    db_user = await authenticate_user(
+        form_data.username, form_data.password, db,
+    )
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    token_data = {"sub": db_user.username, "uid": db_user.id}
+    if api_settings.token_embed_user:
+        token_data["act"] = db_user.is_active
     access_token = create_access_token(
-        data={"sub": db_user.username},
+        data=token_data,
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
     )
 
+    await stick_to_primary(db_user.username)
+
     # register user login
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
         db,
         schemas.ActionCreate(**{"title": "Logged into account"}),
         db_user.id,
@@ -139,14 +434,52 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.post(
+    "/logout",
+    tags=["Authentication"],
+    summary="Revoke the access token.",
+)
+async def logout(
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
+):
+    """
+    A `POST` call to revoke the access token used for the call, so it can't
+    be used anymore.
+    """
+    payload = decode_access_token(token)
+    if "jti" not in payload:
+        raise HTTPException(
+            status_code=400, detail="This access token can't be revoked",
+        )
+    await run_blocking(
+        crud.revoke_token,
+        db,
+        payload["jti"],
+        datetime.utcfromtimestamp(payload["exp"]),
+    )
+
+    await stick_to_primary(current_user.username)
+
+    # register user logout
+    await run_blocking(
+        get_audit_writer().record,
+        db,
+        schemas.ActionCreate(**{"title": "Logged out of account"}),
+        current_user.id,
+    )
+    return {"detail": "Access token revoked"}
+
+
 @app.get(
     "/users/histogram-types",
     tags=["Histogram (private)"],
     summary="Types histogram"
 )
 async def read_users_actions_types_histogram(
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user),
+    db: Session = Depends(get_read_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
     """
     A `GET` call that returns all types of registered actions, alongside the
@@ -154,15 +487,18 @@ async def read_users_actions_types_histogram(
     action's title, and the value the number of times that the action was used.
     """
 
-    types_of_actions = crud.get_users_types_histogram(db)
+    types_of_actions = await get_cached_histogram(
+        "types", crud.get_users_types_histogram, db,
+    )
 
     # register actions types query
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
         db,
         schemas.ActionCreate(**{"title": "Queried types histogram"}),
         current_user.id,
     )
-    return types_of_actions
+    return json_response(types_of_actions)
 
 
 @app.get(
@@ -171,7 +507,7 @@ async def read_users_actions_types_histogram(
     summary="Period histogram"
 )
 async def read_users_actions_periods_histogram(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     period_time: Literal["hour", "day", "month"] = Query(
         "day",
         description=(
@@ -179,79 +515,195 @@ async def read_users_actions_periods_histogram(
             "- `hour`\n- `day`\n- `month`\n"
         ),
     ),
-    current_user: schemas.User = Depends(get_current_user),
+    mode: Literal["timestamps", "summary", "buckets"] = Query(
+        "timestamps",
+        description=(
+            "The format of the histogram. It should be one of:\n\n"
+            "- `timestamps`: all the timestamps of each action\n"
+            "- `summary`: only the number of actions and the first/last "
+            "timestamps of each action\n"
+            "- `buckets`: the number of actions per bucket of time\n"
+        ),
+    ),
+    granularity: Literal["minute", "hour", "day"] = Query(
+        None,
+        description=(
+            "Size of the buckets of time, only used with `mode=buckets`. "
+            "By default, `minute` for an `hour` period, `hour` for a `day` "
+            "period and `day` for a `month` period."
+        ),
+    ),
+    start: datetime = Query(
+        None,
+        description=(
+            "Start of the histogram, only used with `mode=buckets`. "
+            "If not set, it will be computed from `period_time`."
+        ),
+    ),
+    end: datetime = Query(
+        None,
+        description=(
+            "End of the histogram, only used with `mode=buckets`. "
+            "If not set, the histogram will include the latest actions."
+        ),
+    ),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
     """
     A `GET` call that returns an histogram containing information about all
     different types of actions. Each registered action will have the
     following information:
 
-    - **timestamps**: A list with the timestamps of the action
+    - **timestamps**: A list with the timestamps of the action, sorted in
+      ascending order (only for `mode=timestamps`)
+    - **buckets**: The number of actions per bucket of time, where the keys
+      are the start of each bucket (only for `mode=buckets`)
     - **size**: The total number of timestamps for the action
     - **min**: The first timestamp of the action
     - **max**: The last timestamp of the action
     """
-    actions_data = crud.get_users_periods_histogram(db, period_time)
+    if mode == "buckets":
+        granularity = granularity or PERIOD_GRANULARITIES[period_time]
+        actions_data = await get_cached_histogram(
+            f"period:{period_time}:buckets:{granularity}:{start}:{end}",
+            crud.get_users_periods_histogram_buckets,
+            db,
+            granularity=granularity,
+            start=start or crud.get_period_start(period_time),
+            end=end,
+        )
+        title = f"Queried period histogram ({period_time}, buckets)"
+    elif mode == "summary":
+        actions_data = await get_cached_histogram(
+            f"period:{period_time}:summary",
+            crud.get_users_periods_histogram,
+            db,
+            period_time,
+            include_timestamps=False,
+        )
+        title = f"Queried period histogram ({period_time}, summary)"
+    else:
+        actions_data = await get_cached_histogram(
+            f"period:{period_time}",
+            crud.get_users_periods_histogram,
+            db,
+            period_time,
+        )
+        title = f"Queried period histogram ({period_time})"
 
     # register last actions query
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
         db,
-        schemas.ActionCreate(
-            **{"title": f"Queried period histogram ({period_time})"},
-        ),
+        schemas.ActionCreate(**{"title": title}),
         current_user.id,
     )
-    return actions_data
+    return json_response(actions_data)
 
 
 @app.post("/users/", response_model=schemas.User, tags=["Users"])
 async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     """A `POST` call to add a new user."""
-    db_user = crud.get_user_by_username(db, username=user.username)
+    db_user = await run_blocking(
+        crud.get_user_by_username, db, username=user.username,
+    )
     if db_user:
         raise HTTPException(
             status_code=400, detail="username already registered"
         )
     log.debug(f"Creating user: {user}")
-    return crud.create_user(db=db, user=user)
+    hashed_password = await get_password_hash_async(user.password)
+    db_user = await run_blocking(
+        crud.create_user, db=db, user=user, hashed_password=hashed_password,
+    )
+    await stick_to_primary(db_user.username)
+    return db_user
 
 
 @app.delete(
     "/users/{user_id}",
     response_model=schemas.UserRemoved,
+    response_model_exclude_none=True,
     tags=["Users (private)"],
     description=(
             "This `delete` call, will also remove any information "
-            "related with the user."
+            "related with the user. The account is removed right away, but "
+            "if the user has many actions, they are removed in background "
+            "(`pending_actions`)."
     ),
 )
 async def delete_user(
         user_id: int,
         db: Session = Depends(get_db),
-        current_user: schemas.User = Depends(get_current_user),
+        current_user: schemas.UserProfile = Depends(get_current_user),
 ):
     """A `DELETE` call to remove an user from database."""
     assert check_user_id(current_user.id, user_id, "profile") is True
 
-    removed_user = crud.remove_user(db, user_id)
+    removed_user = await run_blocking(
+        crud.remove_user,
+        db,
+        user_id,
+        sync_limit=api_settings.user_delete_sync_limit,
+    )
+    if removed_user.pending_actions:
+        get_deletion_worker().wake()
     log.info(f"Removed user: {removed_user}")
     return removed_user
 
 
 @app.get(
     "/users/{user_id}",
-    response_model=schemas.User,
+    response_model=schemas.UserDetails,
+    response_model_exclude_none=True,
     tags=["Users (private)"],
 )
 async def read_user(
     user_id: int,
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user),
+    include: Literal["actions"] = Query(
+        None,
+        description=(
+            "Extra information to include into the user profile. It should "
+            "be: `actions`."
+        ),
+    ),
+    actions_limit: int = Query(
+        100,
+        description=(
+            "Maximum number of user actions (the oldest ones) to include "
+            "with `include=actions`. To get all the user actions, use the "
+            "endpoint `/users/{user_id}/actions`."
+        ),
+        ge=1,
+        le=api_settings.actions_max_limit,
+    ),
+    db: Session = Depends(get_read_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
-    """A `GET` call to retrieve user information."""
+    """
+    A `GET` call to retrieve user information. The user actions are only
+    included if requested via `include=actions`, limited to `actions_limit`.
+    """
     assert check_user_id(current_user.id, user_id, "profile") is True
 
-    return crud.get_user(db, user_id=user_id)
+    db_user = await run_blocking(crud.get_user, db, user_id=user_id)
+    # we don't use `UserDetails.from_orm`, since it would load all the user
+    # actions from the `User.actions` relationship
+    user_details = schemas.UserDetails(
+        **schemas.UserProfile.from_orm(db_user).dict(),
+    )
+    if include == "actions":
+        actions = await run_blocking(
+            crud.get_user_actions,
+            db,
+            user_id=user_id,
+            sort="asc",
+            limit=actions_limit,
+        )
+        user_details.actions = [
+            schemas.Action.from_orm(action) for action in actions
+        ]
+    return user_details
 
 
 @app.put(
@@ -262,15 +714,24 @@ async def change_user_password(
     user_id: int,
     new_password: str,
     db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
     """A `PUT` call to update user password."""
     assert check_user_id(current_user.id, user_id, "password") is True
 
-    crud.change_user_password(db, user_id, new_password)
+    hashed_password = await get_password_hash_async(new_password)
+    await run_blocking(
+        crud.change_user_password,
+        db,
+        user_id,
+        new_password,
+        hashed_password=hashed_password,
+    )
+    await stick_to_primary(current_user.username)
 
     # register action: changed user password
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
         db,
         schemas.ActionCreate(**{"title": "Changed user password"}),
         user_id,
@@ -300,13 +761,29 @@ async def read_actions(
         title="Limit results",
         description=(
                 "The results will be limited to the supplied number. If the "
-                "supplied number is `0`, all the result will be shown."
+                "supplied number is `0` (or greater than the maximum allowed "
+                f"`{api_settings.actions_max_limit}`), the maximum allowed "
+                "number of results will be shown."
         ),
+        ge=0,
     ),
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user),
+    cursor: str = Query(
+        None,
+        title="Page cursor",
+        description=(
+                "To get the next page of results, supply the cursor received "
+                "in the `X-Next-Cursor` header of the previous page."
+        ),
+    ),
+    db: Session = Depends(get_read_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
-    """A `GET` call to retrieve the user actions information."""
+    """
+    A `GET` call to retrieve the user actions information. The results are
+    paginated: if there are more results, the response will include the
+    headers `X-Next-Cursor` (to be supplied as the `cursor` of the next call)
+    and `Link` (the url of the next page).
+    """
     assert check_user_id(current_user.id, user_id, "actions") is True
 
     if sort not in {"asc", "desc"}:
@@ -317,21 +794,107 @@ async def read_actions(
                 + "It should be one of: `asc` or `desc`."
             ),
         )
-    actions = crud.get_user_actions(
-        db, user_id=user_id, sort=sort, limit=limit,
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=WRONG_QUERY_ARGUMENTS_MSG.format(query_arg="cursor"),
+            )
+    max_limit = api_settings.actions_max_limit
+    if limit == 0 or limit > max_limit:
+        limit = max_limit
+    actions = await run_blocking(
+        crud.get_user_actions,
+        db,
+        user_id=user_id,
+        sort=sort,
+        limit=limit,
+        after=after,
+        rows=True,
     )
+    headers = {}
+    if len(actions) == limit:
+        next_cursor = encode_cursor(actions[-1].timestamp, actions[-1].id)
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = (
+            f'</users/{user_id}/actions?sort={sort}&limit={limit}'
+            f'&cursor={next_cursor}>; rel="next"'
+        )
 
     # register actions query
     order = {"asc": "ascending", "desc": "descending"}
-    lim = f"{'unlimited' if limit == 0 else ('limited to ' + str(limit))}"
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
+        db,
+        schemas.ActionCreate(
+            **{
+                "title": (
+                    f"Queried actions in {order[sort]} sorting "
+                    f"(limited to {limit})"
+                ),
+            },
+        ),
+        user_id,
+    )
+    # the rows are serialized as `schemas.Action`, without the models
+    return actions_response(actions, headers=headers)
+
+
+@app.get(
+    "/users/{user_id}/actions/export",
+    tags=["Users (private)"],
+    summary="Export actions",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {
+            media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()
+        }},
+    },
+)
+async def export_actions(
+    user_id: int,
+    export_format: Literal["ndjson", "csv"] = Query(
+        "ndjson",
+        alias="format",
+        description=(
+            "The format of the exported actions. It should be one of:\n\n"
+            "- `ndjson`: one JSON object per line\n"
+            "- `csv`: comma separated values, with a header\n"
+        ),
+    ),
+    db: Session = Depends(get_read_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
+):
+    """
+    A `GET` call to export all the user actions, sorted from the oldest to the
+    newest. The actions are streamed while they are read from the database,
+    so the memory used by the server doesn't depend on the number of actions.
+    """
+    assert check_user_id(current_user.id, user_id, "actions") is True
+
+    # register the export before we start streaming the actions
+    await run_blocking(
+        get_audit_writer().record,
         db,
         schemas.ActionCreate(
-            **{"title": f"Queried actions in {order[sort]} sorting ({lim})"},
+            **{"title": f"Exported actions ({export_format})"},
         ),
         user_id,
     )
-    return actions
+    chunk_size = api_settings.export_chunk_size
+    rows = crud.iter_user_actions(db, user_id, chunk_size=chunk_size)
+    return StreamingResponse(
+        stream_actions(rows, export_format, chunk_size=chunk_size),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="actions-{user_id}.{export_format}"'
+            ),
+        },
+    )
 
 
 @app.get(
@@ -341,20 +904,189 @@ async def read_actions(
 )
 async def read_last_actions(
     user_id: int,
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user),
+    db: Session = Depends(get_read_db),
+    current_user: schemas.UserProfile = Depends(get_current_user),
 ):
     """A `GET` call to query latest action of each kind."""
     assert check_user_id(current_user.id, user_id, "last actions") is True
 
-    last_actions = crud.get_latest_user_actions(
-        db, user_id=user_id,
+    last_actions = await run_blocking(
+        crud.get_latest_user_actions, db, user_id=user_id, rows=True,
     )
 
     # register last actions query
-    crud.create_user_action(
+    await run_blocking(
+        get_audit_writer().record,
         db,
-        schemas.ActionCreate(**{"title": f"Queried last actions"}),
+        schemas.ActionCreate(**{"title": "Queried last actions"}),
         user_id,
     )
-    return last_actions
+    return actions_response(last_actions)
+
+
+@admin_router.get("/hashing", summary="Hashing pool metrics")
+async def read_hashing_pool_stats():
+    """
+    A `GET` call that returns the metrics of the password hashing pool:
+
+    - **pending**: number of hashing operations queued or running
+    - **peak_pending**: the maximum value reached by `pending`
+    - **completed**: number of finished hashing operations
+    - **rejected**: number of operations rejected because the pool was full
+    - **latency_avg**/**latency_max**: time spent by an operation (seconds)
+    """
+    return get_hashing_pool().stats()
+
+
+@admin_router.get("/audit", summary="Audit writer metrics")
+async def read_audit_writer_stats():
+    """
+    A `GET` call that returns the metrics of the user actions writer:
+
+    - **mode**: `batched` or `durable`
+    - **queued**: number of actions waiting to be written
+    - **written**: number of actions written in bulk
+    - **batches**: number of bulk inserts performed
+    - **fallbacks**: actions written synchronously because the queue was full
+    """
+    return get_audit_writer().stats()
+
+
+@admin_router.get("/cache", summary="Cache metrics")
+async def read_cache_stats():
+    """
+    A `GET` call that returns the metrics of the cache, for each namespace
+    (`users` and `histograms`):
+
+    - **backend**: `memory`, `sqlite` or `redis`
+    - **ttl**: time (seconds) a value is cached for
+    - **hits**/**misses**: lookups served from the cache or the database
+    - **errors**: backend errors (handled as misses)
+    - **hit_ratio**: `hits / (hits + misses)`
+    """
+    return {
+        "users": get_user_cache().stats(),
+        "histograms": get_histogram_cache().stats(),
+    }
+
+
+@admin_router.get("/revocations", summary="Revoked tokens metrics")
+async def read_revocation_stats():
+    """
+    A `GET` call that returns the metrics of the revoked access tokens:
+
+    - **tokens**: number of revoked tokens (by `jti`)
+    - **users**: number of users whose previous tokens are revoked
+    - **loaded**: number of revocations loaded from the database
+    - **sync_interval**: time (seconds) between each load
+    """
+    return get_revocation_list().stats()
+
+
+@admin_router.get("/timings", summary="Request timings")
+async def read_request_timings(reset: bool = False):
+    """
+    A `GET` call that returns the timings of the requests of each route
+    (averaged per request), since the server started (or the last `reset`):
+
+    - **time_avg**/**time_max**: time spent by a request (seconds)
+    - **queries_avg**/**queries_max**: number of SQL queries of a request
+    - **sql_time_avg**: time spent running SQL queries (seconds)
+    - **phases_avg**: time spent in each phase (seconds): decoding the token
+      (`jwt`), looking up the user (`user`), hashing passwords (`bcrypt`),
+      registering the action (`audit`) and serializing the response
+      (`serialize`)
+
+    It also returns the latest queries slower than `slow_query_threshold`.
+    """
+    report = get_timing_report().report()
+    if reset:
+        get_timing_report().reset()
+    return report
+
+
+@admin_router.get(
+    "/profile", summary="CPU profile", response_class=PlainTextResponse,
+)
+async def read_profile(
+        seconds: float = Query(
+            5.0, gt=0, le=api_settings.profile_max_seconds,
+        ),
+        include_idle: bool = False,
+):
+    """
+    A `GET` call that samples the stacks of every thread of the worker for
+    some `seconds`, returning how many times each stack has been seen, in
+    the collapsed format of flame graphs (e.g. `flamegraph.pl`, speedscope).
+    The threads waiting for work are skipped, unless `include_idle`.
+    """
+    try:
+        sampler = get_profiler().start(include_idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stacks = get_profiler().stop(sampler)
+    return format_collapsed(stacks)
+
+
+@admin_router.get("/deletions", summary="Users' actions removals")
+async def read_user_deletions(
+        include_finished: bool = False, db: Session = Depends(get_db),
+):
+    """
+    A `GET` call that returns the progress of the background removals of
+    the actions of the removed users (the pending ones, unless
+    `include_finished` is set), and the metrics of this worker:
+
+    - **running**: whether the background worker is running
+    - **users**: number of users whose removal has been finished
+    - **removed**: number of actions removed
+    """
+    deletions = await run_blocking(
+        crud.get_user_deletions, db, include_finished,
+    )
+    return {
+        **get_deletion_worker().stats(),
+        "deletions": [
+            {
+                "user_id": deletion.user_id,
+                "username": deletion.username,
+                "total": deletion.total,
+                "removed": deletion.removed,
+                "created_at": deletion.created_at,
+                "finished_at": deletion.finished_at,
+            }
+            for deletion in deletions
+        ],
+    }
+
+
+async def read_metrics():
+    """
+    A `GET` call that returns the metrics of the server (of all its workers,
+    if `metrics_dir` is set) in the Prometheus text format.
+    """
+    metrics = await run_blocking(registry.expose)
+    return Response(metrics, media_type=CONTENT_TYPE)
+
+
+if api_settings.metrics_enabled:
+    app.add_api_route("/metrics", read_metrics, include_in_schema=False)
+if api_settings.include_admin_routes:
+    app.include_router(
+        admin_router,
+        prefix="/admin",
+        tags=["Admin"],
+        dependencies=(
+            [] if api_settings.disable_superuser_dependency
+            else [Depends(get_current_superuser)]
+        ),
+    )
+    # the requests sent with `X-Profile: 1` (by a superuser) are profiled
+    app.add_middleware(
+        ProfilingMiddleware,
+        profiler=get_profiler(),
+        authorize=is_superuser_request,
+    )
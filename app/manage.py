@@ -0,0 +1,148 @@
+"""
+Maintenance commands for the user-service database. Run with:
+
+    PYTHONPATH=. python -m app.manage --help
+"""
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from app import migrations, retention
+from app.api import crud
+from app.api.config import get_api_settings
+from app.database import SessionLocal, engine
+
+log = logging.getLogger("api")
+
+
+def rebuild_histograms(args: argparse.Namespace) -> int:
+    """Recompute the histogram aggregates from the `actions` table."""
+    db = SessionLocal()
+    try:
+        counts = crud.rebuild_action_counts(db)
+        buckets = crud.rebuild_action_rollups(db)
+    finally:
+        db.close()
+    print(f"Rebuilt action counts: {len(counts)} types of actions")
+    print(f"Rebuilt action rollups: {buckets} buckets")
+    return 0
+
+
+def rebuild_last_actions(args: argparse.Namespace) -> int:
+    """Recompute the latest action of each kind from the `actions` table."""
+    db = SessionLocal()
+    try:
+        rows = crud.rebuild_last_actions(db)
+    finally:
+        db.close()
+    print(f"Rebuilt last actions: {rows} rows")
+    return 0
+
+
+def migrate(args: argparse.Namespace) -> int:
+    """Upgrade an existing SQLite database to the current schema."""
+    migrated = migrations.migrate(engine, batch_size=args.batch_size)
+    print(f"Database migrated: {migrated} rows updated")
+    return 0
+
+
+def archive_actions(args: argparse.Namespace) -> int:
+    """
+    Remove the actions older than the retention period from the database,
+    archiving them (one compressed file per month) unless `--drop` is set.
+    """
+    if args.months <= 0:
+        print("No retention period set (see --months)")
+        return 1
+    db = SessionLocal()
+    try:
+        archived = retention.apply_retention(
+            db,
+            args.months,
+            None if args.drop else Path(args.archive_dir),
+            batch_size=args.batch_size,
+        )
+    finally:
+        db.close()
+    for month in archived:
+        print(
+            f"{month['month']}: {month['rows']} actions "
+            f"{'dropped' if args.drop else 'archived'}"
+        )
+    print(f"Archived {len(archived)} months of actions")
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Build the command line parser for our maintenance commands."""
+    parser = argparse.ArgumentParser(
+        prog="python -m app.manage",
+        description="Maintenance commands for the user-service database.",
+    )
+    subparsers = parser.add_subparsers(title="commands", dest="command")
+    rebuild = subparsers.add_parser(
+        "rebuild-histograms",
+        help="Recompute the histogram aggregates from the actions table.",
+    )
+    rebuild.set_defaults(func=rebuild_histograms)
+    rebuild_last = subparsers.add_parser(
+        "rebuild-last-actions",
+        help="Recompute the latest action of each kind for every user.",
+    )
+    rebuild_last.set_defaults(func=rebuild_last_actions)
+    migrate_parser = subparsers.add_parser(
+        "migrate",
+        help="Upgrade an existing SQLite database to the current schema.",
+    )
+    migrate_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of rows updated per transaction.",
+    )
+    migrate_parser.set_defaults(func=migrate)
+    api_settings = get_api_settings()
+    archive = subparsers.add_parser(
+        "archive-actions",
+        help="Archive the actions older than the retention period.",
+    )
+    archive.add_argument(
+        "--months",
+        type=int,
+        default=api_settings.actions_retention_months,
+        help="Number of months kept, besides the current one.",
+    )
+    archive.add_argument(
+        "--archive-dir",
+        default=api_settings.actions_archive_dir,
+        help="Directory where the archived months are stored.",
+    )
+    archive.add_argument(
+        "--drop",
+        action="store_true",
+        help="Remove the actions without archiving them.",
+    )
+    archive.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of actions removed per transaction.",
+    )
+    archive.set_defaults(func=archive_actions)
+    return parser
+
+
+def main(argv=None) -> int:
+    """Entry point of the maintenance commands."""
+    logging.basicConfig(level=logging.INFO)
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
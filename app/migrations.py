@@ -0,0 +1,110 @@
+"""
+Migrations for existing SQLite databases. New databases are created with the
+current schema (see `app.database`), so they only need the migrations to mark
+them as up to date. The schema version is stored in `PRAGMA user_version`.
+"""
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from app.api import crud
+from app.api.utils import TIMESTAMP_FORMAT
+
+log = logging.getLogger("api")
+
+SCHEMA_VERSION = 2
+# The format used by SQLAlchemy to store a `DateTime` into SQLite
+SQLITE_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def get_schema_version(connection: Connection) -> int:
+    """Return the schema version of a SQLite database."""
+    return connection.execute("PRAGMA user_version").scalar()
+
+
+def _legacy_timestamp_to_utc(timestamp: str) -> str:
+    """
+    Convert a timestamp stored by previous versions (a string in the server's
+    local time) to an UTC datetime, in the format used by SQLAlchemy.
+    """
+    local_time = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    utc_time = local_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return utc_time.strftime(SQLITE_DATETIME_FORMAT)
+
+
+def migrate_actions_timestamps(
+        connection: Connection, batch_size: int = 10000,
+) -> int:
+    """
+    Convert the timestamps of the `actions` table to UTC datetimes and create
+    the composite indexes. The rows are converted in batches, each one in its
+    own transaction, so the server can keep registering actions while the
+    migration is running. Returns the number of converted rows.
+    """
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_actions_owner_id_timestamp "
+        "ON actions (owner_id, timestamp)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_actions_title_timestamp "
+        "ON actions (title, timestamp)"
+    )
+    # replaced by `ix_actions_title_timestamp`
+    connection.execute("DROP INDEX IF EXISTS ix_actions_title")
+
+    converted = 0
+    last_id = 0
+    while True:
+        # the timestamps stored by previous versions don't have microseconds
+        rows = connection.execute(
+            "SELECT id, timestamp FROM actions "
+            "WHERE id > ? AND length(timestamp) = 19 ORDER BY id LIMIT ?",
+            last_id,
+            batch_size,
+        ).fetchall()
+        if not rows:
+            break
+        with connection.begin():
+            connection.execute(
+                "UPDATE actions SET timestamp = ? WHERE id = ?",
+                [(_legacy_timestamp_to_utc(ts), pk) for pk, ts in rows],
+            )
+        converted += len(rows)
+        last_id = rows[-1][0]
+        log.info(f"Converted {converted} timestamps of the actions table")
+    return converted
+
+
+def migrate(engine: Engine, batch_size: int = 10000) -> int:
+    """
+    Upgrade a SQLite database to the current schema. Returns the number of
+    migrated rows.
+    """
+    if engine.dialect.name != "sqlite":
+        log.info("Only SQLite databases need to be migrated")
+        return 0
+
+    with engine.connect() as connection:
+        version = get_schema_version(connection)
+        if version >= SCHEMA_VERSION:
+            log.info(f"Database already at schema version {version}")
+            return 0
+        migrated = 0
+        db = Session(bind=connection)
+        try:
+            if version < 1:
+                migrated += migrate_actions_timestamps(connection, batch_size)
+                # the `action_counts` table didn't exist, and the rollups were
+                # stored with the previous timestamps
+                crud.rebuild_action_counts(db)
+                crud.rebuild_action_rollups(db)
+            if version < 2:
+                # the `last_actions` table has been added in version 2
+                crud.rebuild_last_actions(db)
+        finally:
+            db.close()
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    log.info(f"Database migrated to schema version {SCHEMA_VERSION}")
+    return migrated
@@ -0,0 +1,114 @@
+"""
+Retention policy of the user actions. The actions stay in a single `actions`
+table (it isn't partitioned): every month older than the retention period is
+archived, appending its rows as NDJSON to a compressed file per month
+(`actions-<year>-<month>.ndjson.gz`, unless there is no archive directory),
+and then its rows are deleted in batches, so the queries (and the indexes)
+only cover the recent actions. The archived actions are restored by loading
+those files back into the `actions` table.
+"""
+import gzip
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.api import crud, models
+from app.api.export import serialize_ndjson
+
+log = logging.getLogger("api")
+
+
+def month_start(value: datetime) -> datetime:
+    """Return the start of the month of `value`."""
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    """Add (or subtract) a number of months to the start of a month."""
+    month = value.year * 12 + value.month - 1 + months
+    return value.replace(year=month // 12, month=month % 12 + 1)
+
+
+def get_retention_cutoff(months: int, now: datetime = None) -> datetime:
+    """
+    Return the start of the oldest month kept by the retention policy: the
+    current month and the previous `months` ones.
+    """
+    return add_months(month_start(now or datetime.utcnow()), -months)
+
+
+def archive_month(
+        db: Session,
+        start: datetime,
+        archive_dir: Optional[Path],
+        batch_size: int = 10000,
+) -> dict:
+    """
+    Remove the actions of the month starting at `start` from the database,
+    appending them to `actions-<year>-<month>.ndjson.gz` within `archive_dir`
+    (if set, otherwise they are dropped).
+    """
+    month = start.strftime("%Y-%m")
+    path = None
+    archive = None
+
+    def write(rows: List[tuple]):
+        nonlocal archive
+        if archive is None:
+            archive_dir.mkdir(parents=True, exist_ok=True)
+            # appending a new gzip member keeps the file valid
+            archive = gzip.open(path, "at", encoding="utf-8")
+        archive.write(serialize_ndjson(rows))
+        # the rows should be archived before removing them
+        archive.flush()
+
+    if archive_dir is not None:
+        path = Path(archive_dir, f"actions-{month}.ndjson.gz")
+    try:
+        rows = crud.archive_actions(
+            db,
+            start,
+            add_months(start, 1),
+            write=write if path else None,
+            batch_size=batch_size,
+        )
+    finally:
+        if archive is not None:
+            archive.close()
+    if rows:
+        crud.register_action_archive(
+            db, month, rows, str(path) if path else None,
+        )
+        log.info(f"Archived {rows} actions of {month} into {path}")
+    return {"month": month, "rows": rows, "path": str(path) if path else None}
+
+
+def apply_retention(
+        db: Session,
+        months: int,
+        archive_dir: Optional[Path],
+        batch_size: int = 10000,
+        now: datetime = None,
+) -> List[dict]:
+    """
+    Archive (or drop if `archive_dir` is not set) every month of actions
+    older than the latest `months`. Returns the archived months.
+    """
+    if months <= 0:
+        return []
+    cutoff = get_retention_cutoff(months, now)
+    oldest = (
+        db.query(func.min(models.Action.timestamp))
+        .filter(models.Action.timestamp < cutoff)
+        .scalar()
+    )
+    archived = []
+    start = month_start(oldest) if oldest else cutoff
+    while start < cutoff:
+        archived.append(archive_month(db, start, archive_dir, batch_size))
+        start = add_months(start, 1)
+    return archived
@@ -0,0 +1,132 @@
+"""
+Measure the throughput (requests per second) of an authenticated call
+(`GET /users/{user_id}`), resolving the current user:
+
+- `baseline`: decoding the token and looking up the user in every call
+- `user-cache`: decoding the token, the user is cached
+- `token-cache`: the decoded token and the user are cached
+- `embedded-user`: the decoded token is cached and it includes the user
+
+Run with:
+
+    PYTHONPATH=. python -m benchmarks.auth --requests 5000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+# register the login within the request, there is no audit writer running
+os.environ.setdefault("AUDIT_MODE", "durable")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app import main as service  # noqa: E402
+from app.api import cache, crud, schemas  # noqa: E402
+from app.api.models import Base  # noqa: E402
+from tests.asgi import asgi_request  # noqa: E402
+
+LOGIN_DATA = {"username": "benchmark", "password": "benchmark"}
+
+
+def setup_database(path: Path) -> int:
+    """Create a database with our user, returning its id."""
+    engine = create_engine(
+        f"sqlite:///{path}", connect_args={"check_same_thread": False},
+    )
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(
+        autocommit=False, autoflush=False, bind=engine,
+    )
+
+    def get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    service.app.dependency_overrides[service.get_db] = get_db
+    db = session_factory()
+    try:
+        return crud.create_user(db, schemas.UserCreate(**LOGIN_DATA)).id
+    finally:
+        db.close()
+
+
+def configure(scenario: str) -> None:
+    """Enable the caches used by `scenario` (and start them empty)."""
+    cache._token_cache = cache.MemoryBackend(
+        0 if scenario in ("baseline", "user-cache") else 10000
+    )
+    cache._backend = cache.MemoryBackend()
+    cache._caches.clear()
+    cache.get_user_cache().ttl = 0 if scenario == "baseline" else 30
+    service.api_settings.token_embed_user = scenario == "embedded-user"
+
+
+async def measure(user_id: int, requests: int, concurrency: int) -> dict:
+    """Run `requests` calls (`concurrency` at once) with a new token."""
+    status, body, _ = await asgi_request(
+        service.app, "POST", "/authenticate", data=LOGIN_DATA,
+    )
+    assert status == 200, body
+    token = json.loads(body)["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with semaphore:
+            status, body, _ = await asgi_request(
+                service.app, "GET", f"/users/{user_id}", headers=headers,
+            )
+            assert status == 200, body
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(requests / elapsed, 1),
+    }
+
+
+async def run(requests: int, concurrency: int, scenarios) -> list:
+    """Run the benchmark for each scenario."""
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        user_id = setup_database(Path(data_dir, "auth.db"))
+        try:
+            for scenario in scenarios:
+                configure(scenario)
+                result = await measure(user_id, requests, concurrency)
+                result["scenario"] = scenario
+                results.append(result)
+                print(json.dumps(result))
+        finally:
+            service.app.dependency_overrides.clear()
+            service.shutdown_blocking_pool()
+            service.shutdown_hashing_pool()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.auth")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=["baseline", "user-cache", "token-cache", "embedded-user"],
+    )
+    args = parser.parse_args(argv)
+    asyncio.run(run(args.requests, args.concurrency, args.scenarios))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Fixtures of the micro-benchmarks of the `crud` functions, run with:
+
+    PYTHONPATH=. pytest benchmarks --benchmark-autosave
+
+Then, compare them with the previous runs via `--benchmark-compare`. The size
+of the seeded database is set via `BENCHMARK_USERS` and `BENCHMARK_ACTIONS`.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.seed import seed_database
+
+USERS = int(os.getenv("BENCHMARK_USERS", 100))
+ACTIONS = int(os.getenv("BENCHMARK_ACTIONS", 100000))
+
+
+@pytest.fixture(scope="session")
+def session_factory(tmp_path_factory):
+    """A session factory bound to a seeded database."""
+    path = tmp_path_factory.mktemp("benchmarks") / "seed.db"
+    seed_database(path, USERS, ACTIONS)
+    engine = create_engine(f"sqlite:///{path}")
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    yield db
+    db.close()
@@ -0,0 +1,107 @@
+"""
+Compare the previous implementation of the period histogram (which loaded
+every `Action` as an ORM object and aggregated them in Python) with the
+current one (`crud.get_users_periods_histogram`), in wall time and peak
+memory (python allocations, measured with `tracemalloc`). Run with:
+
+    PYTHONPATH=. python -m benchmarks.histogram --sizes 10000 1000000 10000000
+
+The seeded databases are kept in `--data-dir`, so they can be reused.
+"""
+import argparse
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api import crud, models
+from benchmarks.seed import seed_database
+
+
+def legacy_periods_histogram(db, period_time: str = "") -> dict:
+    """The implementation of the period histogram before the rewrite."""
+    if period_time == "":
+        all_actions = db.query(models.Action).all()
+    else:
+        all_actions = db.query(models.Action).filter(
+            models.Action.timestamp > crud.get_period_start(period_time)
+        ).all()
+    histogram = {}
+    for row in all_actions:
+        title = row.title
+        dt = row.timestamp
+        if row.title in histogram:
+            histogram[title]["timestamps"].append(dt)
+            histogram[title]["size"] += 1
+            continue
+        histogram[title] = {"timestamps": [dt], "size": 1}
+    for key, data in histogram.items():
+        histogram[key]["min"] = data["timestamps"][0]
+        histogram[key]["max"] = data["timestamps"][-1]
+    return histogram
+
+
+def measure(func, *args, **kwargs) -> dict:
+    """Run `func` returning its wall time (seconds) and peak memory (MiB)."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(elapsed, 4), "peak_mib": round(peak / 2**20, 2)}
+
+
+def run(sizes, data_dir: Path, period_time: str) -> list:
+    """Run the benchmarks for each database size."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    for size in sizes:
+        path = data_dir / f"actions-{size}.db"
+        seed_database(path, actions=size)
+        engine = create_engine(f"sqlite:///{path}")
+        db = sessionmaker(bind=engine)()
+        implementations = {
+            "legacy": (legacy_periods_histogram, {}),
+            "timestamps": (crud.get_users_periods_histogram, {}),
+            "summary": (
+                crud.get_users_periods_histogram,
+                {"include_timestamps": False},
+            ),
+        }
+        for name, (func, kwargs) in implementations.items():
+            result = measure(func, db, period_time, **kwargs)
+            result.update({"rows": size, "implementation": name})
+            results.append(result)
+            print(json.dumps(result))
+            db.expunge_all()
+        db.close()
+        engine.dispose()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.histogram")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000],
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir(), "user-service-benchmarks"),
+    )
+    parser.add_argument(
+        "--period-time", default="", choices=["", "hour", "day", "month"],
+    )
+    args = parser.parse_args(argv)
+    run(args.sizes, args.data_dir, args.period_time)
+
+
+if __name__ == "__main__":
+    main()
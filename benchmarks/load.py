@@ -0,0 +1,285 @@
+"""
+Measure the throughput and the latency percentiles of every route of the
+API, with an in-process ASGI load generator (no network involved), against
+a seeded database (see `benchmarks.seed`). Each route is called `--requests`
+times (`--slow-requests` for the routes which hash passwords or read all
+the actions), `--concurrency` calls at once, by random seeded users. The
+routes which modify an user (e.g. removing it) are called by users created
+for them, so the seeded data is preserved. Run with:
+
+    PYTHONPATH=. python -m benchmarks.load --users 1000 --actions 1000000 \\
+        --concurrency 32 --output load.json
+
+The seeded databases are kept in `--data-dir`, so they can be reused.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from statistics import mean
+from typing import Dict, List, NamedTuple, Optional
+
+from app.api import security
+from app.api.config import APISettings
+from tests.asgi import asgi_request, percentile
+from benchmarks.seed import (
+    PASSWORD,
+    get_username,
+    insert_users,
+    seed_database,
+)
+
+
+class Scenario(NamedTuple):
+    """
+    A route to measure. The `path`, `data` and `json` values are formatted
+    with the `user_id`, `username`, the number of the request (`i`) and the
+    id of the benchmark run (`run_id`).
+    """
+    name: str
+    method: str
+    path: str
+    authenticated: bool = True
+    slow: bool = False
+    # each call is performed by a new user, with its own token
+    new_users: bool = False
+    data: Optional[Dict[str, str]] = None
+    json: Optional[Dict[str, str]] = None
+
+
+SCENARIOS = [
+    Scenario("root", "GET", "/", authenticated=False),
+    Scenario(
+        "authenticate",
+        "POST",
+        "/authenticate",
+        authenticated=False,
+        slow=True,
+        data={"username": "{username}", "password": PASSWORD},
+    ),
+    Scenario(
+        "create_user",
+        "POST",
+        "/users/",
+        authenticated=False,
+        slow=True,
+        json={"username": "{username}-{run_id}-{i}", "password": PASSWORD},
+    ),
+    Scenario("read_user", "GET", "/users/{user_id}"),
+    Scenario(
+        "read_user_with_actions", "GET", "/users/{user_id}?include=actions",
+    ),
+    Scenario("read_actions", "GET", "/users/{user_id}/actions"),
+    Scenario("read_actions_max", "GET", "/users/{user_id}/actions?limit=0"),
+    Scenario(
+        "export_actions",
+        "GET",
+        "/users/{user_id}/actions/export?format=ndjson",
+        slow=True,
+    ),
+    Scenario("last_actions", "GET", "/users/{user_id}/last_actions"),
+    Scenario("histogram_types", "GET", "/users/histogram-types"),
+    Scenario(
+        "histogram_period",
+        "GET",
+        "/users/histogram-period?period_time=day",
+        slow=True,
+    ),
+    Scenario(
+        "histogram_period_summary",
+        "GET",
+        "/users/histogram-period?period_time=day&mode=summary",
+        slow=True,
+    ),
+    Scenario(
+        "histogram_period_buckets",
+        "GET",
+        "/users/histogram-period?period_time=day&mode=buckets",
+    ),
+    Scenario(
+        "change_password",
+        "PUT",
+        f"/users/{{user_id}}/password?new_password={PASSWORD}",
+        slow=True,
+        new_users=True,
+    ),
+    Scenario("logout", "POST", "/logout", new_users=True),
+    Scenario("delete_user", "DELETE", "/users/{user_id}", new_users=True),
+]
+
+
+def create_users(path: Path, prefix: str, number: int) -> List[tuple]:
+    """Create `number` users, returning their ids and usernames."""
+    connection = sqlite3.connect(str(path))
+    try:
+        hashed_password = connection.execute(
+            "SELECT hashed_password FROM users WHERE username = ?",
+            (get_username(1),),
+        ).fetchone()[0]
+        usernames = [f"{prefix}-{i}" for i in range(number)]
+        insert_users(connection, usernames, hashed_password)
+        return connection.execute(
+            "SELECT id, username FROM users WHERE username LIKE ?",
+            (f"{prefix}-%",),
+        ).fetchall()
+    finally:
+        connection.close()
+
+
+def build_requests(
+        scenario: Scenario, users: List[tuple], number: int, run_id: str,
+) -> List[dict]:
+    """Return the arguments of `number` calls to the `scenario` route."""
+    requests = []
+    tokens = {}
+    for i in range(number):
+        user_id, username = users[i] if scenario.new_users else (
+            random.choice(users)
+        )
+        values = {
+            "user_id": user_id,
+            "username": username,
+            "i": i,
+            "run_id": run_id,
+        }
+        request = {
+            "method": scenario.method,
+            "path": scenario.path.format(**values),
+        }
+        for body in ("data", "json"):
+            if getattr(scenario, body) is not None:
+                request[body] = {
+                    k: v.format(**values)
+                    for k, v in getattr(scenario, body).items()
+                }
+        if scenario.authenticated:
+            if username not in tokens:
+                token = security.create_access_token(data={"sub": username})
+                # pyjwt < 2 returns the token encoded
+                if isinstance(token, bytes):
+                    token = token.decode()
+                tokens[username] = token
+            request["headers"] = {
+                "Authorization": f"Bearer {tokens[username]}",
+            }
+        requests.append(request)
+    return requests
+
+
+async def measure(app, requests: List[dict], concurrency: int) -> dict:
+    """Run the `requests` (`concurrency` at once), returning its metrics."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = Counter()
+
+    async def call(request):
+        async with semaphore:
+            status, _, elapsed = await asgi_request(app, **request)
+        latencies.append(elapsed)
+        statuses[status] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call(request) for request in requests))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(requests),
+        "errors": len(requests) - statuses[200],
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(len(requests) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(mean(latencies) * 1000, 3),
+            **{
+                f"p{pct}": round(percentile(latencies, pct) * 1000, 3)
+                for pct in (50, 90, 95, 99)
+            },
+            "max": round(max(latencies) * 1000, 3),
+        },
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Seed the database and run the benchmark for each scenario."""
+    path = args.data_dir / f"load-{args.users}-{args.actions}.db"
+    # the app (and its background writers) must use the seeded database, so
+    # it's set before the settings are loaded (and the app is imported)
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    seed_database(path, args.users, args.actions)
+    from app import main as service
+
+    run_id = uuid.uuid4().hex[:8]
+    users = [(i, get_username(i)) for i in range(1, args.users + 1)]
+    results = []
+    try:
+        for scenario in SCENARIOS:
+            if args.scenarios and scenario.name not in args.scenarios:
+                continue
+            number = args.slow_requests if scenario.slow else args.requests
+            scenario_users = users
+            if scenario.new_users:
+                scenario_users = create_users(
+                    path, f"{scenario.name}-{run_id}", number,
+                )
+            requests = build_requests(
+                scenario, scenario_users, number, run_id,
+            )
+            result = await measure(service.app, requests, args.concurrency)
+            result = {"route": scenario.name, **result}
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        service.stop_audit_writer()
+        service.shutdown_blocking_pool()
+        service.shutdown_hashing_pool()
+    return {
+        "users": args.users,
+        "actions": args.actions,
+        "concurrency": args.concurrency,
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--actions", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--slow-requests", type=int, default=100)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        # more calls than threads in our pool, so they have to wait for them
+        # (the settings are read, but not loaded, see `run`)
+        default=2 * APISettings().blocking_pool_size,
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="the routes to measure (all of them by default)",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir(), "user-service-benchmarks"),
+    )
+    parser.add_argument(
+        "--output", type=Path, help="write the results into a JSON file",
+    )
+    args = parser.parse_args(argv)
+    report = asyncio.run(run(args))
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
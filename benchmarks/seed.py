@@ -0,0 +1,115 @@
+"""
+Seed a SQLite database with `--users` users (`user1`, `user2`... all of
+them with the password `benchmark`) and `--actions` random actions, spread
+over the last `--days` days, with its aggregated data (histograms and last
+actions) up to date. Run with:
+
+    PYTHONPATH=. python -m benchmarks.seed --users 1000 --actions 10000000 \\
+        --path /tmp/user-service-benchmarks/seed.db
+
+An existing database is not seeded again, so it can be reused between runs.
+"""
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api import crud, hashing
+from app.api.models import Base
+from app.migrations import SQLITE_DATETIME_FORMAT
+
+PASSWORD = "benchmark"
+TITLES = [f"Action {i}" for i in range(20)]
+
+
+def get_username(user_id: int) -> str:
+    """Return the username of a seeded user."""
+    return f"user{user_id}"
+
+
+def insert_users(
+        connection: sqlite3.Connection,
+        usernames: Iterable[str],
+        hashed_password: str,
+):
+    """Insert the users (all of them with the same password) at once."""
+    connection.executemany(
+        "INSERT INTO users (username, hashed_password, is_active) "
+        "VALUES (?, ?, 1)",
+        ((username, hashed_password) for username in usernames),
+    )
+    connection.commit()
+
+
+def seed_database(
+        path: Path, users: int = 1000, actions: int = 100000, days: int = 60,
+) -> bool:
+    """
+    Create a database with `users` users and `actions` random actions (if it
+    doesn't exist). Returns whether the database has been seeded.
+    """
+    if path.exists():
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+
+    connection = sqlite3.connect(str(path))
+    # a single (slow) hash for every user
+    hashed_password = hashing.get_password_hash(PASSWORD)
+    insert_users(
+        connection,
+        (get_username(i) for i in range(1, users + 1)),
+        hashed_password,
+    )
+    start = datetime.utcnow() - timedelta(days=days)
+    step = timedelta(days=days) / max(actions, 1)
+    rows = (
+        (
+            random.choice(TITLES),
+            (start + step * i).strftime(SQLITE_DATETIME_FORMAT),
+            random.randint(1, users),
+        )
+        for i in range(actions)
+    )
+    connection.executemany(
+        "INSERT INTO actions (title, timestamp, owner_id) VALUES (?, ?, ?)",
+        rows,
+    )
+    connection.commit()
+    connection.close()
+
+    db = sessionmaker(bind=engine)()
+    try:
+        crud.rebuild_action_counts(db)
+        crud.rebuild_action_rollups(db)
+        crud.rebuild_last_actions(db)
+    finally:
+        db.close()
+        engine.dispose()
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.seed")
+    parser.add_argument("--path", type=Path, required=True)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--actions", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=60)
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    if seed_database(args.path, args.users, args.actions, args.days):
+        elapsed = time.perf_counter() - start
+        print(f"Seeded {args.path} in {elapsed:.1f} seconds")
+    else:
+        print(f"{args.path} already exists, it has not been seeded")
+
+
+if __name__ == "__main__":
+    main()
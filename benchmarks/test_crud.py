@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+from app.api import crud, models, schemas
+from benchmarks.seed import get_username
+
+pytest.importorskip("pytest_benchmark")
+
+
+def test_get_user(benchmark, db):
+    assert benchmark(crud.get_user, db, 1) is not None
+
+
+def test_get_user_by_username(benchmark, db):
+    assert benchmark(crud.get_user_by_username, db, get_username(1))
+
+
+def test_get_user_actions(benchmark, db):
+    assert benchmark(crud.get_user_actions, db, 1, limit=100)
+
+
+def test_get_user_actions_next_page(benchmark, db):
+    last_action = crud.get_user_actions(db, 1, limit=100)[-1]
+    after = (last_action.timestamp, last_action.id)
+    assert benchmark(crud.get_user_actions, db, 1, limit=100, after=after)
+
+
+def test_iter_user_actions(benchmark, db):
+    assert benchmark(lambda: sum(1 for _ in crud.iter_user_actions(db, 1)))
+
+
+def test_get_latest_user_actions(benchmark, db):
+    assert benchmark(crud.get_latest_user_actions, db, 1)
+
+
+def test_get_users_types_histogram(benchmark, db):
+    assert benchmark(crud.get_users_types_histogram, db)
+
+
+@pytest.mark.parametrize("include_timestamps", [True, False])
+def test_get_users_periods_histogram(benchmark, db, include_timestamps):
+    assert benchmark(
+        crud.get_users_periods_histogram,
+        db,
+        "day",
+        include_timestamps=include_timestamps,
+    )
+
+
+@pytest.mark.parametrize("granularity", ["minute", "hour", "day"])
+def test_get_users_periods_histogram_buckets(benchmark, db, granularity):
+    assert benchmark(
+        crud.get_users_periods_histogram_buckets, db, granularity,
+    )
+
+
+def test_create_user_action(benchmark, db):
+    action = schemas.ActionCreate(title="Benchmark")
+    assert benchmark(crud.create_user_action, db, action, 1)
+
+
+def test_create_user_actions(benchmark, db):
+    def create_actions():
+        crud.create_user_actions(db, [
+            {
+                "title": "Benchmark",
+                "owner_id": 1,
+                "timestamp": datetime.utcnow(),
+            }
+            for _ in range(100)
+        ])
+
+    benchmark(create_actions)
+
+
+def test_remove_user(benchmark, db):
+    def create_user():
+        now = datetime.utcnow()
+        user = models.User(username=f"removed-{now}")
+        db.add(user)
+        db.commit()
+        crud.create_user_actions(db, [
+            {"title": "Benchmark", "owner_id": user.id, "timestamp": now}
+            for _ in range(1000)
+        ])
+        return (db, user.id), {}
+
+    benchmark.pedantic(crud.remove_user, setup=create_user, rounds=10)
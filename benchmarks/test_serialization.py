@@ -0,0 +1,53 @@
+"""
+Micro-benchmarks of the serialization of 10k actions: the default path of
+FastAPI (a `schemas.Action` per row, `jsonable_encoder` and `json`) versus
+`app.api.responses` (the rows as dicts, encoded with `orjson`).
+"""
+import json
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from app.api import responses, schemas
+from benchmarks.seed import TITLES
+
+pytest.importorskip("pytest_benchmark")
+
+ACTIONS = 10000
+
+Row = namedtuple("Row", ["id", "title", "timestamp", "owner_id"])
+
+
+@pytest.fixture(scope="module")
+def rows():
+    start = datetime(2020, 5, 30)
+    return [
+        Row(i, random.choice(TITLES), start + timedelta(seconds=i), 1)
+        for i in range(1, ACTIONS + 1)
+    ]
+
+
+def serialize_with_models(rows):
+    actions = [schemas.Action.from_orm(row) for row in rows]
+    return json.dumps(
+        jsonable_encoder(actions),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def test_serialize_actions_with_models(benchmark, rows):
+    assert benchmark(serialize_with_models, rows)
+
+
+def test_serialize_actions(benchmark, rows):
+    def serialize(rows):
+        return responses.dumps(responses.serialize_actions(rows))
+
+    body = benchmark(serialize, rows)
+    assert body == serialize_with_models(rows)
@@ -0,0 +1,163 @@
+import time
+
+import pytest
+
+from app.api import audit, crud, models, schemas
+
+
+def count_actions(session_factory) -> int:
+    db = session_factory()
+    try:
+        return db.query(models.Action).count()
+    finally:
+        db.close()
+
+
+def add_user(session_factory, username: str) -> int:
+    db = session_factory()
+    try:
+        db_user = models.User(username=username, hashed_password="x")
+        db.add(db_user)
+        db.commit()
+        return db_user.id
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def user_id(session_factory) -> int:
+    return add_user(session_factory, "johndoe")
+
+
+def record_actions(writer, session_factory, number: int, user_id: int):
+    db = session_factory()
+    try:
+        for i in range(number):
+            writer.record(
+                db, schemas.ActionCreate(title=f"Action {i}"), user_id,
+            )
+    finally:
+        db.close()
+
+
+def test_durable_mode(session_factory, user_id):
+    writer = audit.AuditWriter(session_factory, mode="durable")
+    record_actions(writer, session_factory, 3, user_id)
+    assert count_actions(session_factory) == 3
+    assert writer.stats()["queued"] == 0
+
+
+def test_batched_mode_flush_on_size(session_factory, user_id):
+    writer = audit.AuditWriter(
+        session_factory, mode="batched", batch_size=5, flush_interval=60,
+    )
+    try:
+        record_actions(writer, session_factory, 4, user_id)
+        time.sleep(0.2)
+        assert count_actions(session_factory) == 0
+
+        record_actions(writer, session_factory, 1, user_id)
+        deadline = time.monotonic() + 5
+        while count_actions(session_factory) < 5:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        writer.stop()
+    assert writer.stats()["batches"] == 1
+
+
+def test_batched_mode_flush_on_time(session_factory, user_id):
+    writer = audit.AuditWriter(
+        session_factory, mode="batched", batch_size=100, flush_interval=0.2,
+    )
+    try:
+        record_actions(writer, session_factory, 3, user_id)
+        deadline = time.monotonic() + 5
+        while count_actions(session_factory) < 3:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        writer.stop()
+
+
+def test_batched_mode_flush_on_stop(session_factory, user_id):
+    writer = audit.AuditWriter(
+        session_factory, mode="batched", batch_size=100, flush_interval=60,
+    )
+    record_actions(writer, session_factory, 10, user_id)
+    writer.stop()
+    assert count_actions(session_factory) == 10
+    assert writer.stats() == {
+        "mode": "batched",
+        "queued": 0,
+        "written": 10,
+        "batches": 1,
+        "fallbacks": 0,
+    }
+
+
+def test_batched_mode_backpressure(session_factory, user_id):
+    writer = audit.AuditWriter(
+        session_factory,
+        mode="batched",
+        batch_size=100,
+        flush_interval=60,
+        max_buffer=2,
+        enqueue_timeout=0.01,
+    )
+    record_actions(writer, session_factory, 5, user_id)
+    # the actions which didn't fit into the queue are written right away
+    assert count_actions(session_factory) == 3
+    assert writer.stats()["fallbacks"] == 3
+    writer.stop()
+    assert count_actions(session_factory) == 5
+
+
+def test_batched_mode_removed_user(session_factory):
+    writer = audit.AuditWriter(
+        session_factory, mode="batched", batch_size=100, flush_interval=60,
+    )
+    removed_user_id = add_user(session_factory, "removed")
+    user_id = add_user(session_factory, "johndoe")
+    record_actions(writer, session_factory, 2, removed_user_id)
+    record_actions(writer, session_factory, 3, user_id)
+    db = session_factory()
+    try:
+        crud.remove_user(db, removed_user_id)
+    finally:
+        db.close()
+
+    # the actions of the removed user are discarded, the rest are written
+    assert writer.flush() == 3
+    writer.stop()
+    db = session_factory()
+    try:
+        owners = {action.owner_id for action in db.query(models.Action)}
+    finally:
+        db.close()
+    assert owners == {user_id}
+    assert writer.stats()["written"] == 3
+
+
+def test_batched_mode_failing_action(session_factory, user_id, monkeypatch):
+    writer = audit.AuditWriter(
+        session_factory, mode="batched", batch_size=100, flush_interval=60,
+    )
+    record_actions(writer, session_factory, 3, user_id)
+    create_user_actions = crud.create_user_actions
+
+    def fail_on_action_1(db, actions):
+        if any(action["title"] == "Action 1" for action in actions):
+            raise RuntimeError("cannot write Action 1")
+        return create_user_actions(db, actions)
+
+    monkeypatch.setattr(crud, "create_user_actions", fail_on_action_1)
+    # only the failing action is lost, not the rest of its batch
+    assert writer.flush() == 2
+    writer.stop()
+    db = session_factory()
+    try:
+        titles = {action.title for action in db.query(models.Action)}
+    finally:
+        db.close()
+    assert titles == {"Action 0", "Action 2"}
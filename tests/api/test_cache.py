@@ -0,0 +1,225 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from app.api import cache
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """A stand-in for a Redis server, implementing the commands we use."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            command = self.read_command()
+            if command is None:
+                break
+            name, args = command[0].upper(), command[1:]
+            with self.server.lock:
+                key = args[0] if args else None
+                value, expires_at = data.get(key, (None, None))
+                if expires_at is not None and expires_at <= time.time():
+                    data.pop(key)
+                    value = None
+                if name == "GET":
+                    reply = value
+                elif name == "SET":
+                    expires_at = None
+                    if len(args) == 4 and args[2].upper() == "PX":
+                        expires_at = time.time() + int(args[3]) / 1000
+                    data[key] = (args[1], expires_at)
+                    reply = "+OK"
+                elif name == "DEL":
+                    reply = int(data.pop(key, None) is not None)
+                elif name == "INCR":
+                    reply = int(value or 0) + 1
+                    data[key] = (str(reply), None)
+                elif name == "SELECT":
+                    reply = "+OK"
+                else:
+                    reply = Exception(f"ERR unknown command '{name}'")
+            self.wfile.write(self.encode(reply))
+
+    @staticmethod
+    def encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, Exception):
+            return f"-{reply}\r\n".encode()
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if reply.startswith("+"):
+            return f"{reply}\r\n".encode()
+        return f"${len(reply.encode())}\r\n{reply}\r\n".encode()
+
+
+@pytest.fixture
+def redis_url():
+    server = socketserver.ThreadingTCPServer(
+        ("127.0.0.1", 0), FakeRedisHandler,
+    )
+    server.daemon_threads = True
+    server.data = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield f"redis://{host}:{port}/1"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_backend(request, tmp_path):
+    """
+    A factory of backends sharing the same storage, like the backends of
+    several workers.
+    """
+    backends = []
+    memory_backend = cache.MemoryBackend()
+
+    def make_backend():
+        if request.param == "memory":
+            backend = memory_backend
+        elif request.param == "sqlite":
+            backend = cache.SQLiteBackend(str(tmp_path / "cache.db"))
+        else:
+            backend = cache.RedisBackend(request.getfixturevalue("redis_url"))
+        backends.append(backend)
+        return backend
+
+    yield make_backend
+    for backend in backends:
+        backend.close()
+
+
+def test_backend(make_backend):
+    backend = make_backend()
+    assert backend.get("johndoe") is None
+    backend.set("johndoe", '{"id": 1}')
+    assert backend.get("johndoe") == '{"id": 1}'
+    backend.delete("johndoe")
+    backend.delete("johndoe")
+    assert backend.get("johndoe") is None
+    assert backend.incr("version") == 1
+    assert backend.incr("version") == 2
+
+
+def test_backend_expires_values(make_backend):
+    backend = make_backend()
+    backend.set("johndoe", "1", ttl=0.05)
+    backend.set("janedoe", "2")
+    assert backend.get("johndoe") == "1"
+    time.sleep(0.1)
+    assert backend.get("johndoe") is None
+    assert backend.get("janedoe") == "2"
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = cache.MemoryBackend(maxsize=2)
+    backend.set("johndoe", "1")
+    backend.set("johndoe2", "2")
+    backend.get("johndoe")
+    backend.set("johndoe3", "3")
+    assert backend.get("johndoe2") is None
+    assert backend.get("johndoe") == "1"
+    assert backend.get("johndoe3") == "3"
+    assert len(backend) == 2
+
+
+def test_cache_hits_and_misses(make_backend):
+    users = cache.Cache(make_backend(), "users", ttl=60)
+    assert users.get("johndoe") is None
+    users.set("johndoe", {"id": 1, "username": "johndoe"})
+    assert users.get("johndoe") == {"id": 1, "username": "johndoe"}
+
+    stats = users.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["errors"] == 0
+    assert stats["hit_ratio"] == 0.5
+
+
+def test_cache_is_invalidated_across_workers(make_backend):
+    # each worker has its own backend (and connection) to the same storage,
+    # and reads the version of the namespace every time
+    worker_1 = cache.Cache(make_backend(), "histograms", 60, version_ttl=0)
+    worker_2 = cache.Cache(make_backend(), "histograms", 60, version_ttl=0)
+    users = cache.Cache(worker_1.backend, "users", ttl=60)
+    worker_1.set("types", {"Login": 1})
+    worker_1.set("period:day", {"Login": {"size": 1}})
+    users.set("johndoe", {"id": 1})
+    assert worker_2.get("types") == {"Login": 1}
+
+    worker_2.delete("types")
+    assert worker_1.get("types") is None
+    assert worker_1.get("period:day") == {"Login": {"size": 1}}
+
+    worker_2.invalidate()
+    assert worker_1.get("period:day") is None
+    assert users.get("johndoe") == {"id": 1}
+    worker_1.set("types", {"Login": 2})
+    assert worker_2.get("types") == {"Login": 2}
+
+
+def test_namespace_version_is_kept(make_backend, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    worker_1 = cache.Cache(make_backend(), "histograms", 60, version_ttl=1)
+    worker_2 = cache.Cache(make_backend(), "histograms", 60, version_ttl=1)
+    worker_1.set("types", {"Login": 1})
+    assert worker_2.get("types") == {"Login": 1}
+
+    # the version isn't read again for every value
+    backend_get = worker_1.backend.get
+    read_keys = []
+
+    def get(key):
+        read_keys.append(key)
+        return backend_get(key)
+
+    monkeypatch.setattr(worker_1.backend, "get", get)
+    assert worker_1.get("types") == {"Login": 1}
+    assert read_keys == ["histograms:0:types"]
+
+    # the invalidation is applied right away by the worker which performs it,
+    # and by the rest once their version expires
+    worker_2.invalidate()
+    assert worker_2.get("types") is None
+    assert worker_1.get("types") == {"Login": 1}
+    now[0] += 1
+    assert worker_1.get("types") is None
+
+
+def test_disabled_cache():
+    backend = cache.MemoryBackend()
+    histograms = cache.Cache(backend, "histograms", ttl=0)
+    histograms.set("types", {"Login": 1})
+    assert histograms.get("types") is None
+    assert len(backend) == 0
+
+
+def test_cache_errors_are_misses(redis_url):
+    backend = cache.RedisBackend(redis_url)
+    users = cache.Cache(backend, "users", ttl=60)
+    users.set("johndoe", {"id": 1})
+    # an unreachable server
+    backend.port = 1
+    backend.close()
+    assert users.get("johndoe") is None
+    users.set("johndoe", {"id": 1})
+    users.invalidate()
+    assert users.stats()["errors"] == 3
+    assert users.stats()["misses"] == 1
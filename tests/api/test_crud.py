@@ -0,0 +1,196 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from app.api import cache, crud, models, schemas
+
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    for username in ("johndoe", "janedoe"):
+        db.add(models.User(username=username, hashed_password="x"))
+    db.commit()
+    yield db
+    db.close()
+
+
+def action(title: str, owner_id: int, *timestamp) -> dict:
+    timestamp = datetime(*timestamp)
+    return {"title": title, "owner_id": owner_id, "timestamp": timestamp}
+
+
+def register_actions(db, user_id: int, titles: list):
+    for title in titles:
+        crud.create_user_action(db, schemas.ActionCreate(title=title), user_id)
+
+
+def test_action_counts_are_maintained(db):
+    register_actions(db, 1, ["Login", "Login", "Logout"])
+    crud.create_user_actions(db, [
+        action("Login", 2, 2020, 5, 30, 17, 35, 55),
+        action("Query", 2, 2020, 5, 30, 17, 35, 55),
+    ])
+    assert crud.get_users_types_histogram(db) == {
+        "Login": 3, "Logout": 1, "Query": 1,
+    }
+
+    # removing an user also removes the user's actions from the counts
+    crud.remove_user(db, 2)
+    assert crud.get_users_types_histogram(db) == {"Login": 2, "Logout": 1}
+
+
+def test_rebuild_action_counts(db):
+    register_actions(db, 1, ["Login", "Login", "Logout"])
+    db.query(models.ActionCount).delete()
+    db.commit()
+    assert crud.get_users_types_histogram(db) == {}
+
+    assert crud.rebuild_action_counts(db) == {"Login": 2, "Logout": 1}
+    assert crud.get_users_types_histogram(db) == {"Login": 2, "Logout": 1}
+
+
+def test_action_rollups_are_maintained(db):
+    crud.create_user_actions(db, [
+        action("Login", 1, 2020, 5, 30, 17, 35, 55),
+        action("Login", 2, 2020, 5, 30, 17, 36, 10),
+        action("Login", 1, 2020, 5, 30, 18, 5, 0),
+        action("Query", 2, 2020, 5, 31, 9, 0, 0),
+    ])
+    assert crud.get_users_periods_histogram_buckets(db, "hour") == {
+        "Login": {
+            "buckets": {"2020-05-30 17:00:00": 2, "2020-05-30 18:00:00": 1},
+            "size": 3,
+            "min": "2020-05-30 17:35:55",
+            "max": "2020-05-30 18:05:00",
+        },
+        "Query": {
+            "buckets": {"2020-05-31 09:00:00": 1},
+            "size": 1,
+            "min": "2020-05-31 09:00:00",
+            "max": "2020-05-31 09:00:00",
+        },
+    }
+
+    # the range is aligned to the boundaries of the buckets
+    histogram = crud.get_users_periods_histogram_buckets(
+        db,
+        "minute",
+        start=datetime(2020, 5, 30, 17, 36, 30),
+        end=datetime(2020, 5, 30, 18, 0, 0),
+    )
+    assert histogram == {
+        "Login": {
+            "buckets": {"2020-05-30 17:36:00": 1},
+            "size": 1,
+            "min": "2020-05-30 17:36:10",
+            "max": "2020-05-30 17:36:10",
+        },
+    }
+
+    # removing an user also removes the user's actions from the rollups
+    crud.remove_user(db, 2)
+    assert crud.get_users_periods_histogram_buckets(db, "day") == {
+        "Login": {
+            "buckets": {"2020-05-30 00:00:00": 2},
+            "size": 2,
+            "min": "2020-05-30 17:35:55",
+            "max": "2020-05-30 18:05:00",
+        },
+    }
+
+
+def test_rebuild_action_rollups(db):
+    crud.create_user_actions(db, [
+        action("Login", 1, 2020, 5, 30, 17, 35, 55),
+        action("Login", 1, 2020, 5, 30, 18, 5, 0),
+    ])
+    expected_histogram = crud.get_users_periods_histogram_buckets(db, "hour")
+    db.query(models.ActionRollup).delete()
+    db.commit()
+    assert crud.get_users_periods_histogram_buckets(db, "hour") == {}
+
+    # 2 minutes, 2 hours and 1 day
+    assert crud.rebuild_action_rollups(db) == 5
+    assert crud.get_users_periods_histogram_buckets(db, "hour") == (
+        expected_histogram
+    )
+
+
+def test_last_actions_are_maintained(db):
+    crud.create_user_actions(db, [
+        action("Login", 1, 2020, 5, 30, 17, 35, 55),
+        action("Query", 1, 2020, 5, 30, 17, 36, 0),
+        action("Login", 1, 2020, 5, 30, 18, 0, 0),
+        action("Login", 2, 2020, 5, 30, 19, 0, 0),
+    ])
+    # an older action doesn't replace the latest one
+    crud.create_user_actions(db, [action("Query", 1, 2020, 5, 30, 17, 0, 0)])
+    register_actions(db, 1, ["Logout"])
+
+    last_actions = crud.get_latest_user_actions(db, 1)
+    assert [(a.title, a.id) for a in last_actions] == [
+        ("Logout", 6), ("Login", 3), ("Query", 2),
+    ]
+
+    db.query(models.LastAction).delete()
+    db.commit()
+    assert crud.get_latest_user_actions(db, 1) == []
+    assert crud.rebuild_last_actions(db) == 4
+    assert crud.get_latest_user_actions(db, 1) == last_actions
+
+    crud.remove_user(db, 2)
+    assert db.query(models.LastAction).count() == 3
+
+
+def test_actions_are_inserted_at_once(db):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement.split("(")[0].strip())
+
+    actions = [
+        action("Login", 1, 2020, 5, 30, 17, 35, 55),
+        action("Login", 1, 2020, 5, 30, 18, 0, 0),
+        action("Query", 2, 2020, 5, 30, 19, 0, 0),
+    ]
+    event.listen(db.bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        crud.create_user_actions(db, actions)
+    finally:
+        event.remove(db.bind, "before_cursor_execute", before_cursor_execute)
+
+    assert statements.count("INSERT INTO actions") == 1
+    # the counts are only cleaned up when removing actions
+    assert not any(
+        statement.startswith("DELETE") for statement in statements
+    )
+    # the supplied actions are left untouched
+    assert all("id" not in new_action for new_action in actions)
+    last_actions = crud.get_latest_user_actions(db, 1)
+    assert [(a.title, a.id) for a in last_actions] == [("Login", 2)]
+
+
+def test_caches_are_invalidated(db, monkeypatch):
+    backend = cache.MemoryBackend()
+    users = cache.Cache(backend, "users", ttl=60)
+    histograms = cache.Cache(backend, "histograms", ttl=60)
+    monkeypatch.setattr(crud, "get_user_cache", lambda: users)
+    monkeypatch.setattr(crud, "get_histogram_cache", lambda: histograms)
+    monkeypatch.setattr(crud.hashing, "get_password_hash", lambda p: p)
+    users.set("johndoe:1", {"id": 1})
+    users.set("janedoe:2", {"id": 2})
+    histograms.set("types", {})
+
+    crud.change_user_password(db, 1, "new password")
+    assert users.get("johndoe:1") is None
+    assert users.get("janedoe:2") == {"id": 2}
+    assert histograms.get("types") == {}
+    crud.remove_user(db, 2)
+    assert users.get("janedoe:2") is None
+    assert histograms.get("types") is None
+
+    histograms.set("types", {})
+    crud.rebuild_action_counts(db)
+    assert histograms.get("types") is None
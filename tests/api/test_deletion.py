@@ -0,0 +1,101 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.api import crud, deletion, models
+
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    for username in ("johndoe", "janedoe"):
+        db.add(models.User(username=username, hashed_password="x"))
+    db.commit()
+    timestamp = datetime(2020, 5, 30, 17, 35, 55)
+    titles = {1: ["Login"] * 7 + ["Logout"], 2: ["Login"]}
+    crud.create_user_actions(db, [
+        {"title": title, "owner_id": owner_id, "timestamp": timestamp}
+        for owner_id in titles
+        for title in titles[owner_id]
+    ])
+    yield db
+    db.close()
+
+
+def test_small_accounts_are_removed_at_once(db):
+    removed_user = crud.remove_user(db, 2, sync_limit=1)
+    assert removed_user.dict() == {
+        "username": "janedoe", "id": 2, "pending_actions": None,
+    }
+    assert crud.get_user(db, 2) is None
+    assert crud.get_user_deletions(db, include_finished=True) == []
+    assert crud.get_users_types_histogram(db) == {"Login": 7, "Logout": 1}
+
+
+def test_large_accounts_are_removed_in_background(db, session_factory):
+    removed_user = crud.remove_user(db, 1, sync_limit=1)
+    assert removed_user.dict() == {
+        "username": "johndoe", "id": 1, "pending_actions": 8,
+    }
+    # the account is gone right away, and its username is available
+    assert crud.get_user_by_username(db, "johndoe") is None
+    assert crud.get_latest_user_actions(db, 1) == []
+    assert [d.username for d in crud.get_user_deletions(db)] == ["johndoe"]
+
+    worker = deletion.UserDeletionWorker(session_factory, batch_size=3)
+    assert worker.run_pending() == 8
+    assert worker.stats() == {"running": False, "users": 1, "removed": 8}
+
+    db.expire_all()
+    assert crud.get_user(db, 1) is None
+    assert db.query(models.Action).count() == 1
+    assert crud.get_users_types_histogram(db) == {"Login": 1}
+    assert crud.get_user_deletions(db) == []
+    finished = crud.get_user_deletions(db, include_finished=True)
+    assert [(d.total, d.removed) for d in finished] == [(8, 8)]
+    assert worker.run_pending() == 0
+
+
+def test_removals_are_claimed_by_a_single_worker(db, session_factory):
+    crud.remove_user(db, 1, sync_limit=1)
+    other_db = session_factory()
+    try:
+        claimed = crud.claim_user_deletion(db)
+        assert claimed.user_id == 1
+        assert crud.claim_user_deletion(other_db) is None
+
+        # the claim of a stopped worker expires
+        claimed.claimed_at = datetime.utcnow() - timedelta(minutes=5)
+        db.commit()
+        assert crud.claim_user_deletion(other_db).user_id == 1
+        assert crud.claim_user_deletion(db) is None
+    finally:
+        other_db.close()
+
+
+def test_background_worker(db, session_factory):
+    worker = deletion.UserDeletionWorker(session_factory, poll_interval=60)
+    try:
+        crud.remove_user(db, 1, sync_limit=1)
+        worker.wake()
+        for _ in range(100):
+            if worker.stats()["users"]:
+                break
+            time.sleep(0.05)
+    finally:
+        worker.stop()
+    assert worker.stats() == {"running": False, "users": 1, "removed": 8}
+
+
+def test_removal_batches(db):
+    crud.remove_user(db, 1, sync_limit=1)
+    pending = crud.get_user_deletions(db)[0]
+    # the batches are the first actions left, without skipping any rows
+    assert crud.remove_pending_user_actions(db, pending, batch_size=4) == 4
+    assert crud.remove_pending_user_actions(db, pending, batch_size=4) == 4
+    assert pending.finished_at is None
+    assert crud.remove_pending_user_actions(db, pending, batch_size=4) == 0
+    assert pending.finished_at is not None
+    assert crud.get_user(db, 1) is None
+    assert crud.get_users_types_histogram(db) == {"Login": 1}
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+
+import pytest
+
+from app import main
+from app.api import hashing
+from tests.api.test_security import expected_hash, test_password
+
+
+@pytest.mark.parametrize("workers", (0, 1))
+def test_hashing_pool(workers):
+    pool = hashing.HashingPool(workers=workers, max_pending=4)
+    try:
+        hashed_password = pool.hash(test_password)
+        assert isinstance(hashed_password, str)
+        assert pool.verify(test_password, hashed_password) is True
+        assert pool.verify(test_password, expected_hash) is True
+        assert pool.verify(test_password + "x", expected_hash) is False
+    finally:
+        pool.shutdown()
+
+    stats = pool.stats()
+    assert stats["workers"] == workers
+    assert stats["pending"] == 0
+    assert stats["peak_pending"] == 1
+    assert stats["completed"] == 4
+    assert stats["rejected"] == 0
+    assert 0 < stats["latency_avg"] <= stats["latency_max"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", (0, 1))
+async def test_hashing_pool_async(workers):
+    pool = hashing.HashingPool(workers=workers, max_pending=4)
+    try:
+        hashed_password = await pool.hash_async(test_password)
+        assert await pool.verify_async(test_password, hashed_password)
+        assert not await pool.verify_async(test_password + "x", expected_hash)
+    finally:
+        pool.shutdown()
+
+    stats = pool.stats()
+    assert stats["pending"] == 0
+    assert stats["completed"] == 3
+
+
+@pytest.mark.asyncio
+async def test_hashing_pool_async_rejects_when_full():
+    pool = hashing.HashingPool(workers=0, max_pending=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_operation():
+        started.set()
+        release.wait(timeout=5)
+        return "done"
+
+    running = asyncio.ensure_future(pool._run_async(slow_operation))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+    # rejected on the event loop, without waiting for a thread
+    with pytest.raises(hashing.HashingPoolBusy):
+        await pool.hash_async(test_password)
+    release.set()
+    assert await running == "done"
+    assert pool.stats()["rejected"] == 1
+
+
+def test_hashing_pool_rejects_when_full():
+    pool = hashing.HashingPool(workers=0, max_pending=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_operation():
+        started.set()
+        release.wait(timeout=5)
+        return "done"
+
+    worker = threading.Thread(target=pool._run, args=(slow_operation,))
+    worker.start()
+    started.wait(timeout=5)
+    with pytest.raises(hashing.HashingPoolBusy):
+        pool.hash(test_password)
+    release.set()
+    worker.join()
+
+    stats = pool.stats()
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 1
+    assert stats["pending"] == 0
+
+
+def test_hashing_pool_busy_response(client, monkeypatch):
+    pool = hashing.HashingPool(workers=0, max_pending=0)
+    monkeypatch.setattr(hashing, "_hashing_pool", pool)
+    response = client.post(
+        "/users/", json={"username": "busy", "password": test_password},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.json() == {"detail": hashing.HASHING_POOL_BUSY_MSG}
+
+    # the user of the shared database is created later on (by `test_main`)
+    client.app.dependency_overrides[main.get_current_superuser] = lambda: None
+    try:
+        response = client.get("/admin/hashing")
+    finally:
+        del client.app.dependency_overrides[main.get_current_superuser]
+    assert response.status_code == 200
+    assert response.json()["rejected"] == 1
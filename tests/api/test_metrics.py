@@ -0,0 +1,87 @@
+from app.api import metrics
+
+
+def test_memory_registry():
+    registry = metrics.Registry("")
+    requests = metrics.Counter(
+        registry, "requests", "Requests.", ["route", "status"],
+    )
+    latency = metrics.Histogram(
+        registry, "latency_seconds", "Latency.", ["route"],
+        buckets=(0.1, 1.0),
+    )
+    child = requests.labels("GET /", "2xx")
+    # the values are only looked up (and allocated) once
+    assert requests.labels("GET /", "2xx") is child
+    child.inc()
+    child.inc(2)
+    for elapsed in (0.05, 0.1, 0.5, 3.0):
+        latency.labels("GET /").observe(elapsed)
+
+    exposed = registry.expose()
+    assert "# TYPE requests counter" in exposed
+    assert 'requests_total{route="GET /",status="2xx"} 3.0' in exposed
+    # the counts of the buckets are cumulative
+    assert 'latency_seconds_bucket{route="GET /",le="0.1"} 2.0' in exposed
+    assert 'latency_seconds_bucket{route="GET /",le="1.0"} 3.0' in exposed
+    assert 'latency_seconds_bucket{route="GET /",le="+Inf"} 4.0' in exposed
+    assert 'latency_seconds_sum{route="GET /"} 3.65' in exposed
+    assert 'latency_seconds_count{route="GET /"} 4.0' in exposed
+
+
+def test_file_registry(tmp_path):
+    registry = metrics.Registry(str(tmp_path))
+    requests = metrics.Counter(registry, "requests", "Requests.", ["kind"])
+    connections = metrics.Gauge(registry, "connections", "Connections.")
+    cache = metrics.Counter(
+        registry, "cache_requests", "Cache.", ["namespace", "result"],
+    )
+    requests.labels("a").inc()
+    connections.labels().inc(2)
+    cache.labels("users", "miss").inc()
+
+    # another process (worker) sharing the directory of the metrics
+    other = metrics.FileStorage(str(tmp_path), process_id=0)
+    for key, amount in (
+        ('["requests", "_total", {"kind": "a"}]', 2),
+        ('["requests", "_total", {"kind": "b"}]', 1),
+        ('["connections", "", {}]', 2),
+        ('["cache_requests", "_total", '
+         '{"namespace": "users", "result": "hit"}]', 3),
+    ):
+        other.add(other.allocate(key), amount)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    exposed = registry.expose()
+    assert 'requests_total{kind="a"} 3.0' in exposed
+    assert 'requests_total{kind="b"} 1.0' in exposed
+    assert "connections 4.0" in exposed
+    assert 'cache_hit_ratio{namespace="users"} 0.75' in exposed
+
+    # a stopped process resets its gauges
+    registry.close()
+    assert "connections 2.0" in registry.expose()
+
+
+def test_file_storage_grows(tmp_path):
+    storage = metrics.FileStorage(str(tmp_path))
+    positions = [
+        storage.allocate(f"key-{i}-" + "x" * 100)
+        for i in range(1000)
+    ]
+    for position in positions:
+        storage.add(position, 1.5)
+    values = dict(storage.read())
+    assert len(values) == 1000
+    assert set(values.values()) == {1.5}
+
+
+def test_forked_process():
+    registry = metrics.Registry("")
+    requests = metrics.Counter(registry, "requests", "Requests.")
+    child = requests.labels()
+    child.inc(5)
+    # as if the process was forked, the values of the parent are not kept
+    registry._pid = None
+    child.inc()
+    assert "requests_total 1.0" in registry.expose()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+from app.api import profiling
+
+
+def busy_loop(stop_event: threading.Event):
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+def test_sampler():
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=busy_loop, args=(stop_event,), name="busy",
+    )
+    idle_thread = threading.Thread(
+        target=stop_event.wait, name="idle",
+    )
+    thread.start()
+    idle_thread.start()
+    sampler = profiling.StackSampler(interval=0.001)
+    sampler.start()
+    time.sleep(0.05)
+    stacks = sampler.stop()
+    stop_event.set()
+    thread.join()
+    idle_thread.join()
+
+    assert sampler.samples > 1
+    busy_stacks = [stack for stack in stacks if stack.startswith("busy;")]
+    assert busy_stacks
+    assert all(
+        "busy_loop (tests/api/test_profiling.py:" in stack
+        for stack in busy_stacks
+    )
+    # the threads waiting for work are skipped
+    assert not any(stack.startswith("idle;") for stack in stacks)
+
+    collapsed = profiling.format_collapsed(stacks)
+    for line in collapsed.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert stacks[stack] == int(count)
+
+
+def test_one_profile_at_a_time():
+    profiler = profiling.Profiler(interval=0.001)
+    sampler = profiler.start()
+    with pytest.raises(profiling.ProfilerBusy):
+        profiler.start()
+    profiler.stop(sampler)
+    profiler.stop(profiler.start())
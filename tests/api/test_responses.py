@@ -0,0 +1,41 @@
+import json
+
+from fastapi.encoders import jsonable_encoder
+
+from app.api import crud, models, responses, schemas
+
+
+def test_actions_response(session_factory):
+    db = session_factory()
+    try:
+        db.add(models.User(username="johndoe", hashed_password="x"))
+        db.commit()
+        for title in ("Login", "Búsqueda", None):
+            crud.create_user_action(
+                db, schemas.ActionCreate(title=title), 1,
+            )
+        models_actions = crud.get_user_actions(db, 1)
+        rows = crud.get_user_actions(db, 1, rows=True)
+    finally:
+        db.close()
+
+    # the same output as the response model (`schemas.Action`)
+    expected = jsonable_encoder(
+        [schemas.Action.from_orm(action) for action in models_actions]
+    )
+    assert responses.serialize_actions(rows) == expected
+    response = responses.actions_response(rows, headers={"X-Test": "1"})
+    assert response.headers["x-test"] == "1"
+    assert response.media_type == "application/json"
+    assert json.loads(response.body) == expected
+    assert list(json.loads(response.body)[0]) == [
+        "title", "id", "owner_id", "timestamp",
+    ]
+
+
+def test_dumps_without_orjson(monkeypatch):
+    content = {"Búsqueda": [1, 2.5, None, "2020-05-30 17:35:55"]}
+    encoded = responses.dumps(content)
+    monkeypatch.setattr(responses, "orjson", None)
+    assert responses.dumps(content) == encoded
+    assert json.loads(encoded) == content
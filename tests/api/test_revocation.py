@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+from app.api import crud, models, revocation
+
+
+def revoked_user(username: str, issued_before: datetime):
+    return models.TokenRevocation(
+        username=username,
+        issued_before=issued_before,
+        expires_at=issued_before + timedelta(minutes=30),
+    )
+
+
+def test_revoked_tokens():
+    revocations = revocation.RevocationList()
+    now = datetime.utcnow()
+    epoch = revocation.to_epoch(now)
+    revocations.add(models.TokenRevocation(
+        jti="revoked", expires_at=now + timedelta(minutes=5),
+    ))
+    revocations.add(revoked_user("johndoe", now))
+
+    assert revocations.is_revoked({"sub": "janedoe", "jti": "revoked"})
+    assert not revocations.is_revoked({"sub": "janedoe", "jti": "other"})
+    assert revocations.is_revoked({"sub": "johndoe", "iat": epoch - 1})
+    assert not revocations.is_revoked({"sub": "johndoe", "iat": epoch})
+    # the tokens issued by previous versions don't have `iat` nor `jti`
+    assert revocations.is_revoked({"sub": "johndoe"})
+    assert not revocations.is_revoked({"sub": "janedoe"})
+
+    # an older revocation doesn't replace the latest one
+    revocations.add(revoked_user("johndoe", now - timedelta(minutes=1)))
+    assert revocations.is_revoked({"sub": "johndoe", "iat": epoch - 1})
+
+
+def test_expired_revocations_are_purged():
+    revocations = revocation.RevocationList()
+    now = datetime.utcnow()
+    revocations.add(models.TokenRevocation(
+        jti="revoked", expires_at=now + timedelta(minutes=5),
+    ))
+    revocations.add(revoked_user("johndoe", now))
+
+    revocations.purge(revocation.to_epoch(now + timedelta(minutes=10)))
+    assert revocations.stats()["tokens"] == 0
+    assert revocations.stats()["users"] == 1
+    revocations.purge(revocation.to_epoch(now + timedelta(minutes=30)))
+    assert revocations.stats()["users"] == 0
+
+
+def test_revocations_are_synced_across_workers(session_factory, monkeypatch):
+    worker_1 = revocation.RevocationList(sync_interval=60)
+    worker_2 = revocation.RevocationList(sync_interval=60)
+    monkeypatch.setattr(crud, "get_revocation_list", lambda: worker_1)
+    monkeypatch.setattr(crud.hashing, "get_password_hash", lambda p: p)
+    db = session_factory()
+    db.add(models.User(username="johndoe", hashed_password="x"))
+    db.commit()
+    assert worker_2.needs_sync()
+    assert worker_2.sync(db) == 0
+    assert not worker_2.needs_sync()
+
+    crud.change_user_password(db, 1, "new password")
+    crud.revoke_token(db, "revoked", datetime.utcnow() + timedelta(minutes=5))
+    # an expired revocation isn't loaded
+    crud.revoke_token(db, "expired", datetime.utcnow())
+    assert worker_1.is_revoked({"sub": "johndoe", "iat": 0})
+    assert not worker_2.is_revoked({"sub": "johndoe", "iat": 0})
+
+    assert worker_2.sync(db) == 2
+    assert worker_2.is_revoked({"sub": "johndoe", "iat": 0})
+    assert worker_2.is_revoked({"sub": "janedoe", "jti": "revoked"})
+    assert not worker_2.is_revoked({"sub": "janedoe", "jti": "expired"})
+    assert worker_2.sync(db) == 0
+    db.close()
+
+
+def test_revocations_committed_out_of_order(session_factory):
+    revocations = revocation.RevocationList(sync_interval=60)
+    expires_at = datetime.utcnow() + timedelta(minutes=5)
+    db = session_factory()
+    # a revocation is committed before another one with a lower id (e.g.
+    # its transaction started later, but finished earlier)
+    db.add(models.TokenRevocation(id=2, jti="second", expires_at=expires_at))
+    db.commit()
+    assert revocations.sync(db) == 1
+
+    db.add(models.TokenRevocation(id=1, jti="first", expires_at=expires_at))
+    db.commit()
+    assert revocations.sync(db) == 1
+    assert revocations.is_revoked({"sub": "johndoe", "jti": "first"})
+    assert revocations.stats()["loaded"] == 2
+    db.close()
@@ -1,4 +1,5 @@
 import datetime
+import jwt
 import pytest
 
 from passlib.context import CryptContext
@@ -10,10 +11,11 @@ expected_hash = "$2b$12$xwpxT094Q7KvXIoEKJqj2uFh/r8JzkHbWcMXVKfSKLuwV/OPUfDym"
 token_timedelta = datetime.timedelta(
     minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES
 )
-expected_token = (
-    b"eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.eyJzdWIiOiJqb2huZG9lIiwiZXhwIjo"
-    b"xNTkwODYxOTU1fQ.Fa-D3YT2rph_UZiKClk7la4UPR48ARdrO25Le_vmgi0"
-)
+expected_claims = {
+    "sub": "johndoe",
+    "exp": 1590861955,
+    "iat": 1590860155.0,
+}
 
 
 def test_password_context():
@@ -43,4 +45,11 @@ def test_create_access_token(datetime_now, with_delta):
         data={"sub": "johndoe"}, expires_delta=with_delta
     )
     assert isinstance(access_token, bytes)
-    assert access_token == expected_token
+    claims = jwt.decode(access_token, verify=False)
+    jti = claims.pop("jti")
+    assert claims == expected_claims
+    # each token has its own id
+    assert len(jti) == 32
+    assert jti != jwt.decode(
+        security.create_access_token(data={"sub": "johndoe"}), verify=False,
+    )["jti"]
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from app.api import timing
+from app.api.concurrency import run_blocking
+
+
+def run_with_timing(func, slow_query_threshold: float = 0.1):
+    """Run `func` as if it was a request, returning its timings."""
+    request_timing = timing.RequestTiming(slow_query_threshold)
+    token = timing._current_timing.set(request_timing)
+    try:
+        func()
+    finally:
+        timing._current_timing.reset(token)
+    return request_timing
+
+
+def test_phases():
+    def request():
+        with timing.phase("jwt"):
+            time.sleep(0.01)
+        with timing.phase("jwt"):
+            pass
+        with timing.phase("user"):
+            pass
+
+    request_timing = run_with_timing(request)
+    assert list(request_timing.phases) == ["jwt", "user"]
+    assert request_timing.phases["jwt"] >= 0.01
+    header = request_timing.server_timing()
+    assert header.startswith('db;dur=0.00;desc="0 queries", jwt;dur=')
+    assert "user;dur=" in header
+    assert "total;dur=" in header
+
+    # outside of a request, nothing is measured
+    with timing.phase("jwt"):
+        pass
+    assert timing.current_timing() is None
+
+
+def test_queries_are_measured():
+    engine = create_engine("sqlite://")
+
+    def request():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            connection.execute(text("SELECT 2"))
+
+    request_timing = run_with_timing(request, slow_query_threshold=0)
+    assert request_timing.queries == 2
+    assert request_timing.sql_time > 0
+    assert [s for s, _ in request_timing.slow_queries] == [
+        "SELECT 1", "SELECT 2",
+    ]
+
+    request_timing = run_with_timing(request)
+    assert request_timing.queries == 2
+    assert request_timing.slow_queries == []
+
+
+@pytest.mark.asyncio
+async def test_queries_of_blocking_work_are_measured():
+    engine = create_engine("sqlite://")
+
+    def query():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+    request_timing = timing.RequestTiming()
+    token = timing._current_timing.set(request_timing)
+    try:
+        await run_blocking(query)
+    finally:
+        timing._current_timing.reset(token)
+    assert request_timing.queries == 1
+
+
+def test_report(caplog):
+    report = timing.TimingReport(slow_query_samples=2, max_queries=2)
+    for queries in (1, 3):
+        request_timing = timing.RequestTiming(slow_query_threshold=0)
+        request_timing.add_phase("jwt", 0.5)
+        for i in range(queries):
+            request_timing.add_query(f"SELECT {i}", 0.25)
+        report.record("GET /users/{user_id}", request_timing)
+
+    stats = report.report()
+    route = stats["routes"]["GET /users/{user_id}"]
+    assert route["requests"] == 2
+    assert route["queries_avg"] == 2
+    assert route["queries_max"] == 3
+    assert route["sql_time_avg"] == 0.5
+    assert route["phases_avg"] == {"jwt": 0.5}
+    assert [q["statement"] for q in stats["slow_queries"]] == [
+        "SELECT 1", "SELECT 2",
+    ]
+    assert "ran 3 queries within a request" in caplog.text
+
+    report.reset()
+    assert report.report() == {"routes": {}, "slow_queries": []}
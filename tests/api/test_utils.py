@@ -1,3 +1,5 @@
+from datetime import datetime
+
 import pytest
 
 from fastapi import HTTPException
@@ -8,8 +10,21 @@ from tests.conftest import FAKE_TIME
 
 def test_get_timestamp(datetime_now):
     timestamp = utils.get_timestamp()
-    expected_datetime = FAKE_TIME.strftime("%Y-%m-%d %H:%M:%S")
-    assert timestamp == expected_datetime
+    assert timestamp == FAKE_TIME
+    assert utils.format_timestamp(timestamp) == "2020-05-30 17:35:55"
+
+
+@pytest.mark.parametrize(
+    "granularity, expected_bucket",
+    (
+        ("minute", datetime(2020, 5, 30, 17, 35)),
+        ("hour", datetime(2020, 5, 30, 17)),
+        ("day", datetime(2020, 5, 30)),
+    ),
+)
+def test_get_bucket(granularity, expected_bucket):
+    timestamp = datetime(2020, 5, 30, 17, 35, 55, 123)
+    assert utils.get_bucket(timestamp, granularity) == expected_bucket
 
 
 def test_check_user_id():
@@ -23,3 +38,15 @@ def test_check_user_id():
     with pytest.raises(HTTPException) as http_exception:
         utils.check_user_id(1, 2, "fake_section")
     assert expected_message in str(http_exception)
+
+
+def test_encode_decode_cursor():
+    timestamp = datetime(2020, 5, 30, 17, 35, 55)
+    cursor = utils.encode_cursor(timestamp, 42)
+    assert utils.decode_cursor(cursor) == (timestamp, 42)
+
+
+@pytest.mark.parametrize("cursor", ("wrong_cursor", "d3Jvbmc=", "é"))
+def test_decode_wrong_cursor(cursor):
+    with pytest.raises(ValueError):
+        utils.decode_cursor(cursor)
@@ -0,0 +1,72 @@
+import json as jsonlib
+import time
+from typing import Any, Dict, Tuple
+from urllib.parse import urlencode
+
+
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    headers: Dict[str, str] = None,
+    data: Dict[str, str] = None,
+    json: Any = None,
+) -> Tuple[int, bytes, float]:
+    """
+    Perform an in-process request against an ASGI application, without any
+    network involved, so several requests can be run concurrently in the
+    same event loop. The body can be a form (`data`) or a JSON document
+    (`json`). Returns the status code, the body and the elapsed time.
+    """
+    path, _, query_string = path.partition("?")
+    raw_headers = [
+        (k.lower().encode(), v.encode()) for k, v in (headers or {}).items()
+    ]
+    body = b""
+    if data:
+        body = urlencode(data).encode()
+        raw_headers.append(
+            (b"content-type", b"application/x-www-form-urlencoded"),
+        )
+    elif json is not None:
+        body = jsonlib.dumps(json).encode()
+        raw_headers.append((b"content-type", b"application/json"))
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query_string.encode(),
+        "headers": raw_headers,
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+    request_sent = False
+    response = {"status": None, "body": []}
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            return {"type": "http.disconnect"}
+        request_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    elapsed = time.perf_counter() - start
+    return response["status"], b"".join(response["body"]), elapsed
+
+
+def percentile(values, pct: float) -> float:
+    """Return the `pct` percentile of `values` (nearest-rank method)."""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
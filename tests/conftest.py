@@ -7,24 +7,60 @@ from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from app.api import security
-from app.api import utils
-from app.api.models import Base
-from app.main import app, get_db
+# the admin routes are disabled by default, enable them to be able to test it
+os.environ.setdefault("INCLUDE_ADMIN_ROUTES", "true")
+# and allow them to the user of our tests (see `tests/test_main.py`)
+os.environ.setdefault("SUPERUSERS", '["johndoe"]')
+# register the user actions within the request, so our tests can check the
+# registered actions right away (the batched mode is tested separately)
+os.environ.setdefault("AUDIT_MODE", "durable")
+# don't cache the histograms, so our tests can check the new actions right
+# away (the histograms cache is tested separately)
+os.environ.setdefault("HISTOGRAM_CACHE_TTL", "0")
+# don't run the background removal of the users' actions, our tests perform
+# it when needed (against the test database)
+os.environ.setdefault("USER_DELETE_POLL_INTERVAL", "0")
+
+from app.api import security  # noqa: E402
+from app.api import utils  # noqa: E402
+from app.api.models import Base  # noqa: E402
+from app.database import create_db_engine  # noqa: E402
+from app.main import app, get_db  # noqa: E402
 
 FAKE_TIME = datetime.datetime(2020, 5, 30, 17, 35, 55)
 
-# Configure a test database (in memory)
+# Configure a test database (in memory by default, or the database given by
+# `TEST_DATABASE_URL`, e.g. a local PostgreSQL server). Since the blocking
+# database work is performed in a thread pool, an in-memory database is
+# shared between threads, otherwise each thread would get its own (and
+# empty) in-memory database.
 SQLALCHEMY_DATABASE_URI = os.getenv("TEST_DATABASE_URL", "sqlite://")
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URI, connect_args={"check_same_thread": False}
-)
+engine = create_db_engine(SQLALCHEMY_DATABASE_URI)
+if engine.dialect.name != "sqlite":
+    # our tests expect an empty database
+    Base.metadata.drop_all(bind=engine)
 TestingSessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine,
 )
 Base.metadata.create_all(bind=engine)
 
 
+@pytest.fixture
+def session_factory(tmp_path):
+    """
+    A session factory bound to an empty database (stored in a temporary file,
+    so it can be used from several threads), for tests which need a database
+    isolated from the rest of the test suite.
+    """
+    isolated_engine = create_engine(
+        f"sqlite:///{tmp_path / 'isolated.db'}",
+        connect_args={"check_same_thread": False},
+    )
+    Base.metadata.create_all(bind=isolated_engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=isolated_engine)
+    isolated_engine.dispose()
+
+
 @pytest.fixture
 def datetime_now(monkeypatch):
 
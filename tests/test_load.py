@@ -0,0 +1,179 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import Depends
+from sqlalchemy.orm import sessionmaker
+
+from app import main
+from app.api import concurrency, crud, hashing, schemas, security
+from app.api.config import APISettings
+from app.api.models import Base
+from app.database import create_db_engine
+from tests.asgi import asgi_request, percentile
+
+LOGIN_DATA = {"username": "loaduser", "password": "load_password"}
+CONCURRENT_LOGINS = 8
+# more requests than threads in our pool, so they have to wait for them
+CONCURRENT_REQUESTS = 2 * main.api_settings.blocking_pool_size
+
+
+def _override_get_db(session_factory):
+    """
+    Override `get_db` with the sessions of `session_factory`, returns the id
+    of the user performing the requests.
+    """
+    db = session_factory()
+    user_id = crud.create_user(db, schemas.UserCreate(**LOGIN_DATA)).id
+    db.close()
+
+    # as `get_db`, wait on the event loop until the database can serve us
+    def override_get_db(_: None = Depends(main.limit_db_requests)):
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    previous_override = main.app.dependency_overrides.get(main.get_db)
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    yield user_id
+    if previous_override is None:
+        del main.app.dependency_overrides[main.get_db]
+    else:
+        main.app.dependency_overrides[main.get_db] = previous_override
+
+
+@pytest.fixture
+def load_test_db(session_factory):
+    """Override `get_db` with an isolated database, returns the user id."""
+    yield from _override_get_db(session_factory)
+
+
+@pytest.fixture
+def pooled_test_db(tmp_path, monkeypatch):
+    """
+    Override `get_db` with an isolated database, behind a pool of a few
+    connections (much less than our threads), returns the user id.
+    """
+    api_settings = APISettings(
+        db_pool_size=2, db_max_overflow=0, db_pool_timeout=1,
+    )
+    engine = create_db_engine(
+        f"sqlite:///{tmp_path / 'pooled.db'}", api_settings,
+    )
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(
+        concurrency,
+        "_db_limiter",
+        concurrency.RequestLimiter(api_settings.db_max_requests),
+    )
+    yield from _override_get_db(
+        sessionmaker(autocommit=False, autoflush=False, bind=engine),
+    )
+    engine.dispose()
+
+
+async def _user_requests_latencies(user_id: int):
+    """
+    Perform `CONCURRENT_REQUESTS` calls to `GET /users/{user_id}` at once,
+    with its actions (a route which queries the database twice, in two
+    threads), returning their latencies.
+    """
+    token = security.create_access_token(data={"sub": LOGIN_DATA["username"]})
+    if isinstance(token, bytes):
+        token = token.decode()
+    headers = {"Authorization": f"Bearer {token}"}
+    results = await asyncio.gather(*(
+        asgi_request(
+            main.app,
+            "GET",
+            f"/users/{user_id}?include=actions",
+            headers=headers,
+        )
+        for _ in range(CONCURRENT_REQUESTS)
+    ))
+    assert [status for status, _, _ in results] == [200] * len(results)
+    return [elapsed for _, _, elapsed in results]
+
+
+async def _with_concurrent_logins(requests):
+    """Run the `requests` while `CONCURRENT_LOGINS` logins are hashing."""
+    logins = [
+        asgi_request(main.app, "POST", "/authenticate", data=LOGIN_DATA)
+        for _ in range(CONCURRENT_LOGINS)
+    ]
+    results = await asyncio.gather(requests, *logins)
+    assert all(status == 200 for status, _, _ in results[1:])
+    return results[0]
+
+
+@pytest.mark.asyncio
+async def test_database_requests_with_concurrent_logins(load_test_db):
+    # all the requests are served, although they don't fit in our pool and
+    # the logins are hashing at the same time
+    latencies = await _with_concurrent_logins(
+        _user_requests_latencies(load_test_db),
+    )
+    assert len(latencies) == CONCURRENT_REQUESTS
+
+
+@pytest.mark.asyncio
+async def test_logins_beyond_the_hashing_pool(load_test_db, monkeypatch):
+    pool = hashing.HashingPool(workers=1, max_pending=2)
+    monkeypatch.setattr(hashing, "_hashing_pool", pool)
+    try:
+        # more logins than threads in our pool, the ones the hashing pool
+        # can't take are rejected right away
+        results = await asyncio.gather(*(
+            asgi_request(main.app, "POST", "/authenticate", data=LOGIN_DATA)
+            for _ in range(CONCURRENT_REQUESTS)
+        ))
+    finally:
+        pool.shutdown()
+    statuses = [status for status, _, _ in results]
+    assert set(statuses) == {200, 503}
+    stats = pool.stats()
+    assert stats["rejected"] == statuses.count(503)
+    assert stats["peak_pending"] == 2
+
+
+@pytest.mark.load
+@pytest.mark.asyncio
+async def test_database_requests_latency_with_concurrent_logins(
+        load_test_db, record_property,
+):
+    # time a single bcrypt verification, this is what a request would have
+    # to wait, at least, if the logins were blocking the event loop (or the
+    # threads used to query the database)
+    hashed_password = security.get_password_hash(LOGIN_DATA["password"])
+    start = time.perf_counter()
+    security.verify_password(LOGIN_DATA["password"], hashed_password)
+    bcrypt_time = time.perf_counter() - start
+
+    idle_latencies = await _user_requests_latencies(load_test_db)
+    loaded_latencies = await _with_concurrent_logins(
+        _user_requests_latencies(load_test_db),
+    )
+
+    idle_p99 = percentile(idle_latencies, 99)
+    loaded_p99 = percentile(loaded_latencies, 99)
+    record_property("bcrypt_ms", round(bcrypt_time * 1000, 1))
+    record_property("idle_p99_ms", round(idle_p99 * 1000, 1))
+    record_property("loaded_p99_ms", round(loaded_p99 * 1000, 1))
+    # with the logins blocking the event loop, the requests would wait for
+    # several bcrypt checks in a row
+    assert loaded_p99 < idle_p99 + bcrypt_time, (
+        f"bcrypt: {bcrypt_time * 1000:.1f}ms, "
+        f"GET /users/{{user_id}} p99 idle: {idle_p99 * 1000:.1f}ms, "
+        f"under {CONCURRENT_LOGINS} logins: {loaded_p99 * 1000:.1f}ms"
+    )
+
+
+@pytest.mark.asyncio
+async def test_database_requests_beyond_the_pool(pooled_test_db):
+    # the requests waiting for a connection would hold the threads that the
+    # requests holding the connections need to finish (failing once the
+    # pool timeout expires), unless they wait on the event loop
+    latencies = await _user_requests_latencies(pooled_test_db)
+    assert len(latencies) == CONCURRENT_REQUESTS
@@ -1,4 +1,6 @@
-from types import MappingProxyType
+import csv
+import json
+from types import MappingProxyType, SimpleNamespace
 
 import jwt
 import pytest
@@ -6,14 +8,12 @@ from fastapi import HTTPException
 from sqlalchemy import orm
 
 from app import main
-from app.api import utils
-from tests.api.test_security import expected_token, test_password
-
-headers_authenticated_user = {
-    "Content-Type": "application/json",
-    "Content-Type": "application/x-www-form-urlencoded",
-    "Authorization": f"Bearer {expected_token.decode('utf-8')}",
-}
+from app.api import cache, utils
+from app.api.models import Base
+from app.api.security import create_access_token
+from app.database import ReplicaSet, create_db_engine
+from tests.api.test_security import expected_claims, test_password
+from tests.conftest import TestingSessionLocal
 
 # welcome to the world of mutable/immutable dicts...since there is a bug in
 # `cpython` (MappingProxy objects should JSON serialize just like a dictionary)
@@ -64,11 +64,11 @@ expected_types_histogram_data = {
     "Account created": 1,
     "Changed user password": 2,
     "Logged into account": 15,
+    "Queried actions in ascending sorting (limited to 1000)": 1,
     "Queried actions in ascending sorting (limited to 2)": 1,
-    "Queried actions in ascending sorting (unlimited)": 1,
     "Queried actions in descending sorting (limited to 100)": 1,
+    "Queried actions in descending sorting (limited to 1000)": 1,
     "Queried actions in descending sorting (limited to 2)": 1,
-    "Queried actions in descending sorting (unlimited)": 1,
     "Queried last actions": 1,
 }
 
@@ -158,10 +158,10 @@ def test_authenticate(client, datetime_now):
         data=post_data_user,
     )
     assert response.status_code == 200
-    assert response.json() == {
-        "access_token": expected_token.decode("utf-8"),
-        "token_type": "bearer",
-    }
+    assert response.json()["token_type"] == "bearer"
+    claims = jwt.decode(response.json()["access_token"], verify=False)
+    claims.pop("jti")
+    assert claims == {**expected_claims, "uid": 1}
 
 
 def test_read_user_not_authenticated(client):
@@ -172,7 +172,24 @@ def test_read_user_not_authenticated(client):
 
 def test_read_user(client):
     session_headers_with_token = get_superuser_token_headers(client)
+    # by default, the user actions are not included
     response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+    assert response.json() == {
+        key: value for key, value in expected_user.items() if key != "actions"
+    }
+
+    # only the requested number of actions is included
+    response = client.get(
+        "/users/1?include=actions&actions_limit=1",
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.json() == expected_user
+
+    response = client.get(
+        "/users/1?include=actions", headers=session_headers_with_token,
+    )
     response_json = response.json()
     assert response.status_code == 200
     assert "actions" in response_json
@@ -459,3 +476,443 @@ def test_read_users_actions_periods_histogram_with_params(client, period_time):
         headers=get_superuser_token_headers(client)
     )
     assert response.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "query, expected_bucket_size",
+    (
+        ("period_time=hour", 16),
+        ("period_time=month", 10),
+        ("period_time=month&granularity=hour", 13),
+        ("start=2020-01-01T00:00:00&end=2100-01-01T00:00:00", 13),
+    ),
+)
+def test_read_users_actions_periods_histogram_buckets(
+        client, query, expected_bucket_size,
+):
+    response = client.get(
+        f"/users/histogram-period?mode=buckets&{query}",
+        headers=get_superuser_token_headers(client)
+    )
+    assert response.status_code == 200
+    assert "Logged into account" in response.json()
+    for action, data in response.json().items():
+        assert set(data.keys()) == {"buckets", "max", "min", "size"}
+        assert data["size"] == sum(data["buckets"].values())
+        for bucket in data["buckets"]:
+            # the bucket should be aligned to the granularity
+            assert bucket[expected_bucket_size:].strip(" :0") == ""
+
+
+def test_read_users_actions_periods_histogram_summary(client):
+    headers = get_superuser_token_headers(client)
+    with_timestamps = client.get(
+        "/users/histogram-period?period_time=month", headers=headers,
+    ).json()
+    response = client.get(
+        "/users/histogram-period?period_time=month&mode=summary",
+        headers=headers,
+    )
+    assert response.status_code == 200
+    for action, data in response.json().items():
+        assert set(data.keys()) == {"max", "min", "size"}
+        if action == "Queried period histogram (month)":
+            # registered after the first query
+            continue
+        expected_data = with_timestamps[action]
+        assert data["min"] == min(expected_data["timestamps"])
+        assert data["max"] == max(expected_data["timestamps"])
+        assert data["size"] == expected_data["size"]
+
+
+def test_read_actions_pagination(client, monkeypatch):
+    session_headers_with_token = get_superuser_token_headers(client)
+    all_actions = client.get(
+        "/users/1/actions?limit=0&sort=asc",
+        headers=session_headers_with_token,
+    ).json()
+    assert len(all_actions) > 4
+
+    # the maximum number of results is enforced
+    monkeypatch.setattr(main.api_settings, "actions_max_limit", 3)
+    paginated_actions = []
+    url = "/users/1/actions?limit=0&sort=asc"
+    while True:
+        response = client.get(url, headers=session_headers_with_token)
+        assert response.status_code == 200
+        assert len(response.json()) <= 3
+        paginated_actions.extend(response.json())
+        if "X-Next-Cursor" not in response.headers:
+            break
+        next_cursor = response.headers["X-Next-Cursor"]
+        assert next_cursor in response.headers["Link"]
+        url = f"/users/1/actions?limit=0&sort=asc&cursor={next_cursor}"
+    # each page registers a new action, so we may get more actions
+    assert paginated_actions[:len(all_actions)] == all_actions
+
+    # now from the newest to the oldest
+    response = client.get(
+        "/users/1/actions?limit=2", headers=session_headers_with_token,
+    )
+    next_cursor = response.headers["X-Next-Cursor"]
+    response = client.get(
+        f"/users/1/actions?limit=2&cursor={next_cursor}",
+        headers=session_headers_with_token,
+    )
+    assert response.json()[0]["id"] < int(utils.decode_cursor(next_cursor)[1])
+
+
+def test_read_actions_wrong_cursor_param(client):
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get(
+        "/users/1/actions?cursor=wrong_cursor",
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": main.WRONG_QUERY_ARGUMENTS_MSG.format(query_arg="cursor"),
+    }
+
+
+@pytest.mark.parametrize("export_format", ("ndjson", "csv"))
+def test_export_actions(client, monkeypatch, export_format):
+    session_headers_with_token = get_superuser_token_headers(client)
+    monkeypatch.setattr(main.api_settings, "export_chunk_size", 2)
+    response = client.get(
+        f"/users/1/actions/export?format={export_format}",
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(
+        {"ndjson": "application/x-ndjson", "csv": "text/csv"}[export_format]
+    )
+    lines = response.text.splitlines()
+    if export_format == "ndjson":
+        exported_actions = [json.loads(line) for line in lines]
+    else:
+        assert lines[0] == "id,title,timestamp,owner_id"
+        exported_actions = [
+            {**row, "id": int(row["id"]), "owner_id": int(row["owner_id"])}
+            for row in csv.DictReader(lines)
+        ]
+
+    all_actions = client.get(
+        "/users/1/actions?limit=0&sort=asc",
+        headers=session_headers_with_token,
+    ).json()
+    assert exported_actions == all_actions[:len(exported_actions)]
+    expected_title = f"Exported actions ({export_format})"
+    assert exported_actions[-1]["title"] == expected_title
+
+    # Test that an user cannot export the actions of another user
+    response = client.get(
+        "/users/2/actions/export", headers=session_headers_with_token,
+    )
+    assert response.status_code == 401
+
+
+def test_current_user_is_cached(client):
+    session_headers_with_token = get_superuser_token_headers(client)
+    client.get("/users/1", headers=session_headers_with_token)
+    stats = main.get_user_cache().stats()
+
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+    cached_stats = main.get_user_cache().stats()
+    assert cached_stats["hits"] == stats["hits"] + 1
+    assert cached_stats["misses"] == stats["misses"]
+
+
+@pytest.mark.asyncio
+async def test_cached_user_of_a_reused_username(
+        monkeypatch, mock_get_db_yield,
+):
+    # the user is removed (and its username registered again) by other
+    # worker, so this one (with its own `memory` cache) keeps it cached
+    users = cache.Cache(cache.MemoryBackend(), "users", ttl=60)
+    monkeypatch.setattr(main, "get_user_cache", lambda: users)
+    db_users = {"janedoe": SimpleNamespace(
+        id=5, username="janedoe", is_active=True,
+    )}
+    monkeypatch.setattr(
+        main.crud, "get_user_by_username",
+        lambda db, username: db_users.get(username),
+    )
+
+    def get_token(user_id):
+        token = create_access_token(data={"sub": "janedoe", "uid": user_id})
+        return token.decode() if isinstance(token, bytes) else token
+
+    old_token = get_token(5)
+    user = await main.get_current_user(old_token, mock_get_db_yield)
+    assert user.id == 5
+
+    db_users["janedoe"] = SimpleNamespace(
+        id=7, username="janedoe", is_active=True,
+    )
+    user = await main.get_current_user(get_token(7), mock_get_db_yield)
+    assert user.id == 7
+    # once the removed user expires from the cache, its token doesn't
+    # resolve to the new user
+    users.invalidate()
+    with pytest.raises(HTTPException) as excinfo:
+        await main.get_current_user(old_token, mock_get_db_yield)
+    assert str(excinfo) == expected_credentials_exception
+
+
+def test_histograms_are_cached(client, monkeypatch):
+    session_headers_with_token = get_superuser_token_headers(client)
+    monkeypatch.setattr(main.get_histogram_cache(), "ttl", 60)
+    first = client.get(
+        "/users/histogram-types", headers=session_headers_with_token,
+    ).json()
+    stats = main.get_histogram_cache().stats()
+
+    # the action registered by the first query isn't included yet
+    response = client.get(
+        "/users/histogram-types", headers=session_headers_with_token,
+    )
+    assert response.json() == first
+    cached_stats = main.get_histogram_cache().stats()
+    assert cached_stats["hits"] == stats["hits"] + 1
+    main.get_histogram_cache().invalidate()
+
+
+def test_decoded_tokens_are_cached(client, monkeypatch):
+    session_headers_with_token = get_superuser_token_headers(client)
+    decoded_tokens = []
+
+    class CountingJwt:
+        @staticmethod
+        def decode(token, *args, **kwargs):
+            decoded_tokens.append(token)
+            return jwt.decode(token, *args, **kwargs)
+
+    monkeypatch.setattr(main, "jwt", CountingJwt)
+    for _ in range(3):
+        response = client.get("/users/1", headers=session_headers_with_token)
+        assert response.status_code == 200
+    assert len(decoded_tokens) <= 1
+
+
+def test_token_with_embedded_user(client, monkeypatch):
+    monkeypatch.setattr(main.api_settings, "token_embed_user", True)
+    session_headers_with_token = get_superuser_token_headers(client)
+    token = session_headers_with_token["Authorization"].split()[1]
+    payload = jwt.decode(token, verify=False)
+    assert payload["uid"] == 1
+    assert payload["act"] is False
+
+    def get_user_by_username(*args, **kwargs):
+        raise AssertionError("the user shouldn't be looked up")
+
+    monkeypatch.setattr(
+        main.crud, "get_user_by_username", get_user_by_username,
+    )
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+    assert response.json()["username"] == "johndoe"
+
+
+def test_logout(client):
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.post("/logout", headers=session_headers_with_token)
+    assert response.status_code == 200
+
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 401
+
+    # other tokens of the user are still valid
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+    response = client.get(
+        "/admin/revocations", headers=session_headers_with_token,
+    )
+    assert response.json()["tokens"] >= 1
+
+
+def test_password_change_revokes_tokens(client, monkeypatch):
+    monkeypatch.setattr(main.api_settings, "token_embed_user", True)
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.put(
+        f"/users/1/password?new_password={test_password}",
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 401
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+
+
+def test_read_only_routes_use_replicas(client, monkeypatch, tmp_path):
+    # an empty replica, so we can tell which database answered
+    replica = create_db_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    Base.metadata.create_all(bind=replica)
+    monkeypatch.setattr(main, "replicas", ReplicaSet([replica]))
+
+    # the user has just logged in, so it reads from the primary
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get(
+        "/users/1/last_actions", headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.json() != []
+
+    main.get_primary_reads_cache().delete("johndoe")
+    response = client.get(
+        "/users/1/last_actions", headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+    # the user action has been registered into the primary database
+    response = client.get(
+        "/users/1/last_actions", headers=session_headers_with_token,
+    )
+    assert response.json() == []
+    monkeypatch.setattr(main, "replicas", ReplicaSet([]))
+    response = client.get(
+        "/users/1/last_actions", headers=session_headers_with_token,
+    )
+    assert response.json()[0]["title"] == "Queried last actions"
+
+
+def test_delete_user_with_many_actions(client, monkeypatch):
+    monkeypatch.setattr(main.api_settings, "user_delete_sync_limit", 1)
+    response = client.post("/users/", json=to_delete_user)
+    user_id = response.json()["id"]
+    session_headers_with_token = get_superuser_token_headers(
+        client, user_data=MappingProxyType(to_delete_user),
+    )
+    response = client.delete(
+        f"/users/{user_id}", headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "username": "johndoe2", "id": user_id, "pending_actions": 2,
+    }
+    response = client.get(
+        f"/users/{user_id}", headers=session_headers_with_token,
+    )
+    assert response.status_code == 401
+    response = client.post(
+        "/authenticate", data=MappingProxyType(to_delete_user),
+    )
+    assert response.status_code == 401
+
+    superuser_headers = get_superuser_token_headers(client)
+    deletions = client.get(
+        "/admin/deletions", headers=superuser_headers,
+    ).json()["deletions"]
+    assert [(d["user_id"], d["removed"]) for d in deletions] == [(user_id, 0)]
+    worker = main.get_deletion_worker()
+    monkeypatch.setattr(worker, "session_factory", TestingSessionLocal)
+    assert worker.run_pending() == 2
+    response = client.get("/admin/deletions", headers=superuser_headers)
+    assert response.json()["deletions"] == []
+
+
+def test_request_timings(client):
+    client.get(
+        "/admin/timings",
+        params={"reset": True},
+        headers=get_superuser_token_headers(client),
+    )
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get(
+        "/users/1/last_actions", headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    server_timing = response.headers["server-timing"]
+    for metric in ("db;dur=", "jwt;dur=", "user;dur=", "audit;dur="):
+        assert metric in server_timing
+    assert "serialize;dur=" in server_timing
+
+    report = client.get(
+        "/admin/timings", headers=session_headers_with_token,
+    ).json()
+    login = report["routes"]["POST /authenticate"]
+    assert login["requests"] == 1
+    assert "bcrypt" in login["phases_avg"]
+    route = report["routes"]["GET /users/{user_id}/last_actions"]
+    assert route["requests"] == 1
+    assert route["queries_max"] > 0
+
+
+def test_metrics(client):
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get("/users/1", headers=session_headers_with_token)
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    metrics = response.text
+    assert (
+        'http_requests_total{route="GET /users/{user_id}",status="2xx"}'
+        in metrics
+    )
+    assert (
+        'http_request_duration_seconds_count{route="GET /users/{user_id}"}'
+        in metrics
+    )
+    assert "bcrypt_duration_seconds_count" in metrics
+    assert 'audit_actions_written_total{mode="durable"}' in metrics
+    assert 'cache_hit_ratio{namespace="users"}' in metrics
+    assert "db_pool_checked_out " in metrics
+    assert "db_pool_connections " in metrics
+
+
+def test_profile(client):
+    session_headers_with_token = get_superuser_token_headers(client)
+    response = client.get(
+        "/admin/profile",
+        params={"seconds": 0.05},
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    response = client.get(
+        "/admin/profile",
+        params={"seconds": main.api_settings.profile_max_seconds + 1},
+        headers=session_headers_with_token,
+    )
+    assert response.status_code == 422
+
+    # profile a single request
+    response = client.get(
+        "/users/1",
+        headers={**session_headers_with_token, "X-Profile": "1"},
+    )
+    assert response.status_code == 200
+    assert response.headers["x-profile-status"] == "200"
+    for line in response.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+
+def test_admin_routes_require_a_superuser(client):
+    response = client.get("/admin/cache")
+    assert response.status_code == 401
+
+    user_data = {"username": "janedoe", "password": test_password}
+    response = client.post("/users/", json=user_data)
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    session_headers_with_token = get_superuser_token_headers(
+        client, user_data=user_data,
+    )
+    response = client.get("/admin/cache", headers=session_headers_with_token)
+    assert response.status_code == 403
+
+    # the header is ignored, the request isn't profiled
+    response = client.get(
+        f"/users/{user_id}",
+        headers={**session_headers_with_token, "X-Profile": "1"},
+    )
+    assert response.status_code == 200
+    assert "x-profile-status" not in response.headers
+    assert response.json()["username"] == "janedoe"
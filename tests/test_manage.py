@@ -0,0 +1,35 @@
+from app import manage
+from app.api import crud, models, schemas
+
+
+def test_rebuild_histograms(session_factory, monkeypatch, capsys):
+    monkeypatch.setattr(manage, "SessionLocal", session_factory)
+    db = session_factory()
+    crud.create_user_action(db, schemas.ActionCreate(title="Login"), 1)
+    db.query(models.ActionCount).delete()
+    db.commit()
+
+    assert manage.main(["rebuild-histograms"]) == 0
+    output = capsys.readouterr().out
+    assert "1 types of actions" in output
+    assert "3 buckets" in output
+    assert crud.get_users_types_histogram(db) == {"Login": 1}
+    db.close()
+
+
+def test_rebuild_last_actions(session_factory, monkeypatch, capsys):
+    monkeypatch.setattr(manage, "SessionLocal", session_factory)
+    db = session_factory()
+    crud.create_user_action(db, schemas.ActionCreate(title="Login"), 1)
+    db.query(models.LastAction).delete()
+    db.commit()
+
+    assert manage.main(["rebuild-last-actions"]) == 0
+    assert "1 rows" in capsys.readouterr().out
+    assert len(crud.get_latest_user_actions(db, 1)) == 1
+    db.close()
+
+
+def test_no_command(capsys):
+    assert manage.main([]) == 1
+    assert "rebuild-histograms" in capsys.readouterr().out
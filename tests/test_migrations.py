@@ -0,0 +1,89 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from app import manage, migrations
+from app.api import crud
+from app.api.models import Base
+from app.database import SessionLocal
+
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL PRIMARY KEY,
+    username VARCHAR,
+    hashed_password VARCHAR,
+    is_active BOOLEAN
+);
+CREATE TABLE actions (
+    id INTEGER NOT NULL PRIMARY KEY,
+    title VARCHAR,
+    timestamp VARCHAR,
+    owner_id INTEGER REFERENCES users (id)
+);
+CREATE INDEX ix_actions_id ON actions (id);
+CREATE INDEX ix_actions_title ON actions (title);
+CREATE INDEX ix_actions_timestamp ON actions (timestamp);
+INSERT INTO users VALUES (1, 'johndoe', 'x', 0);
+INSERT INTO actions VALUES (1, 'Account created', '2020-05-30 17:35:55', 1);
+INSERT INTO actions VALUES (2, 'Logged in', '2020-05-30 17:40:00', 1);
+INSERT INTO actions VALUES (3, 'Logged in', '2020-05-31 09:00:00', 1);
+"""
+
+
+@pytest.fixture
+def legacy_engine(tmp_path):
+    path = tmp_path / "legacy.db"
+    connection = sqlite3.connect(str(path))
+    connection.executescript(LEGACY_SCHEMA)
+    connection.close()
+    legacy_engine = create_engine(f"sqlite:///{path}")
+    # tables added by the current version are created on startup
+    Base.metadata.create_all(bind=legacy_engine)
+    yield legacy_engine
+    legacy_engine.dispose()
+
+
+def to_utc(timestamp: str) -> datetime:
+    local_time = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    return local_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def test_migrate(legacy_engine):
+    assert migrations.migrate(legacy_engine, batch_size=2) == 3
+
+    db = SessionLocal(bind=legacy_engine)
+    actions = crud.get_user_actions(db, 1, sort="asc")
+    assert [action.timestamp for action in actions] == [
+        to_utc("2020-05-30 17:35:55"),
+        to_utc("2020-05-30 17:40:00"),
+        to_utc("2020-05-31 09:00:00"),
+    ]
+    assert crud.get_users_types_histogram(db) == {
+        "Account created": 1, "Logged in": 2,
+    }
+    histogram = crud.get_users_periods_histogram_buckets(db, "day")
+    assert histogram["Logged in"]["size"] == 2
+    last_actions = crud.get_latest_user_actions(db, 1)
+    assert [action.id for action in last_actions] == [3, 1]
+    db.close()
+
+    indexes = {
+        index["name"]
+        for index in inspect(legacy_engine).get_indexes("actions")
+    }
+    assert "ix_actions_owner_id_timestamp" in indexes
+    assert "ix_actions_title_timestamp" in indexes
+    assert "ix_actions_title" not in indexes
+    with legacy_engine.connect() as connection:
+        assert migrations.get_schema_version(connection) == 2
+
+    # the database is already migrated
+    assert migrations.migrate(legacy_engine) == 0
+
+
+def test_migrate_command(legacy_engine, monkeypatch, capsys):
+    monkeypatch.setattr(manage, "engine", legacy_engine)
+    assert manage.main(["migrate", "--batch-size", "1"]) == 0
+    assert "3 rows updated" in capsys.readouterr().out
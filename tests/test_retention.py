@@ -0,0 +1,96 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+from app import manage, retention
+from app.api import crud, models
+from tests.api.test_crud import action
+
+NOW = datetime(2020, 5, 15, 10, 0, 0)
+
+
+@pytest.fixture
+def db(session_factory):
+    db = session_factory()
+    crud.create_user_actions(db, [
+        action("Login", 1, 2020, 1, 10, 8, 0, 0),
+        action("Query", 1, 2020, 1, 31, 23, 59, 59),
+        action("Login", 1, 2020, 2, 3, 8, 0, 0),
+        action("Login", 2, 2020, 2, 4, 8, 0, 0),
+        action("Query", 1, 2020, 3, 1, 0, 0, 0),
+        action("Login", 1, 2020, 5, 14, 8, 0, 0),
+    ])
+    yield db
+    db.close()
+
+
+def test_months():
+    assert retention.month_start(NOW) == datetime(2020, 5, 1)
+    assert retention.add_months(datetime(2020, 1, 1), -1) == (
+        datetime(2019, 12, 1)
+    )
+    assert retention.add_months(datetime(2020, 12, 1), 1) == (
+        datetime(2021, 1, 1)
+    )
+    assert retention.get_retention_cutoff(2, NOW) == datetime(2020, 3, 1)
+
+
+def test_apply_retention(db, tmp_path):
+    archived = retention.apply_retention(db, 2, tmp_path, now=NOW)
+    assert [(month["month"], month["rows"]) for month in archived] == [
+        ("2020-01", 2), ("2020-02", 1),
+    ]
+    # the latest login of the user 2 is kept
+    assert [a.id for a in db.query(models.Action).order_by("id")] == [4, 5, 6]
+    assert crud.get_users_types_histogram(db) == {"Login": 2, "Query": 1}
+    assert crud.rebuild_action_counts(db) == {"Login": 2, "Query": 1}
+
+    with gzip.open(tmp_path / "actions-2020-01.ndjson.gz", "rt") as archive:
+        rows = [json.loads(line) for line in archive]
+    assert rows == [
+        {
+            "id": 1,
+            "title": "Login",
+            "timestamp": "2020-01-10 08:00:00",
+            "owner_id": 1,
+        },
+        {
+            "id": 2,
+            "title": "Query",
+            "timestamp": "2020-01-31 23:59:59",
+            "owner_id": 1,
+        },
+    ]
+    archive = db.query(models.ActionArchive).get("2020-02")
+    assert archive.rows == 1
+    assert archive.path == str(tmp_path / "actions-2020-02.ndjson.gz")
+
+    # nothing else to archive
+    archived = retention.apply_retention(db, 2, tmp_path, now=NOW)
+    assert [(month["month"], month["rows"]) for month in archived] == [
+        ("2020-02", 0),
+    ]
+
+
+def test_drop_old_actions(db, tmp_path):
+    archived = retention.apply_retention(
+        db, 1, None, batch_size=1, now=NOW,
+    )
+    assert [(month["month"], month["rows"]) for month in archived] == [
+        ("2020-01", 2), ("2020-02", 1), ("2020-03", 0),
+    ]
+    assert list(tmp_path.glob("*.ndjson.gz")) == []
+    assert db.query(models.ActionArchive).get("2020-01").path is None
+    assert db.query(models.ActionArchive).get("2020-03") is None
+    assert retention.apply_retention(db, 0, None, now=NOW) == []
+
+
+def test_archive_actions_command(db, session_factory, monkeypatch, capsys):
+    monkeypatch.setattr(manage, "SessionLocal", session_factory)
+    assert manage.main(["archive-actions", "--months", "0"]) == 1
+    assert manage.main(["archive-actions", "--months", "1", "--drop"]) == 0
+    output = capsys.readouterr().out
+    assert "2020-01: 2 actions dropped" in output
+    assert "Archived" in output